@@ -16,45 +16,3699 @@ Usage:
     python cost_analysis.py [--subscription-id SUBSCRIPTION_ID] [--resource-group RESOURCE_GROUP]
 """
 
+import time
+
+_MODULE_START = time.perf_counter()
+
 import argparse
+import atexit
+import calendar
+import glob
+import hashlib
+import importlib
+import importlib.util
+import itertools
 import json
 import os
+import random
+import re
+import shutil
+import sqlite3
 import sys
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import requests
-import pandas as pd
-import matplotlib.pyplot as plt
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.consumption import ConsumptionManagementClient
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from statistics import NormalDist
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+_IMPORT_TIMES: Dict[str, float] = {}
+_started = time.perf_counter()
+import numpy as np
+_IMPORT_TIMES['numpy'] = time.perf_counter() - _started
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# pandas, matplotlib, openpyxl and the Azure SDK are imported lazily, only by the
+# code paths that need them, so text-only and offline runs start quickly.
+AZURE_CLIENTS = {
+    'consumption': ('azure.mgmt.consumption', 'ConsumptionManagementClient'),
+    'resource': ('azure.mgmt.resource', 'ResourceManagementClient'),
+    'compute': ('azure.mgmt.compute', 'ComputeManagementClient'),
+    'network': ('azure.mgmt.network', 'NetworkManagementClient'),
+    'monitor': ('azure.mgmt.monitor', 'MonitorManagementClient'),
+}
+
+# Costs are accumulated as integer nano-dollars so that partial aggregates
+# can be merged in any order and still produce identical totals.
+NANOS_PER_DOLLAR = 1_000_000_000
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_RESETTLE_DAYS = 3
+
+# Output artifacts: name -> (analyzer method, default file name)
+RENDERERS = {
+    'chart': ('create_cost_chart', 'cost_breakdown.png'),
+    'bar_chart': ('create_bar_chart', 'cost_bar_chart.png'),
+    'excel': ('create_detailed_spreadsheet', 'detailed_cost_analysis.xlsx'),
+    'csv': ('export_to_csv', 'cost_analysis.csv'),
+    'parquet': ('export_to_parquet', 'cost_lines.parquet'),
+    'arrow': ('export_to_arrow', 'cost_lines.arrow'),
+}
+# Optional modules an artifact needs; --all skips the artifact when they are missing
+RENDERER_REQUIRES = {'parquet': 'pyarrow', 'arrow': 'pyarrow'}
+# Rows per Parquet row group / Arrow record batch / CSV write
+EXPORT_CHUNK_ROWS = 128 * 1024
+HIVE_DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Rows per worksheet, including the header row
+EXCEL_MAX_ROWS = 1_048_576
+# Bump when a renderer's output changes so cached artifacts are not reused
+RENDER_VERSION = 7
+DEFAULT_KEEP_REPORTS = 30
+DEFAULT_ARTIFACT_CACHE_MB = 200
+MAX_BATCH_WORKERS = 32
+DEFAULT_MAX_RETRIES = 8
+SHARD_DAYS = {'day': 1, 'week': 7}
+DEFAULT_PROFILE_TOP = 30
+DEFAULT_SERVICE_PORT = 8765
+DEFAULT_REFRESH_MINUTES = 60
+# The Terraform stack and the sample price sheet live next to this script
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PRICE_SHEET = os.path.join(SCRIPT_DIR, 'price_sheet.json')
+
+
+def _lazy_import(name: str):
+    """Import a module on first use and record how long the import took."""
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        _IMPORT_TIMES[name] = time.perf_counter() - started
+    return module
+
+
+def _module_available(name: Optional[str]) -> bool:
+    return name is None or name in sys.modules or importlib.util.find_spec(name) is not None
+
+
+def _pandas():
+    return _lazy_import('pandas')
+
+
+def _pyplot():
+    return _lazy_import('matplotlib.pyplot')
+
+
+def _default_credential():
+    return _lazy_import('azure.identity').DefaultAzureCredential()
+
+
+def startup_profile() -> str:
+    """Import-time breakdown of this run, heaviest first."""
+    lines = ["Startup profile (import times):"]
+    for name, elapsed in sorted(_IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"  {name:<28} {elapsed * 1000:8.1f} ms")
+    lines.append(f"  {'total since module load':<28} {(time.perf_counter() - _MODULE_START) * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+
+def _usage_field(usage, name: str, default=None):
+    """Read a usage-detail field from either the flattened or the properties model."""
+    value = getattr(usage, name, None)
+    if value is None:
+        properties = getattr(usage, 'properties', None)
+        if properties is not None:
+            value = getattr(properties, name, None)
+    return default if value is None else value
+
+
+def _shard_periods(start: date, end: date, shard_by: str = 'none') -> List[Tuple[date, date]]:
+    """Split an inclusive date range into consecutive day or week periods."""
+    if shard_by not in SHARD_DAYS:
+        return [(start, end)]
+    step = timedelta(days=SHARD_DAYS[shard_by])
+    periods = []
+    cursor = start
+    while cursor <= end:
+        shard_end = min(cursor + step - timedelta(days=1), end)
+        periods.append((cursor, shard_end))
+        cursor = shard_end + timedelta(days=1)
+    return periods
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MB (None where unsupported)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+
+@dataclass
+class Span:
+    """One timed phase of a run; start is wall-clock so spans from worker processes line up."""
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    elapsed: float = 0.0
+    attributes: Dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+class Tracer:
+    """
+    Collects the timing spans and counters of a run.
+
+    Spans nest per thread; work handed to a thread pool passes its parent explicitly.
+    Worker processes drain() what they collected and the parent merge()s it, nesting
+    their root spans under the span that dispatched the work.
+    """
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.started = time.time()
+        self.spans: List[Span] = []
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current(self) -> Optional[Span]:
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+        parent = parent or self.current()
+        span = Span(name, os.urandom(8).hex(), parent.span_id if parent else None, time.time(),
+                    attributes=attributes)
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.elapsed = time.perf_counter() - started
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self) -> Dict:
+        """Remove and return everything collected so far."""
+        with self._lock:
+            trace = {'spans': self.spans, 'counters': self.counters}
+            self.spans, self.counters = [], {}
+        return trace
+
+    def merge(self, trace: Optional[Dict], parent: Optional[Span] = None):
+        """Add spans and counters drained in another process."""
+        if not trace:
+            return
+        parent = parent or self.current()
+        with self._lock:
+            for span in trace['spans']:
+                if span.parent_id is None and parent is not None:
+                    span.parent_id = parent.span_id
+                self.spans.append(span)
+            for name, value in trace['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict:
+        """Run summary: total time, per-phase timings (slowest first) and counters."""
+        with self._lock:
+            spans, counters = list(self.spans), dict(self.counters)
+        phases = {}
+        for span in spans:
+            phase = phases.setdefault(span.name, {'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'errors': 0})
+            phase['count'] += 1
+            phase['total_s'] += span.elapsed
+            phase['max_s'] = max(phase['max_s'], span.elapsed)
+            phase['errors'] += span.error is not None
+        for phase in phases.values():
+            phase['total_s'] = round(phase['total_s'], 6)
+            phase['max_s'] = round(phase['max_s'], 6)
+        return {
+            'trace_id': self.trace_id,
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'elapsed_s': round(time.time() - self.started, 6),
+            'peak_rss_mb': _peak_rss_mb(),
+            'counters': dict(sorted(counters.items())),
+            'phases': dict(sorted(phases.items(), key=lambda item: item[1]['total_s'], reverse=True)),
+            'import_ms': {name: round(elapsed * 1000, 3) for name, elapsed in _IMPORT_TIMES.items()},
+        }
+
+    @staticmethod
+    def _nanos(seconds: float) -> str:
+        return str(int(seconds * 1e9))
+
+    @staticmethod
+    def _otlp_value(value) -> Dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, (int, np.integer)):
+            return {'intValue': str(value)}
+        if isinstance(value, (float, np.floating)):
+            return {'doubleValue': float(value)}
+        return {'stringValue': str(value)}
+
+    def otlp(self, service_name: str = 'azure-cost-analysis') -> List[Dict]:
+        """Spans and counters as OTLP/JSON export requests: one for traces, one for metrics."""
+        with self._lock:
+            spans, counters = list(self.spans), dict(self.counters)
+        resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]}
+        scope = {'name': 'cost_analysis'}
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                'traceId': self.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': self._nanos(span.start),
+                'endTimeUnixNano': self._nanos(span.start + span.elapsed),
+                'attributes': [{'key': key, 'value': self._otlp_value(value)}
+                               for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {},
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            otlp_spans.append(otlp_span)
+        now = self._nanos(time.time())
+        metrics = [{
+            'name': name,
+            'sum': {
+                'dataPoints': [{'asInt': str(value), 'startTimeUnixNano': self._nanos(self.started), 'timeUnixNano': now}],
+                'aggregationTemporality': 2,
+                'isMonotonic': True,
+            },
+        } for name, value in sorted(counters.items())]
+        return [
+            {'resourceSpans': [{'resource': resource, 'scopeSpans': [{'scope': scope, 'spans': otlp_spans}]}]},
+            {'resourceMetrics': [{'resource': resource, 'scopeMetrics': [{'scope': scope, 'metrics': metrics}]}]},
+        ]
+
+
+# Spans and counters of this process; worker processes hand theirs back to the parent
+TRACER = Tracer()
+
+
+def _reset_trace():
+    """Pool initializer: drop spans a forked worker inherited from its parent."""
+    TRACER.drain()
+
+
+def write_trace_outputs(args) -> List[str]:
+    """Write the run summary and OTLP/JSON spans requested on the command line."""
+    written = []
+    if args.run_summary:
+        path = os.path.join(args.output_dir, 'run_summary.json')
+        with open(path, 'w') as f:
+            json.dump(TRACER.summary(), f, indent=2)
+        written.append(path)
+    if args.otlp_file:
+        # JSON lines of export requests, as read by the collector's otlpjsonfile receiver
+        with open(args.otlp_file, 'w') as f:
+            for request in TRACER.otlp():
+                f.write(json.dumps(request) + "\n")
+        written.append(args.otlp_file)
+    return written
+
+
+def run_profiled(function: Callable, output_dir: str, top: int = DEFAULT_PROFILE_TOP):
+    """Run function under cProfile and tracemalloc and write its top hotspots to output_dir."""
+    cprofile, pstats, tracemalloc = (_lazy_import(name) for name in ('cProfile', 'pstats', 'tracemalloc'))
+    io = _lazy_import('io')
+    tracemalloc.start()
+    profiler = cprofile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stem = os.path.join(output_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        profiler.dump_stats(stem + '.prof')
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stream.write(f"Top {top} functions by cumulative time (main thread):\n")
+        stats.sort_stats('cumulative').print_stats(top)
+        stream.write(f"Top {top} functions by own time (main thread):\n")
+        stats.sort_stats('tottime').print_stats(top)
+        stream.write(f"Top {top} allocation sites still held at exit (peak traced: {peak / 1024 / 1024:.1f} MB):\n")
+        for statistic in snapshot.statistics('lineno')[:top]:
+            stream.write(f"  {statistic}\n")
+        with open(stem + '.txt', 'w') as f:
+            f.write(stream.getvalue())
+        print(f"Profile saved to: {stem}.txt (raw stats: {stem}.prof)")
+
+# ARM resource types of the Terraform resources Infracost prices for this stack
+TERRAFORM_ARM_TYPES = {
+    'azurerm_windows_virtual_machine': 'Microsoft.Compute/virtualMachines',
+    'azurerm_linux_virtual_machine': 'Microsoft.Compute/virtualMachines',
+    'azurerm_virtual_machine': 'Microsoft.Compute/virtualMachines',
+    'azurerm_linux_virtual_machine_scale_set': 'Microsoft.Compute/virtualMachineScaleSets',
+    'azurerm_windows_virtual_machine_scale_set': 'Microsoft.Compute/virtualMachineScaleSets',
+    'azurerm_managed_disk': 'Microsoft.Compute/disks',
+    'azurerm_lb': 'Microsoft.Network/loadBalancers',
+    'azurerm_lb_rule': 'Microsoft.Network/loadBalancers',
+    'azurerm_application_gateway': 'Microsoft.Network/applicationGateways',
+    'azurerm_bastion_host': 'Microsoft.Network/bastionHosts',
+    'azurerm_traffic_manager_profile': 'Microsoft.Network/trafficmanagerprofiles',
+    'azurerm_traffic_manager_azure_endpoint': 'Microsoft.Network/trafficmanagerprofiles',
+    'azurerm_public_ip': 'Microsoft.Network/publicIPAddresses',
+    'azurerm_storage_account': 'Microsoft.Storage/storageAccounts',
+}
+# Infracost sub-resources that are separate ARM resources
+INFRACOST_SUBRESOURCE_TYPES = {
+    'os_disk': 'Microsoft.Compute/disks',
+    'storage_os_disk': 'Microsoft.Compute/disks',
+    'data_disk': 'Microsoft.Compute/disks',
+}
+
+
+# Ordered fallback rules for bare resource names (first match wins)
+DEFAULT_CLASSIFIER_RULES = [
+    (r'(_|-)?os_?disk(_|-|$)|(_|-)data_?disk|(_|-)disk(\d+|$)', 'Microsoft.Compute/disks'),
+    (r'(^|[-_])pip($|[-_])|public_?ip', 'Microsoft.Network/publicIPAddresses'),
+    (r'(^|[-_])nic($|[-_\d])', 'Microsoft.Network/networkInterfaces'),
+    (r'(^|[-_])nsg($|[-_])', 'Microsoft.Network/networkSecurityGroups'),
+    (r'(^|[-_])vnet($|[-_])', 'Microsoft.Network/virtualNetworks'),
+    (r'appgw|app_?gateway', 'Microsoft.Network/applicationGateways'),
+    (r'bastion', 'Microsoft.Network/bastionHosts'),
+    (r'(^|[-_])lb($|[-_])', 'Microsoft.Network/loadBalancers'),
+    (r'(^|[-_])tm($|[-_])|traffic_?manager', 'Microsoft.Network/trafficmanagerprofiles'),
+    (r'(^|[-_])(vmss|web|biz)($|[-_])', 'Microsoft.Compute/virtualMachineScaleSets'),
+    (r'(^|[-_])(vm|sql|ad)($|[-_\d])', 'Microsoft.Compute/virtualMachines'),
+    (r'storage|(^|[-_])sa($|[-_])', 'Microsoft.Storage/storageAccounts'),
+]
+KNOWN_ARM_TYPES = sorted(set(TERRAFORM_ARM_TYPES.values()) | set(INFRACOST_SUBRESOURCE_TYPES.values()) | {
+    rule_type for _, rule_type in DEFAULT_CLASSIFIER_RULES
+})
+
+
+class ResourceClassifier:
+    """
+    Resolves ARM resource types from ARM resource IDs, bare ARM types, Terraform
+    addresses or, failing those, resource names.
+
+    ARM types are looked up in an index keyed by (provider namespace, type) and
+    Terraform types in a dict keyed by the azurerm_* type, so results do not depend
+    on rule order. Only names that match neither fall through to the ordered regex
+    rules. Results are memoized and batches are classified per unique value.
+    """
+
+    _TERRAFORM_TYPE = re.compile(r'(?:^|\.)(azurerm_[a-z0-9_]+)\.')
+
+    def __init__(self, rules: Optional[List[Tuple[str, str]]] = None,
+                 terraform_types: Optional[Dict[str, str]] = None, default: str = "Unknown"):
+        self.default = default
+        self.terraform_types = dict(TERRAFORM_ARM_TYPES)
+        self.terraform_types.update(terraform_types or {})
+        self.arm_index: Dict[Tuple[str, str], str] = {}
+        for arm_type in KNOWN_ARM_TYPES + list(self.terraform_types.values()):
+            namespace, type_name = arm_type.split('/', 1)
+            self.arm_index.setdefault((namespace.lower(), type_name.lower()), arm_type)
+        self.rules = [(re.compile(pattern, re.IGNORECASE), arm_type)
+                      for pattern, arm_type in (rules or []) + DEFAULT_CLASSIFIER_RULES]
+        self._memo: Dict[str, str] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> 'ResourceClassifier':
+        """
+        Load extra rules from JSON: {"rules": [{"pattern": ..., "type": ...}],
+        "terraform_types": {"azurerm_...": "Microsoft.X/y"}}. File rules run before the defaults.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        rules = [(rule['pattern'], rule['type']) for rule in config.get('rules', [])]
+        return cls(rules, config.get('terraform_types'))
+
+    def _canonical(self, namespace: str, type_name: str) -> str:
+        return self.arm_index.get((namespace.lower(), type_name.lower()), f"{namespace}/{type_name}")
+
+    def _resolve(self, value: str) -> str:
+        if not value:
+            return self.default
+        if '/' in value:
+            segments = value.strip('/').split('/')
+            lowered = [segment.lower() for segment in segments]
+            if 'providers' in lowered:
+                index = len(lowered) - 1 - lowered[::-1].index('providers')
+                if index + 2 < len(segments):
+                    return self._canonical(segments[index + 1], segments[index + 2])
+            elif len(segments) == 2 and '.' in segments[0]:
+                return self._canonical(segments[0], segments[1])
+        match = self._TERRAFORM_TYPE.search(value)
+        if match and match.group(1) in self.terraform_types:
+            return self.terraform_types[match.group(1)]
+        if value in self.terraform_types:
+            return self.terraform_types[value]
+        name = value.rstrip('/').split('/')[-1]
+        for pattern, arm_type in self.rules:
+            if pattern.search(name):
+                return arm_type
+        return self.default
+
+    def classify(self, value: Optional[str]) -> str:
+        value = value or ""
+        resolved = self._memo.get(value)
+        if resolved is None:
+            resolved = self._memo[value] = self._resolve(value)
+        return resolved
+
+    def classify_many(self, values) -> np.ndarray:
+        """Classify an array of identifiers, resolving each distinct value once."""
+        distinct = CategoryIndex()
+        codes = distinct.encode(values)
+        resolved = np.array([self.classify(value) for value in distinct.values], dtype=object)
+        return resolved[codes] if len(codes) else np.zeros(0, dtype=object)
+
+
+DEFAULT_CLASSIFIER = ResourceClassifier()
+
+
+class CategoryIndex:
+    """Dictionary encoder that maps string values to dense integer codes."""
+
+    def __init__(self):
+        self._codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+        return code
+
+    def encode(self, values: Iterable[str]) -> np.ndarray:
+        return np.fromiter((self.code(value) for value in values), dtype=np.int32)
+
+
+@dataclass
+class UsageBatch:
+    """A page of usage rows in columnar form; codes refer to the aggregator's indexes."""
+    type_codes: np.ndarray
+    name_codes: np.ndarray
+    meter_codes: np.ndarray
+    days: np.ndarray
+    costs: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.costs)
+
+
+@dataclass
+class IngestStats:
+    """Throughput and memory figures for one ingestion run."""
+    rows: int = 0
+    pages: int = 0
+    batches: int = 0
+    shards: int = 1
+    elapsed: float = 0.0
+    peak_rss_mb: Optional[float] = None
+    retries: int = 0
+    throttled: int = 0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        rss = f"{self.peak_rss_mb:.1f} MB" if self.peak_rss_mb is not None else "n/a"
+        shards = f" across {self.shards} shards" if self.shards > 1 else ""
+        retries = f", {self.retries} retries ({self.throttled} throttled)" if self.retries else ""
+        return (f"Ingested {self.rows:,} rows from {self.pages:,} pages{shards} in {self.elapsed:.2f}s "
+                f"({self.rows_per_sec:,.0f} rows/sec, peak RSS {rss}{retries})")
+
+
+@dataclass(frozen=True)
+class FetchShard:
+    """One usage-details query: a scope and an inclusive usage date range."""
+    scope: str
+    start: date
+    end: date
+
+    @property
+    def filter(self) -> str:
+        return (f"properties/usageStart ge '{self.start:%Y-%m-%d}' and "
+                f"properties/usageEnd le '{self.end:%Y-%m-%d}'")
+
+
+class ApiThrottledError(RuntimeError):
+    """API requests kept being throttled or failing transiently after all retries."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket pacing requests to `rate` per second; no pacing when rate is None."""
+
+    def __init__(self, rate: Optional[float] = None, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve a token now, then wait outside the lock until it has accrued
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RequestScheduler:
+    """
+    Paces, limits and retries Azure API page requests across all fetch threads.
+
+    Requests draw from a token bucket and from a concurrency limit adapted AIMD-style:
+    every success raises the limit by 1/limit (about one per round of requests) up to
+    max_concurrency, every throttled response halves it. Retry-After (and the
+    x-ms-ratelimit-*-retry-after variants) pauses all threads until the deadline, and
+    low x-ms-ratelimit-remaining-* values shrink the limit before requests get rejected.
+    Paged operations resume from the last completed page after a failure.
+    """
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_concurrency: int = 1, rate: Optional[float] = None, burst: Optional[float] = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff: float = 1.0, low_remaining: int = 10):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(rate or 1.0, 1.0))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.low_remaining = low_remaining
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.min_remaining: Optional[int] = None
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._paused_until = 0.0
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self._in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+            self.requests += 1
+        TRACER.count('api.requests')
+        self.bucket.acquire()
+
+    def _release(self, succeeded: bool, throttled: bool = False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            elif succeeded:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _pause(self, seconds: float):
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _transport_errors() -> Tuple[type, ...]:
+        """Dropped connections and timeouts; azure-core's derive from AzureError, not the builtins."""
+        errors = (ConnectionError, TimeoutError)
+        try:
+            exceptions = _lazy_import('azure.core.exceptions')
+        except ImportError:
+            return errors
+        return errors + (exceptions.ServiceRequestError, exceptions.ServiceResponseError)
+
+    @staticmethod
+    def _headers(error: Exception) -> Dict[str, str]:
+        response = getattr(error, 'response', None)
+        return dict(getattr(response, 'headers', None) or {})
+
+    @staticmethod
+    def _status(error: Exception) -> Optional[int]:
+        status = getattr(error, 'status_code', None)
+        if status is None:
+            status = getattr(getattr(error, 'response', None), 'status_code', None)
+        return status
+
+    @staticmethod
+    def retry_after(headers: Dict[str, str]) -> Optional[float]:
+        """Longest delay requested by Retry-After style headers (seconds or an HTTP date)."""
+        delays = []
+        for name, value in headers.items():
+            name = name.lower()
+            if name != 'retry-after' and not (name.startswith('x-ms-ratelimit') and name.endswith('retry-after')):
+                continue
+            try:
+                delays.append(float(value))
+            except ValueError:
+                try:
+                    delays.append((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        return max(delays) if delays else None
+
+    @staticmethod
+    def remaining(headers: Dict[str, str]) -> Optional[int]:
+        """Smallest x-ms-ratelimit-remaining-* value of a response."""
+        values = []
+        for name, value in headers.items():
+            if name.lower().startswith('x-ms-ratelimit-remaining'):
+                try:
+                    values.append(int(value))
+                except ValueError:
+                    pass
+        return min(values) if values else None
+
+    def observe(self, pipeline_response):
+        """raw_response_hook reading the size and rate-limit headers of every response."""
+        response = pipeline_response.http_response
+        headers = dict(response.headers)
+        length = next((value for name, value in headers.items() if name.lower() == 'content-length'), None)
+        if length is None and callable(getattr(response, 'body', None)):
+            TRACER.count('api.bytes', len(response.body() or b''))
+        elif length is not None:
+            TRACER.count('api.bytes', int(length))
+        remaining = self.remaining(headers)
+        if remaining is None:
+            return
+        with self._condition:
+            self.min_remaining = remaining if self.min_remaining is None else min(self.min_remaining, remaining)
+            if remaining <= self.low_remaining:
+                self.limit = max(1.0, self.limit / 2)
+
+    def call(self, function: Callable):
+        """Run one API request under the scheduler, retrying throttled and transient failures."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                result = function()
+            except Exception as e:
+                status = self._status(e)
+                if status not in self.RETRYABLE_STATUS and not isinstance(e, self._transport_errors()):
+                    self._release(False)
+                    raise
+                self._release(False, throttled=status == 429)
+                if attempt == self.max_retries:
+                    raise ApiThrottledError(f"Giving up after {attempt + 1} attempts: {e}") from e
+                with self._condition:
+                    self.retries += 1
+                    self.throttled += status == 429
+                TRACER.count('api.retries')
+                if status == 429:
+                    TRACER.count('api.throttled')
+                delay = self.retry_after(self._headers(e))
+                if delay is not None:
+                    # The limit applies to the whole subscription, so every thread waits
+                    self._pause(delay)
+                else:
+                    time.sleep(self.backoff * 2 ** attempt * (0.5 + random.random() / 2))
+            else:
+                self._release(True)
+                return result
+
+    def pages(self, list_call: Callable) -> Iterator[List]:
+        """
+        Yield the pages of a paged list operation, each fetched under the scheduler.
+
+        list_call(raw_response_hook) starts the operation. After a failed request it is
+        restarted from the continuation token of the last completed page, or, for pagers
+        without tokens, replayed with the completed pages skipped. Replayed pages are
+        requests too, so each is fetched under the scheduler like any other page.
+        """
+        # position: pages the current pager has returned, counted from the first page
+        state = {'pager': None, 'token': None, 'completed': 0, 'position': 0}
+        
+        def fetch_page():
+            try:
+                if state['pager'] is None:
+                    state['pager'] = list_call(self.observe).by_page(continuation_token=state['token'])
+                    state['position'] = state['completed'] if state['token'] is not None else 0
+                page = next(state['pager'], None)
+                if page is None:
+                    return None
+                state['position'] += 1
+                return list(page)
+            except Exception:
+                state['pager'] = None
+                raise
+        
+        while True:
+            with TRACER.span('api.page') as span:
+                page = self.call(fetch_page)
+                span.attributes['rows'] = 0 if page is None else len(page)
+            if page is None:
+                return
+            if state['position'] <= state['completed']:
+                span.attributes['replayed'] = True
+                continue
+            state['completed'] += 1
+            state['token'] = getattr(state['pager'], 'continuation_token', None)
+            yield page
+
+
+class StreamingCostAggregator:
+    """
+    Incrementally aggregates usage rows into (resource type, resource name, meter, day) cells.
+
+    Rows are encoded page by page into columnar batches and folded into a fixed set of
+    cells, so memory grows with the number of distinct cells rather than with the number
+    of usage rows.
+    """
+
+    def __init__(self, classifier: Optional[ResourceClassifier] = None):
+        self.classifier = classifier or DEFAULT_CLASSIFIER
+        self.resource_types = CategoryIndex()
+        self.resource_names = CategoryIndex()
+        self.meters = CategoryIndex()
+        self._cells: Dict[tuple, int] = {}
+        self._cell_keys: List[tuple] = []
+        self._nanos = np.zeros(1024, dtype=np.int64)
+        self.rows = 0
+
+    def __len__(self) -> int:
+        return len(self._cell_keys)
+
+    def make_batch(self, usages: List) -> UsageBatch:
+        """Encode a list of usage-detail objects into a columnar batch."""
+        identifiers, names, meters, days, costs = [], [], [], [], []
+        for usage in usages:
+            resource_id = _usage_field(usage, 'resource_id') or _usage_field(usage, 'instance_name')
+            identifiers.append(_usage_field(usage, 'resource_type') or resource_id
+                               or _usage_field(usage, 'resource_name') or "")
+            names.append(_usage_field(usage, 'resource_name')
+                         or (resource_id.rstrip('/').split('/')[-1] if resource_id else "Unknown"))
+            meter_details = _usage_field(usage, 'meter_details')
+            meters.append(_usage_field(usage, 'meter_name')
+                          or getattr(meter_details, 'meter_name', None)
+                          or _usage_field(usage, 'meter_id') or "Unknown")
+            usage_date = _usage_field(usage, 'date')
+            days.append(usage_date.toordinal() if usage_date else 0)
+            cost = _usage_field(usage, 'cost')
+            if cost is None:
+                cost = _usage_field(usage, 'cost_in_billing_currency')
+            costs.append(float(cost) if cost else 0.0)
+        types = self.classifier.classify_many(identifiers)
+        return self.make_batch_from_columns(types, names, meters, days, costs)
+
+    def make_batch_from_columns(self, types: Iterable[str], names: Iterable[str],
+                                meters: Iterable[str], days, costs) -> UsageBatch:
+        """Encode already-columnar values into a batch."""
+        return UsageBatch(
+            type_codes=self.resource_types.encode(types),
+            name_codes=self.resource_names.encode(names),
+            meter_codes=self.meters.encode(meters),
+            days=np.asarray(days, dtype=np.int32),
+            costs=np.asarray(costs, dtype=np.float64),
+        )
+
+    def _slots_for(self, keys: np.ndarray) -> np.ndarray:
+        slots = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            slot = self._cells.get(key)
+            if slot is None:
+                slot = len(self._cell_keys)
+                self._cells[key] = slot
+                self._cell_keys.append(key)
+            slots[i] = slot
+        if len(self._cell_keys) > len(self._nanos):
+            grown = np.zeros(max(len(self._cell_keys), 2 * len(self._nanos)), dtype=np.int64)
+            grown[:len(self._nanos)] = self._nanos
+            self._nanos = grown
+        return slots
+
+    def add_batch(self, batch: UsageBatch):
+        """Fold a columnar batch into the running cell totals."""
+        if len(batch) == 0:
+            return
+        keys = np.stack([batch.type_codes, batch.name_codes, batch.meter_codes, batch.days], axis=1)
+        self._add_nanos(keys, np.rint(batch.costs * NANOS_PER_DOLLAR).astype(np.int64))
+        self.rows += len(batch)
+
+    def _add_nanos(self, keys: np.ndarray, nanos: np.ndarray):
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        slots = self._slots_for(unique_keys)
+        np.add.at(self._nanos, slots[inverse.reshape(-1)], nanos)
+
+    def add_usages(self, usages: List):
+        self.add_batch(self.make_batch(usages))
+
+    def add_cells(self, types: Iterable[str], names: Iterable[str], meters: Iterable[str],
+                  days, nanos):
+        """Fold pre-aggregated cells (costs in nano-dollars) into the running totals."""
+        nanos = np.asarray(nanos, dtype=np.int64)
+        if len(nanos) == 0:
+            return
+        keys = np.stack([self.resource_types.encode(types), self.resource_names.encode(names),
+                         self.meters.encode(meters), np.asarray(days, dtype=np.int32)], axis=1)
+        self._add_nanos(keys, nanos)
+
+    def merge(self, other: 'StreamingCostAggregator'):
+        """Fold another aggregator's cells into this one (exact, order-independent)."""
+        count = len(other)
+        if count == 0:
+            return
+        keys = np.array(other._cell_keys, dtype=np.int64).reshape(count, 4)
+        type_map = self.resource_types.encode(other.resource_types.values)
+        name_map = self.resource_names.encode(other.resource_names.values)
+        meter_map = self.meters.encode(other.meters.values)
+        translated = np.stack([type_map[keys[:, 0]], name_map[keys[:, 1]],
+                               meter_map[keys[:, 2]], keys[:, 3]], axis=1)
+        slots = self._slots_for(translated)
+        np.add.at(self._nanos, slots, other._nanos[:count])
+        self.rows += other.rows
+
+    def cell_nanos(self):
+        """Yield (resource type, resource name, meter, day ordinal, nano-dollars) for every cell."""
+        for slot, (type_code, name_code, meter_code, day) in enumerate(self._cell_keys):
+            yield (self.resource_types.values[type_code],
+                   self.resource_names.values[name_code],
+                   self.meters.values[meter_code],
+                   day,
+                   int(self._nanos[slot]))
+
+    def cells(self):
+        """Yield (resource type, resource name, meter, day ordinal, cost) for every cell."""
+        for resource_type, resource_name, meter, day, nanos in self.cell_nanos():
+            yield resource_type, resource_name, meter, day, nanos / NANOS_PER_DOLLAR
+
+    def to_table(self, period: str) -> 'CostTable':
+        """Materialize the cells as a canonical cost table."""
+        count = len(self._cell_keys)
+        keys = np.array(self._cell_keys, dtype=np.int64).reshape(count, 4)
+        return CostTable(
+            {
+                'resource_type': keys[:, 0],
+                'resource_name': keys[:, 1],
+                'meter': keys[:, 2],
+                'day': keys[:, 3],
+                'cost_nanos': self._nanos[:count].copy(),
+            },
+            {
+                'resource_type': list(self.resource_types.values),
+                'resource_name': list(self.resource_names.values),
+                'meter': list(self.meters.values),
+            },
+            period
+        )
+
+    def to_cost_data(self, period: str) -> Dict:
+        """Collapse the cells into the report's cost data structure."""
+        return self.to_table(period).to_cost_data()
+
+
+def _ordinals_to_dates(days: np.ndarray) -> np.ndarray:
+    """Convert proleptic day ordinals to datetime64[ns]; 0 (unknown date) becomes NaT."""
+    days = np.asarray(days, dtype=np.int64)
+    dates = (np.datetime64('0001-01-01', 'D') + (days - 1)).astype('datetime64[ns]')
+    dates[days == 0] = np.datetime64('NaT')
+    return dates
+
+
+def _ordinals_to_months(days: np.ndarray) -> np.ndarray:
+    """Convert proleptic day ordinals to month numbers (months since 1970-01)."""
+    days = np.asarray(days, dtype=np.int64)
+    return (np.datetime64('0001-01-01', 'D') + (days - 1)).astype('datetime64[M]').astype(np.int64)
+
+
+def _month_start_ordinals(months: np.ndarray) -> np.ndarray:
+    """Day ordinal of the first day of each month number."""
+    first_days = np.asarray(months, dtype=np.int64).astype('datetime64[M]').astype('datetime64[D]')
+    return (first_days - np.datetime64('0001-01-01', 'D')).astype(np.int64) + 1
+
+
+def _month_labels(months: np.ndarray) -> np.ndarray:
+    """'YYYY-MM' labels of month numbers."""
+    return np.datetime_as_string(np.asarray(months, dtype=np.int64).astype('datetime64[M]')).astype(object)
+
+
+def _short_type_name(resource_type: str) -> str:
+    return resource_type.split('/')[-1].replace('Microsoft.', '')
+
+
+def _category_ranks(values: List[str]) -> np.ndarray:
+    """Rank of each category value in sorted order, indexed by category code."""
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[np.argsort(np.array(values, dtype=object), kind='stable')] = np.arange(len(values))
+    return ranks
+
+
+def _descending_ranks(sorted_nanos: np.ndarray) -> np.ndarray:
+    """'min' ranks (1 = largest) of values already sorted in descending order."""
+    return np.searchsorted(-sorted_nanos, -sorted_nanos, side='left') + 1
+
+
+def _python_values(column: np.ndarray) -> List:
+    """Python values of a column; NaN becomes None (an empty cell, or null in JSON)."""
+    if column.dtype.kind == 'f' and np.isnan(column).any():
+        return [None if value != value else value for value in column.tolist()]
+    return column.tolist()
+
+
+class ColumnSet:
+    """A small column-oriented result set: named NumPy arrays of equal length."""
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return ColumnSet({name: values[key] for name, values in self.columns.items()})
+
+    def rows(self):
+        """Iterate the rows as named tuples."""
+        Row = namedtuple('Row', list(self.columns))
+        return map(Row._make, zip(*(values.tolist() for values in self.columns.values())))
+
+    def records(self, limit: Optional[int] = None) -> List[Dict]:
+        """The first `limit` rows as JSON-ready dicts; 'day' ordinals and datetimes become ISO dates."""
+        columns = self[:limit] if limit is not None else self
+        values = {}
+        for name, column in columns.columns.items():
+            if name == 'day':
+                values[name] = [date.fromordinal(day).isoformat() if day else None for day in column.tolist()]
+            elif column.dtype.kind == 'M':
+                values[name] = np.datetime_as_string(column, unit='D').tolist()
+            else:
+                values[name] = _python_values(column)
+        return [dict(zip(values, row)) for row in zip(*values.values())]
+
+
+class CostTable:
+    """
+    Canonical columnar cost table shared by the report and every exporter.
+
+    Cells are (resource_type, resource_name, meter, day, cost) rows held as NumPy arrays,
+    with the string columns dictionary-encoded. Aggregations are computed once over
+    integer nano-dollar costs and cached, so all outputs agree on totals, percentages
+    and ordering. pandas is only needed to materialize the table as a DataFrame.
+    """
+
+    CATEGORICAL = ('resource_type', 'resource_name', 'meter')
+
+    def __init__(self, columns: Dict[str, np.ndarray], categories: Dict[str, List[str]], period: str):
+        self.columns = columns
+        self.categories = categories
+        self.period = period
+
+    def __len__(self) -> int:
+        return len(self.columns['cost_nanos'])
+
+    @classmethod
+    def from_cost_data(cls, cost_data: Dict) -> 'CostTable':
+        """Build a table from a legacy breakdown dict (one undated cell per resource)."""
+        table = cost_data.get('table')
+        if isinstance(table, CostTable):
+            return table
+        aggregator = StreamingCostAggregator()
+        for resource_type, data in cost_data['breakdown'].items():
+            resources = data['resources']
+            aggregator.add_batch(aggregator.make_batch_from_columns(
+                [resource_type] * len(resources), list(resources), ['Unknown'] * len(resources),
+                [0] * len(resources), list(resources.values())
+            ))
+        return aggregator.to_table(cost_data['period'])
+
+    @classmethod
+    def concat(cls, tables: List['CostTable'], period: str) -> 'CostTable':
+        """Stack several tables into one, re-encoding their categories."""
+        indexes = {name: CategoryIndex() for name in cls.CATEGORICAL}
+        parts: Dict[str, List[np.ndarray]] = {name: [] for name in (*cls.CATEGORICAL, 'day', 'cost_nanos')}
+        for table in tables:
+            for name in cls.CATEGORICAL:
+                mapping = indexes[name].encode(table.categories[name]).astype(np.int64)
+                parts[name].append(mapping[table.columns[name]])
+            parts['day'].append(table.columns['day'])
+            parts['cost_nanos'].append(table.columns['cost_nanos'])
+        columns = {name: (np.concatenate(values) if values else np.zeros(0, dtype=np.int64))
+                   for name, values in parts.items()}
+        return cls(columns, {name: index.values for name, index in indexes.items()}, period)
+
+    def values(self, name: str) -> np.ndarray:
+        """Decoded string values of a categorical column."""
+        return np.array(self.categories[name], dtype=object)[self.columns[name]]
+
+    @cached_property
+    def total_nanos(self) -> int:
+        return int(self.columns['cost_nanos'].sum())
+
+    @property
+    def total_cost(self) -> float:
+        return self.total_nanos / NANOS_PER_DOLLAR
+
+    def _percentages(self, nanos: np.ndarray) -> np.ndarray:
+        if not self.total_nanos:
+            return np.zeros(len(nanos))
+        return nanos / self.total_nanos * 100
+
+    @cached_property
+    def by_resource(self) -> ColumnSet:
+        """Cost per (resource_type, resource_name), sorted by cost descending, then by name."""
+        type_codes = self.columns['resource_type'].astype(np.int64)
+        name_codes = self.columns['resource_name'].astype(np.int64)
+        width = max(len(self.categories['resource_name']), 1)
+        pairs, inverse = np.unique(type_codes * width + name_codes, return_inverse=True)
+        nanos = np.zeros(len(pairs), dtype=np.int64)
+        np.add.at(nanos, inverse.reshape(-1), self.columns['cost_nanos'])
+        pair_types, pair_names = pairs // width, pairs % width
+        
+        order = np.lexsort((_category_ranks(self.categories['resource_name'])[pair_names],
+                            _category_ranks(self.categories['resource_type'])[pair_types],
+                            -nanos))
+        nanos = nanos[order]
+        type_values = np.array(self.categories['resource_type'], dtype=object)
+        return ColumnSet({
+            'type_code': pair_types[order],
+            'name_code': pair_names[order],
+            'resource_type': type_values[pair_types[order]],
+            'short_type': np.array([_short_type_name(value) for value in type_values],
+                                   dtype=object)[pair_types[order]],
+            'resource_name': np.array(self.categories['resource_name'], dtype=object)[pair_names[order]],
+            'cost_nanos': nanos,
+            'cost': nanos / NANOS_PER_DOLLAR,
+            'percentage': self._percentages(nanos),
+            'rank': _descending_ranks(nanos),
+        })
+
+    @cached_property
+    def by_type(self) -> ColumnSet:
+        """Cost and resource count per resource_type, sorted by cost descending."""
+        by_resource = self.by_resource
+        type_count = len(self.categories['resource_type'])
+        nanos = np.zeros(type_count, dtype=np.int64)
+        np.add.at(nanos, by_resource['type_code'], by_resource['cost_nanos'])
+        counts = np.bincount(by_resource['type_code'], minlength=type_count)
+        present = np.flatnonzero(counts)
+        
+        order = present[np.lexsort((_category_ranks(self.categories['resource_type'])[present], -nanos[present]))]
+        type_values = np.array(self.categories['resource_type'], dtype=object)[order]
+        return ColumnSet({
+            'type_code': order,
+            'resource_type': type_values,
+            'short_type': np.array([_short_type_name(value) for value in type_values], dtype=object),
+            'cost_nanos': nanos[order],
+            'cost': nanos[order] / NANOS_PER_DOLLAR,
+            'percentage': self._percentages(nanos[order]),
+            'resource_count': counts[order],
+            'rank': _descending_ranks(nanos[order]),
+        })
+
+    @cached_property
+    def by_day(self) -> ColumnSet:
+        """Cost per usage day (undated cells excluded), in date order."""
+        days = self.columns['day']
+        dated = days != 0
+        unique_days, inverse = np.unique(days[dated], return_inverse=True)
+        nanos = np.zeros(len(unique_days), dtype=np.int64)
+        np.add.at(nanos, inverse.reshape(-1), self.columns['cost_nanos'][dated])
+        return ColumnSet({
+            'day': unique_days.astype(np.int64),
+            'date': _ordinals_to_dates(unique_days),
+            'cost_nanos': nanos,
+            'cost': nanos / NANOS_PER_DOLLAR,
+        })
+
+    @cached_property
+    def days_covered(self) -> Optional[int]:
+        """Days from the first to the last dated usage day, or None for undated (monthly) tables."""
+        days = self.by_day['day']
+        return int(days[-1] - days[0]) + 1 if len(days) else None
+
+    @property
+    def average_days(self) -> float:
+        """Days daily and hourly averages are taken over; undated monthly estimates span an average month."""
+        return self.days_covered or HOURS_PER_MONTH / 24
+
+    @cached_property
+    def daily_series(self) -> Tuple[np.ndarray, ColumnSet, np.ndarray]:
+        """
+        Per-resource daily cost series: a dense day axis, the resources, and a
+        (days x resources) matrix of nano-dollars. Days without usage are zero.
+        """
+        dated = self.columns['day'] != 0
+        width = max(len(self.categories['resource_name']), 1)
+        pairs, resource_index = np.unique(
+            self.columns['resource_type'][dated].astype(np.int64) * width + self.columns['resource_name'][dated],
+            return_inverse=True
+        )
+        days = self.columns['day'][dated].astype(np.int64)
+        axis = np.arange(days.min(), days.max() + 1) if len(days) else np.zeros(0, dtype=np.int64)
+        matrix = np.zeros((len(axis), len(pairs)), dtype=np.int64)
+        np.add.at(matrix, (days - (axis[0] if len(axis) else 0), resource_index.reshape(-1)),
+                  self.columns['cost_nanos'][dated])
+        resources = ColumnSet({
+            'resource_type': np.array(self.categories['resource_type'], dtype=object)[pairs // width],
+            'resource_name': np.array(self.categories['resource_name'], dtype=object)[pairs % width],
+        })
+        return axis, resources, matrix
+
+    @cached_property
+    def resources_by_type(self) -> Dict[str, ColumnSet]:
+        """by_resource split per resource type, each in cost order."""
+        by_resource = self.by_resource
+        order = np.argsort(by_resource['type_code'], kind='stable')
+        codes = by_resource['type_code'][order]
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        groups = {}
+        for indices in np.split(order, boundaries):
+            if len(indices):
+                groups[by_resource['resource_type'][indices[0]]] = by_resource[indices]
+        return groups
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """Content hash of the table, independent of cell order and category encoding."""
+        ranked = [_category_ranks(self.categories[name])[self.columns[name]] for name in self.CATEGORICAL]
+        keys = (*ranked, self.columns['day'].astype(np.int64), self.columns['cost_nanos'])
+        order = np.lexsort(keys[::-1])
+        digest = hashlib.sha256(self.period.encode())
+        for name in self.CATEGORICAL:
+            digest.update("\x1f".join(sorted(self.categories[name])).encode())
+        for column in keys:
+            digest.update(np.ascontiguousarray(column[order], dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    @cached_property
+    def frame(self):
+        """The cells as a pandas DataFrame with categorical string columns."""
+        pd = _pandas()
+        return pd.DataFrame({
+            'resource_type': pd.Categorical.from_codes(self.columns['resource_type'],
+                                                       categories=self.categories['resource_type']),
+            'resource_name': pd.Categorical.from_codes(self.columns['resource_name'],
+                                                       categories=self.categories['resource_name']),
+            'date': _ordinals_to_dates(self.columns['day']),
+            'meter': pd.Categorical.from_codes(self.columns['meter'], categories=self.categories['meter']),
+            'cost': self.columns['cost_nanos'] / NANOS_PER_DOLLAR,
+        })
+
+    def precompute(self) -> 'CostTable':
+        """Compute every cached aggregation up front, e.g. before shipping a snapshot to workers."""
+        for name in ('total_nanos', 'by_resource', 'by_type', 'by_day', 'days_covered', 'resources_by_type',
+                     'fingerprint'):
+            getattr(self, name)
+        return self
+
+    def category_cost(self, keyword: str) -> float:
+        """Total cost of resource types whose name contains keyword (e.g. 'Compute')."""
+        mask = np.array([keyword in value for value in self.by_type['resource_type']], dtype=bool)
+        return int(self.by_type['cost_nanos'][mask].sum()) / NANOS_PER_DOLLAR
+
+    def to_cost_data(self) -> Dict:
+        """Cost data dict with the legacy breakdown alongside the table itself."""
+        breakdown = {}
+        for row in self.by_type.rows():
+            resources = self.resources_by_type[row.resource_type]
+            breakdown[row.resource_type] = {
+                'total_cost': row.cost,
+                'resources': dict(zip(resources['resource_name'].tolist(), resources['cost'].tolist()))
+            }
+        return {
+            'total_cost': self.total_cost,
+            'period': self.period,
+            'breakdown': breakdown,
+            'table': self
+        }
+
+
+class UsageStore:
+    """
+    On-disk cache of aggregated usage cells, keyed by subscription, scope and usage date.
+
+    Each scope carries a watermark (the last usage date fetched) so later runs only
+    need to fetch the days after it, plus a re-settlement window for late charges.
+    """
+
+    FILENAME = "usage_cache.sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_cells (
+                    subscription_id TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    usage_date TEXT NOT NULL,
+                    resource_type TEXT NOT NULL,
+                    resource_name TEXT NOT NULL,
+                    meter TEXT NOT NULL,
+                    cost_nanos INTEGER NOT NULL,
+                    PRIMARY KEY (subscription_id, scope, usage_date, resource_type, resource_name, meter)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    subscription_id TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    last_usage_date TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL,
+                    PRIMARY KEY (subscription_id, scope)
+                )
+            """)
+
+    @classmethod
+    def in_directory(cls, output_dir: str) -> 'UsageStore':
+        return cls(os.path.join(output_dir, cls.FILENAME))
+
+    def close(self):
+        self._conn.close()
+
+    def watermark(self, subscription_id: str, scope: str) -> Optional[date]:
+        row = self._conn.execute(
+            "SELECT last_usage_date FROM watermarks WHERE subscription_id = ? AND scope = ?",
+            (subscription_id, scope)
+        ).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def replace(self, subscription_id: str, scope: str, start: date, end: date,
+                aggregator: StreamingCostAggregator):
+        """Replace the stored cells of [start, end] with freshly fetched ones and advance the watermark."""
+        # Rows without a usage date are attributed to the first day of the fetched range
+        rows = [
+            (subscription_id, scope, date.fromordinal(day or start.toordinal()).isoformat(),
+             resource_type, resource_name, meter, nanos)
+            for resource_type, resource_name, meter, day, nanos in aggregator.cell_nanos()
+        ]
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM usage_cells WHERE subscription_id = ? AND scope = ? "
+                "AND usage_date BETWEEN ? AND ?",
+                (subscription_id, scope, start.isoformat(), end.isoformat())
+            )
+            self._conn.executemany(
+                "INSERT INTO usage_cells VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT DO UPDATE SET cost_nanos = cost_nanos + excluded.cost_nanos",
+                rows
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)",
+                (subscription_id, scope, end.isoformat(), datetime.now().isoformat(timespec='seconds'))
+            )
+
+    def load(self, subscription_id: str, scopes: List[str], start: date, end: date) -> StreamingCostAggregator:
+        """Load the stored cells of the given scopes and date range into a fresh aggregator."""
+        aggregator = StreamingCostAggregator()
+        placeholders = ", ".join("?" for _ in scopes)
+        cursor = self._conn.execute(
+            "SELECT resource_type, resource_name, meter, usage_date, cost_nanos FROM usage_cells "
+            f"WHERE subscription_id = ? AND scope IN ({placeholders}) AND usage_date BETWEEN ? AND ?",
+            (subscription_id, *scopes, start.isoformat(), end.isoformat())
+        )
+        while True:
+            rows = cursor.fetchmany(DEFAULT_BATCH_SIZE)
+            if not rows:
+                break
+            types, names, meters, usage_dates, nanos = zip(*rows)
+            aggregator.add_cells(types, names, meters,
+                                 [date.fromisoformat(value).toordinal() for value in usage_dates], nanos)
+        return aggregator
+
+
+class CostHistory:
+    """
+    Local history of daily and monthly cost aggregates per resource, across runs.
+
+    Resource types and names are dictionary-encoded into a resources table, so the
+    aggregate tables are narrow integer rows keyed by target (subscription and resource
+    group), period and resource. Monthly totals are maintained next to the daily ones,
+    so month-level trend queries never scan days.
+    """
+
+    FILENAME = "cost_history.sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        # Batch workers share one history file, so wait for each other's writes
+        self._conn = sqlite3.connect(path, timeout=60)
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS targets (
+                    target_id INTEGER PRIMARY KEY,
+                    subscription_id TEXT NOT NULL,
+                    resource_group TEXT NOT NULL,
+                    UNIQUE (subscription_id, resource_group)
+                );
+                CREATE TABLE IF NOT EXISTS resources (
+                    resource_id INTEGER PRIMARY KEY,
+                    resource_type TEXT NOT NULL,
+                    resource_name TEXT NOT NULL,
+                    UNIQUE (resource_type, resource_name)
+                );
+                CREATE TABLE IF NOT EXISTS daily_costs (
+                    target_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    resource_id INTEGER NOT NULL,
+                    cost_nanos INTEGER NOT NULL,
+                    PRIMARY KEY (target_id, day, resource_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS daily_costs_by_day ON daily_costs (day, resource_id, cost_nanos);
+                CREATE TABLE IF NOT EXISTS monthly_costs (
+                    target_id INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    resource_id INTEGER NOT NULL,
+                    cost_nanos INTEGER NOT NULL,
+                    PRIMARY KEY (target_id, month, resource_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS anomaly_state (
+                    target_id INTEGER NOT NULL,
+                    resource_id INTEGER NOT NULL,
+                    mean REAL NOT NULL,
+                    var REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (target_id, resource_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS anomaly_checkpoints (
+                    target_id INTEGER PRIMARY KEY,
+                    day INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS anomalies (
+                    target_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    resource_id INTEGER NOT NULL,
+                    cost REAL NOT NULL,
+                    expected REAL NOT NULL,
+                    zscore REAL NOT NULL,
+                    PRIMARY KEY (target_id, day, resource_id)
+                ) WITHOUT ROWID;
+            """)
+
+    @classmethod
+    def in_directory(cls, output_dir: str) -> 'CostHistory':
+        return cls(os.path.join(output_dir, cls.FILENAME))
+
+    def close(self):
+        self._conn.close()
+
+    def _target_id(self, subscription_id: str, resource_group: str) -> int:
+        self._conn.execute("INSERT OR IGNORE INTO targets (subscription_id, resource_group) VALUES (?, ?)",
+                           (subscription_id, resource_group))
+        return self._conn.execute(
+            "SELECT target_id FROM targets WHERE subscription_id = ? AND resource_group = ?",
+            (subscription_id, resource_group)
+        ).fetchone()[0]
+
+    def _target_ids(self, targets: Optional[List[Tuple[str, str]]]) -> Optional[List[int]]:
+        if targets is None:
+            return None
+        wanted = set(targets)
+        return [target_id for target_id, subscription_id, resource_group
+                in self._conn.execute("SELECT target_id, subscription_id, resource_group FROM targets")
+                if (subscription_id, resource_group) in wanted]
+
+    def record(self, subscription_id: str, resource_group: str, start: date, end: date, table: CostTable):
+        """Replace the history of [start, end] for one target with the given table's costs."""
+        # Cells without a usage date are attributed to the first day of the range
+        days = np.where(table.columns['day'] == 0, start.toordinal(), table.columns['day']).astype(np.int64)
+        width = max(len(table.categories['resource_name']), 1)
+        resources, resource_inverse = np.unique(
+            table.columns['resource_type'].astype(np.int64) * width + table.columns['resource_name'],
+            return_inverse=True
+        )
+        keys, inverse = np.unique(np.stack([resource_inverse.reshape(-1), days], axis=1),
+                                  axis=0, return_inverse=True)
+        nanos = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(nanos, inverse.reshape(-1), table.columns['cost_nanos'])
+
+        pairs = [(table.categories['resource_type'][pair // width], table.categories['resource_name'][pair % width])
+                 for pair in resources.tolist()]
+        start_month, end_month = _ordinals_to_months([start.toordinal(), end.toordinal()]).tolist()
+        with self._conn:
+            target_id = self._target_id(subscription_id, resource_group)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO resources (resource_type, resource_name) VALUES (?, ?)", pairs
+            )
+            ids = dict(((resource_type, resource_name), resource_id) for resource_id, resource_type, resource_name
+                       in self._conn.execute("SELECT resource_id, resource_type, resource_name FROM resources"))
+            resource_ids = np.array([ids[pair] for pair in pairs], dtype=np.int64)
+
+            self._conn.execute("DELETE FROM daily_costs WHERE target_id = ? AND day BETWEEN ? AND ?",
+                               (target_id, start.toordinal(), end.toordinal()))
+            self._conn.executemany(
+                "INSERT INTO daily_costs VALUES (?, ?, ?, ?, ?)",
+                zip([target_id] * len(keys), keys[:, 1].tolist(), _ordinals_to_months(keys[:, 1]).tolist(),
+                    resource_ids[keys[:, 0]].tolist(), nanos.tolist())
+            )
+            self._conn.execute("DELETE FROM monthly_costs WHERE target_id = ? AND month BETWEEN ? AND ?",
+                               (target_id, start_month, end_month))
+            self._conn.execute(
+                "INSERT INTO monthly_costs SELECT target_id, month, resource_id, SUM(cost_nanos) FROM daily_costs "
+                "WHERE target_id = ? AND month BETWEEN ? AND ? GROUP BY target_id, month, resource_id",
+                (target_id, start_month, end_month)
+            )
+
+    def _load(self, query: str, where: List[str], params: List, target_ids: Optional[List[int]],
+              meter: str, period: str) -> CostTable:
+        if target_ids is not None:
+            where.append(f"target_id IN ({', '.join('?' for _ in target_ids)})")
+            params.extend(target_ids)
+        rows = self._conn.execute(query.format(where=" AND ".join(where)), params).fetchall()
+        cells = np.array(rows, dtype=np.int64).reshape(len(rows), 3)
+
+        resource_ids, resource_types, resource_names = [], CategoryIndex(), CategoryIndex()
+        type_codes, name_codes = [], []
+        for resource_id, resource_type, resource_name in self._conn.execute(
+                "SELECT resource_id, resource_type, resource_name FROM resources"):
+            resource_ids.append(resource_id)
+            type_codes.append(resource_types.code(resource_type))
+            name_codes.append(resource_names.code(resource_name))
+        slots = np.zeros(max(resource_ids, default=0) + 1, dtype=np.int64)
+        slots[resource_ids] = np.arange(len(resource_ids))
+        slot = slots[cells[:, 0]]
+        return CostTable(
+            {
+                'resource_type': np.array(type_codes, dtype=np.int64)[slot],
+                'resource_name': np.array(name_codes, dtype=np.int64)[slot],
+                'meter': np.zeros(len(cells), dtype=np.int64),
+                'day': cells[:, 1],
+                'cost_nanos': cells[:, 2],
+            },
+            {'resource_type': resource_types.values, 'resource_name': resource_names.values, 'meter': [meter]},
+            period
+        )
+
+    def daily(self, targets: Optional[List[Tuple[str, str]]] = None,
+              start: Optional[date] = None, end: Optional[date] = None) -> CostTable:
+        """Daily cost per resource, summed over the given (subscription, resource group) targets."""
+        where, params = ["day BETWEEN ? AND ?"], [(start or date.min).toordinal(), (end or date.max).toordinal()]
+        return self._load(
+            "SELECT resource_id, day, SUM(cost_nanos) FROM daily_costs WHERE {where} GROUP BY day, resource_id",
+            where, params, self._target_ids(targets), 'Daily', "Daily history"
+        )
+
+    def monthly(self, targets: Optional[List[Tuple[str, str]]] = None,
+                start: Optional[date] = None, end: Optional[date] = None) -> CostTable:
+        """Monthly cost per resource (dated on the first of the month), summed over the given targets."""
+        months = _ordinals_to_months([(start or date(1970, 1, 1)).toordinal(), (end or date.max).toordinal()])
+        where, params = ["month BETWEEN ? AND ?"], months.tolist()
+        table = self._load(
+            "SELECT resource_id, month, SUM(cost_nanos) FROM monthly_costs WHERE {where} GROUP BY resource_id, month",
+            where, params, self._target_ids(targets), 'Monthly', "Monthly history"
+        )
+        table.columns['day'] = _month_start_ordinals(table.columns['day'])
+        return table
+
+    def detect_anomalies(self, subscription_id: str, resource_group: str, detector: 'AnomalyDetector',
+                         settled_before: date, since: date) -> ColumnSet:
+        """
+        Score the days recorded since the target's last checkpoint and return its anomalies since `since`.
+
+        The detector state is checkpointed at the last day before settled_before, so
+        days that may still receive late charges are re-scored on the next run.
+        """
+        with self._conn:
+            target_id = self._target_id(subscription_id, resource_group)
+            row = self._conn.execute("SELECT day FROM anomaly_checkpoints WHERE target_id = ?",
+                                     (target_id,)).fetchone()
+            checkpoint = row[0] if row else 0
+            saved = np.array(self._conn.execute(
+                "SELECT resource_id, mean, var, count FROM anomaly_state WHERE target_id = ?", (target_id,)
+            ).fetchall(), dtype=np.float64).reshape(-1, 4)
+            cells = np.array(self._conn.execute(
+                "SELECT resource_id, day, cost_nanos FROM daily_costs WHERE target_id = ? AND day > ?",
+                (target_id, checkpoint)
+            ).fetchall(), dtype=np.int64).reshape(-1, 3)
+            
+            if len(cells):
+                resource_ids = np.union1d(saved[:, 0].astype(np.int64), cells[:, 0])
+                state = EwmaState.empty(len(resource_ids))
+                index = np.searchsorted(resource_ids, saved[:, 0].astype(np.int64))
+                state.mean[index], state.var[index], state.count[index] = saved[:, 1], saved[:, 2], saved[:, 3]
+                
+                first_day = checkpoint + 1 if checkpoint else int(cells[:, 1].min())
+                days = np.arange(first_day, cells[:, 1].max() + 1)
+                matrix = np.zeros((len(days), len(resource_ids)), dtype=np.int64)
+                np.add.at(matrix, (cells[:, 1] - first_day, np.searchsorted(resource_ids, cells[:, 0])), cells[:, 2])
+                snapshot_row = int(np.searchsorted(days, settled_before.toordinal())) - 1
+                flagged, expected, zscores, snapshot = detector.run(matrix / NANOS_PER_DOLLAR, state, snapshot_row)
+                
+                rows, columns = np.nonzero(flagged)
+                self._conn.execute("DELETE FROM anomalies WHERE target_id = ? AND day > ?", (target_id, checkpoint))
+                self._conn.executemany(
+                    "INSERT INTO anomalies VALUES (?, ?, ?, ?, ?, ?)",
+                    zip([target_id] * len(rows), days[rows].tolist(), resource_ids[columns].tolist(),
+                        (matrix[rows, columns] / NANOS_PER_DOLLAR).tolist(),
+                        expected[rows, columns].tolist(), zscores[rows, columns].tolist())
+                )
+                if snapshot_row >= 0:
+                    self._conn.execute("DELETE FROM anomaly_state WHERE target_id = ?", (target_id,))
+                    self._conn.executemany(
+                        "INSERT INTO anomaly_state VALUES (?, ?, ?, ?, ?)",
+                        zip([target_id] * len(resource_ids), resource_ids.tolist(), snapshot.mean.tolist(),
+                            snapshot.var.tolist(), snapshot.count.tolist())
+                    )
+                    self._conn.execute("INSERT OR REPLACE INTO anomaly_checkpoints VALUES (?, ?)",
+                                       (target_id, int(days[snapshot_row])))
+        return self.anomalies([(subscription_id, resource_group)], since)
+
+    def anomalies(self, targets: Optional[List[Tuple[str, str]]] = None,
+                  since: Optional[date] = None) -> ColumnSet:
+        """Recorded anomalies of the given targets, newest first and then by z-score."""
+        where, params = ["a.day >= ?"], [(since or date.min).toordinal()]
+        target_ids = self._target_ids(targets)
+        if target_ids is not None:
+            where.append(f"a.target_id IN ({', '.join('?' for _ in target_ids)})")
+            params.extend(target_ids)
+        rows = self._conn.execute(
+            "SELECT a.day, t.resource_group, r.resource_type, r.resource_name, a.cost, a.expected, a.zscore "
+            "FROM anomalies a JOIN targets t USING (target_id) JOIN resources r USING (resource_id) "
+            f"WHERE {' AND '.join(where)} ORDER BY a.day DESC, a.zscore DESC",
+            params
+        ).fetchall()
+        columns = list(zip(*rows)) or [()] * 7
+        days = np.array(columns[0], dtype=np.int64)
+        return ColumnSet({
+            'day': days,
+            'date': _ordinals_to_dates(days),
+            'resource_group': np.array(columns[1], dtype=object),
+            'resource_type': np.array(columns[2], dtype=object),
+            'resource_name': np.array(columns[3], dtype=object),
+            'cost': np.array(columns[4], dtype=np.float64),
+            'expected': np.array(columns[5], dtype=np.float64),
+            'zscore': np.array(columns[6], dtype=np.float64),
+        })
+
+    def trends(self, targets: Optional[List[Tuple[str, str]]] = None, months: int = 12, weeks: int = 8,
+               today: Optional[date] = None) -> 'CostTrends':
+        """Trends over the last `months` months and `weeks` weeks of history."""
+        today = today or date.today()
+        first_month = _month_start_ordinals(_ordinals_to_months([today.toordinal()]) - (months - 1))[0]
+        return CostTrends(self.monthly(targets, date.fromordinal(int(first_month)), today),
+                          self.daily(targets, today - timedelta(days=7 * weeks - 1), today))
+
+
+class CostTrends:
+    """
+    Month-over-month and week-over-week cost trends.
+
+    Built from two cost tables: one cell per resource and month (dated on the first of
+    the month) and one cell per resource and day. Deltas are whole-array window
+    operations over a dense period axis, so gaps in the history count as zero cost.
+    """
+
+    def __init__(self, monthly: CostTable, daily: CostTable):
+        self.monthly = monthly
+        self.daily = daily
+
+    @classmethod
+    def from_table(cls, table: CostTable, today: Optional[date] = None) -> 'CostTrends':
+        """Trends of a single cost table; undated cells are counted in the current month."""
+        days = table.columns['day']
+        days = np.where(days == 0, (today or date.today()).toordinal(), days)
+        monthly = CostTable({**table.columns, 'day': _month_start_ordinals(_ordinals_to_months(days))},
+                            table.categories, table.period)
+        return cls(monthly, table)
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return hashlib.sha256((self.monthly.fingerprint + self.daily.fingerprint).encode()).hexdigest()
+
+    @staticmethod
+    def _change(series: np.ndarray, lag: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Previous cost, change and percentage change against `lag` steps earlier along axis 0.
+
+        series holds nano-dollars; results are dollars, NaN where there is no earlier period.
+        """
+        previous = np.zeros_like(series)
+        previous[lag:] = series[:len(series) - lag]
+        missing = (np.arange(len(series)) < lag).reshape((-1,) + (1,) * (series.ndim - 1))
+        change = series - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent = np.where(missing | (previous == 0), np.nan, change / previous * 100)
+        return (np.where(missing, np.nan, previous / NANOS_PER_DOLLAR),
+                np.where(missing, np.nan, change / NANOS_PER_DOLLAR),
+                percent)
+
+    @cached_property
+    def months(self) -> np.ndarray:
+        """Dense month axis (months since 1970-01) from the first to the last month with costs."""
+        present = _ordinals_to_months(self.monthly.columns['day'])
+        if not len(present):
+            return np.zeros(0, dtype=np.int64)
+        return np.arange(present.min(), present.max() + 1)
+
+    @cached_property
+    def monthly_by_type(self) -> np.ndarray:
+        """Nano-dollars per (month, resource type code)."""
+        matrix = np.zeros((len(self.months), len(self.monthly.categories['resource_type'])), dtype=np.int64)
+        if len(self.months):
+            rows = _ordinals_to_months(self.monthly.columns['day']) - self.months[0]
+            np.add.at(matrix, (rows, self.monthly.columns['resource_type']), self.monthly.columns['cost_nanos'])
+        return matrix
+
+    @cached_property
+    def month_over_month(self) -> ColumnSet:
+        """Total cost per month with the change against the previous month, newest first."""
+        totals = self.monthly_by_type.sum(axis=1)
+        previous, change, percent = self._change(totals, 1)
+        return ColumnSet({
+            'month': _month_labels(self.months)[::-1],
+            'cost': totals[::-1] / NANOS_PER_DOLLAR,
+            'previous_cost': previous[::-1],
+            'change': change[::-1],
+            'change_pct': percent[::-1],
+        })
+
+    @cached_property
+    def type_month_over_month(self) -> ColumnSet:
+        """Latest month's cost per resource type against the previous month, largest change first."""
+        matrix = self.monthly_by_type
+        if not len(matrix):
+            matrix = np.zeros((1, matrix.shape[1]), dtype=np.int64)
+        previous, change, percent = self._change(matrix, 1)
+        present = np.flatnonzero((matrix[-1] != 0) | (np.nan_to_num(previous[-1]) != 0))
+        order = present[np.lexsort((-matrix[-1, present], -np.nan_to_num(np.abs(change[-1, present]))))]
+        return ColumnSet({
+            'resource_type': np.array(self.monthly.categories['resource_type'], dtype=object)[order],
+            'cost': matrix[-1, order] / NANOS_PER_DOLLAR,
+            'previous_cost': previous[-1, order],
+            'change': change[-1, order],
+            'change_pct': percent[-1, order],
+        })
+
+    def category_costs(self, keywords: List[str]) -> Dict[str, np.ndarray]:
+        """Monthly cost of resource types whose name contains each keyword, newest first."""
+        types = self.monthly.categories['resource_type']
+        masks = np.array([[keyword in value for value in types] for keyword in keywords],
+                         dtype=np.int64).reshape(len(keywords), len(types))
+        costs = self.monthly_by_type @ masks.T
+        return {keyword: costs[::-1, index] / NANOS_PER_DOLLAR for index, keyword in enumerate(keywords)}
+
+    @cached_property
+    def week_over_week(self) -> ColumnSet:
+        """Rolling 7-day cost per day with the change against the 7 days before, in date order."""
+        by_day = self.daily.by_day
+        days = (np.arange(by_day['day'][0], by_day['day'][-1] + 1) if len(by_day)
+                else np.zeros(0, dtype=np.int64))
+        daily = np.zeros(len(days), dtype=np.int64)
+        daily[by_day['day'] - (days[0] if len(days) else 0)] = by_day['cost_nanos']
+        cumulative = np.concatenate([np.zeros(7, dtype=np.int64), np.cumsum(daily)])
+        week = cumulative[7:] - cumulative[:-7]
+        previous, change, percent = self._change(week, 7)
+        return ColumnSet({
+            'day': days,
+            'date': _ordinals_to_dates(days),
+            'cost': week / NANOS_PER_DOLLAR,
+            'previous_cost': previous,
+            'change': change,
+            'change_pct': percent,
+        })
+
+    def summary_lines(self, months: int = 3) -> List[str]:
+        """Text report lines for the latest months and the latest rolling week."""
+        def delta(change: float, percent: float, versus: str) -> str:
+            if np.isnan(change):
+                return "no earlier data"
+            return f"{change:+.2f}" + ("" if np.isnan(percent) else f", {percent:+.1f}%") + versus
+        
+        if not len(self.months):
+            return ["No cost history recorded"]
+        lines = []
+        for row in self.month_over_month[:months].rows():
+            lines.append(f"{row.month}: ${row.cost:.2f} "
+                         f"({delta(row.change, row.change_pct, ' vs previous month')})")
+        for row in self.type_month_over_month[:5].rows():
+            lines.append(f"  {row.resource_type}: ${row.cost:.2f} ({delta(row.change, row.change_pct, '')})")
+        week_over_week = self.week_over_week
+        if len(week_over_week):
+            latest = week_over_week[-1:]
+            lines.append(f"Last 7 days: ${latest['cost'][0]:.2f} "
+                         f"({delta(latest['change'][0], latest['change_pct'][0], ' vs previous 7 days')})")
+        return lines
+
+
+DEFAULT_ANOMALY_THRESHOLD = 4.0
+
+
+@dataclass
+class EwmaState:
+    """Exponentially weighted mean and variance of each resource's daily cost, and its days seen."""
+    mean: np.ndarray
+    var: np.ndarray
+    count: np.ndarray
+
+    @classmethod
+    def empty(cls, size: int) -> 'EwmaState':
+        return cls(np.zeros(size), np.zeros(size), np.zeros(size, dtype=np.int64))
+
+    def copy(self) -> 'EwmaState':
+        return EwmaState(self.mean.copy(), self.var.copy(), self.count.copy())
+
+
+class AnomalyDetector:
+    """
+    Streaming EWMA z-score detector over per-resource daily cost series.
+
+    Each day is scored against the exponentially weighted mean and variance of the
+    resource's earlier days and then folded into them, so new days can be scored
+    from a saved state without replaying the history. Only cost increases are
+    flagged, once a resource has `warmup` days of cost behind it.
+    """
+
+    def __init__(self, alpha: float = 0.2, threshold: float = DEFAULT_ANOMALY_THRESHOLD, warmup: int = 7,
+                 min_change: float = 1.0, relative_floor: float = 0.05):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        # Ignore increases below min_change dollars, and never let the deviation scale
+        # drop below relative_floor of the mean (flat series would score infinite)
+        self.min_change = min_change
+        self.relative_floor = relative_floor
+
+    def run(self, costs: np.ndarray, state: EwmaState,
+            snapshot_row: int = -1) -> Tuple[np.ndarray, np.ndarray, np.ndarray, EwmaState]:
+        """
+        Score a (days x resources) matrix of dollar costs, advancing state in place.
+
+        Returns the anomaly mask, the expected cost and the z-score of every cell, and a
+        copy of the state after row snapshot_row (the incoming state when negative).
+        """
+        flagged = np.zeros(costs.shape, dtype=bool)
+        expected = np.zeros(costs.shape)
+        zscores = np.zeros(costs.shape)
+        snapshot = state.copy()
+        for row, day_costs in enumerate(costs):
+            deviation = day_costs - state.mean
+            scale = np.maximum(np.sqrt(state.var), self.relative_floor * np.abs(state.mean))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                zscore = np.where(scale > 0, deviation / scale, np.where(deviation > 0, np.inf, 0.0))
+            flagged[row] = ((state.count >= self.warmup) & (zscore > self.threshold)
+                            & (deviation >= self.min_change))
+            expected[row] = state.mean
+            zscores[row] = zscore
+            
+            # Resources start their series on their first day with cost
+            active = (state.count > 0) | (day_costs != 0)
+            first = active & (state.count == 0)
+            increment = self.alpha * deviation
+            state.var = np.where(active & ~first, (1 - self.alpha) * (state.var + deviation * increment), state.var)
+            state.mean = np.where(first, day_costs, np.where(active, state.mean + increment, state.mean))
+            state.count = state.count + active
+            if row == snapshot_row:
+                snapshot = state.copy()
+        return flagged, expected, zscores, snapshot
+
+    def scan(self, table: CostTable) -> ColumnSet:
+        """Anomalies in a table's daily series, scored from scratch, newest first and then by z-score."""
+        days, resources, matrix = table.daily_series
+        costs = matrix / NANOS_PER_DOLLAR
+        flagged, expected, zscores, _ = self.run(costs, EwmaState.empty(len(resources)))
+        rows, columns = np.nonzero(flagged)
+        order = np.lexsort((-zscores[rows, columns], -rows))
+        rows, columns = rows[order], columns[order]
+        return ColumnSet({
+            'day': days[rows],
+            'date': _ordinals_to_dates(days[rows]),
+            'resource_group': np.full(len(rows), None, dtype=object),
+            'resource_type': resources['resource_type'][columns],
+            'resource_name': resources['resource_name'][columns],
+            'cost': costs[rows, columns],
+            'expected': expected[rows, columns],
+            'zscore': zscores[rows, columns],
+        })
+
+
+DEFAULT_FORECAST_CONFIDENCE = 0.9
+
+
+class CostForecaster:
+    """
+    Month-end projection of month-to-date daily cost series.
+
+    Each row of a (series x days elapsed) matrix gets an ordinary least-squares line
+    fitted in closed form, so thousands of series (resource types, resource groups)
+    are fitted with a few array operations. The month-end total is the cost to date
+    plus the line summed over the remaining days; the band is a normal prediction
+    interval from the residual variance. Series shorter than `min_days` are projected
+    at their mean daily cost.
+    """
+
+    def __init__(self, confidence: float = DEFAULT_FORECAST_CONFIDENCE, min_days: int = 3):
+        self.confidence = confidence
+        self.min_days = max(min_days, 3)
+
+    @staticmethod
+    def month_to_date(table: CostTable) -> Tuple[date, int, ColumnSet, np.ndarray]:
+        """
+        Month start, days in the month, resources and a (resources x days elapsed)
+        nano-dollar matrix of the latest month in the table. Days elapsed run up to the
+        last day with usage data.
+        """
+        days, resources, matrix = table.daily_series
+        if not len(days):
+            raise ValueError("Forecasting needs dated usage data")
+        last_day = date.fromordinal(int(days[-1]))
+        month_start = last_day.replace(day=1)
+        current = days >= month_start.toordinal()
+        series = np.zeros((len(resources), last_day.day), dtype=np.int64)
+        series[:, days[current] - month_start.toordinal()] = matrix[current].T
+        return month_start, calendar.monthrange(last_day.year, last_day.month)[1], resources, series
+
+    def forecast(self, series: np.ndarray, days_in_month: int,
+                 budgets: Optional[np.ndarray] = None) -> ColumnSet:
+        """
+        Project the month-end total of each row of nano-dollar daily costs.
+
+        With budgets (one per row, NaN for none), also reports the projected overrun
+        and the day of the month on which the budget is projected to run out (0 if never).
+        """
+        costs = np.asarray(series, dtype=np.float64) / NANOS_PER_DOLLAR
+        count, elapsed = costs.shape
+        remaining = max(days_in_month - elapsed, 0)
+        elapsed_axis = np.arange(elapsed, dtype=np.float64)
+        future_axis = np.arange(elapsed, elapsed + remaining, dtype=np.float64)
+        to_date = costs.sum(axis=1)
+        mean = to_date / max(elapsed, 1)
+        
+        if elapsed >= self.min_days:
+            centered = elapsed_axis - elapsed_axis.mean()
+            sxx = centered @ centered
+            slope = (costs - mean[:, None]) @ centered / sxx
+            intercept = mean - slope * elapsed_axis.mean()
+            residuals = costs - (intercept[:, None] + slope[:, None] * elapsed_axis)
+            variance = (residuals ** 2).sum(axis=1) / (elapsed - 2)
+            # Noise of each remaining day plus the uncertainty of the fitted line
+            spread = (remaining + remaining ** 2 / elapsed
+                      + (future_axis - elapsed_axis.mean()).sum() ** 2 / sxx)
+        else:
+            slope = np.zeros(count)
+            intercept = mean
+            variance = costs.var(axis=1, ddof=1) if elapsed > 1 else mean ** 2
+            spread = remaining + remaining ** 2 / max(elapsed, 1)
+        
+        projected_daily = np.maximum(intercept[:, None] + slope[:, None] * future_axis, 0.0)
+        expected = projected_daily.sum(axis=1)
+        margin = NormalDist().inv_cdf((1 + self.confidence) / 2) * np.sqrt(variance * spread)
+        projected = to_date + expected
+        columns = {
+            'cost_to_date': to_date,
+            'projected': projected,
+            'lower': to_date + np.maximum(expected - margin, 0.0),
+            'upper': projected + margin,
+            'burn_rate': costs[:, -7:].mean(axis=1) if elapsed else np.zeros(count),
+            'trend': slope,
+        }
+        if budgets is not None:
+            budgets = np.asarray(budgets, dtype=np.float64)
+            cumulative = np.cumsum(np.concatenate([costs, projected_daily], axis=1), axis=1)
+            exceeded = cumulative >= budgets[:, None]
+            columns['budget'] = budgets
+            columns['overrun'] = projected - budgets
+            columns['budget_used_pct'] = to_date / budgets * 100
+            columns['exhausted_day'] = np.where(exceeded.any(axis=1), exceeded.argmax(axis=1) + 1, 0)
+        return ColumnSet(columns)
+
+    def forecast_tables(self, tables: List[CostTable], budget: Optional[float] = None) -> Tuple[ColumnSet, Dict]:
+        """
+        Forecast the month-to-date totals of many tables (e.g. resource groups) as one batch.
+
+        Series are aligned on the latest month across the tables; the last row is the
+        forecast of their combined cost.
+        """
+        last_days = [table.by_day['day'][-1] for table in tables if len(table.by_day)]
+        if not last_days:
+            raise ValueError("Forecasting needs dated usage data")
+        last_day = date.fromordinal(int(max(last_days)))
+        month_start = last_day.replace(day=1).toordinal()
+        rows = np.zeros((len(tables) + 1, last_day.day), dtype=np.int64)
+        for row, table in enumerate(tables):
+            by_day = table.by_day[table.by_day['day'] >= month_start]
+            rows[row, by_day['day'] - month_start] = by_day['cost_nanos']
+        rows[-1] = rows[:-1].sum(axis=0)
+        budgets = np.full(len(rows), np.nan if budget is None else budget)
+        budgets[-1] = np.nan if budget is None else budget * len(tables)
+        days_in_month = calendar.monthrange(last_day.year, last_day.month)[1]
+        forecast = self.forecast(rows, days_in_month, budgets if budget is not None else None)
+        return forecast, {'start': last_day.replace(day=1), 'days_in_month': days_in_month,
+                          'days_elapsed': last_day.day}
+
+    def forecast_table(self, table: CostTable, budget: Optional[float] = None) -> Tuple[ColumnSet, ColumnSet, Dict]:
+        """
+        Forecast the table's latest month in total and per resource type, fitted as one batch.
+
+        Returns the total forecast (one row, with the budget columns when a budget is
+        given), the per-type forecasts in projected cost order, and the month details.
+        """
+        month_start, days_in_month, resources, series = self.month_to_date(table)
+        types, type_index = np.unique(resources['resource_type'].astype(str), return_inverse=True)
+        rows = np.zeros((len(types) + 1, series.shape[1]), dtype=np.int64)
+        np.add.at(rows, type_index.reshape(-1), series)
+        rows[-1] = series.sum(axis=0)
+        budgets = np.full(len(rows), np.nan)
+        budgets[-1] = np.nan if budget is None else budget
+        forecast = self.forecast(rows, days_in_month, budgets if budget is not None else None)
+        
+        by_type = forecast[:len(types)]
+        by_type.columns['resource_type'] = types.astype(object)
+        order = np.argsort(-by_type['projected'], kind='stable')
+        month = {'start': month_start, 'days_in_month': days_in_month, 'days_elapsed': series.shape[1]}
+        return forecast[len(types):], by_type[order], month
 
-class AzureCostAnalyzer:
-    def __init__(self, subscription_id: str, resource_group: str = "azure-3tier-rg-ypggv"):
+
+HOURS_PER_MONTH = 730
+HOURS_PER_WEEK = 168
+SCHEDULE_OPTIONS = tuple((label, hours * days / HOURS_PER_WEEK)
+                         for label, hours, days in (('24x7', 24, 7), ('12x7', 12, 7), ('12x5', 12, 5),
+                                                    ('10x5', 10, 5), ('8x5', 8, 5)))
+SAVINGS_KINDS = ('sku', 'schedule', 'reservation', 'hybrid_benefit')
+MAX_SCENARIOS = 1_000_000
+
+
+@dataclass(frozen=True)
+class SavingsLever:
+    """
+    One what-if dimension: the resources it applies to and its mutually exclusive options.
+
+    Option values depend on the kind: 'sku' is the fraction of cost that remains, 'schedule'
+    the fraction of the week resources run, 'reservation' the discount on compute and
+    'hybrid_benefit' 1 to drop the license share of the cost. The first option is the
+    status quo.
+    """
+    name: str
+    kind: str
+    resource_type: str
+    options: Tuple[Tuple[str, float], ...]
+    recommendation: str
+    effort: str = 'Medium'
+    name_pattern: str = ''
+    license_share: float = 0.0
+
+    REQUIRED = ('name', 'kind', 'resource_type', 'options', 'recommendation')
+
+    @classmethod
+    def from_dict(cls, config: Dict, default: Optional['SavingsLever'] = None) -> 'SavingsLever':
+        """Lever from its JSON object; fields it leaves out are kept from the default lever it overrides."""
+        if default is not None:
+            config = {**default.__dict__, **config}
+        missing = [name for name in cls.REQUIRED if name not in config]
+        if missing:
+            raise ValueError(f"Savings lever {config.get('name', '(unnamed)')!r} is missing {', '.join(missing)}")
+        if config['kind'] not in SAVINGS_KINDS:
+            raise ValueError(f"Unknown lever kind '{config['kind']}', expected one of {', '.join(SAVINGS_KINDS)}")
+        options = (tuple((label, value) for label, value in SCHEDULE_OPTIONS) if config.get('options') == 'schedule'
+                   else tuple((str(label), float(value)) for label, value in config['options']))
+        return cls(config['name'], config['kind'], config['resource_type'], options, config['recommendation'],
+                   config.get('effort', 'Medium'), config.get('name_pattern', ''),
+                   float(config.get('license_share', 0.0)))
+
+    def matches(self, table: 'CostTable') -> np.ndarray:
+        """Mask of the resources (rows of table.by_resource) this lever applies to."""
+        by_resource = table.by_resource
+        type_pattern = re.compile(self.resource_type, re.IGNORECASE)
+        type_hits = np.array([bool(type_pattern.search(value)) for value in table.categories['resource_type']],
+                             dtype=bool)
+        mask = type_hits[by_resource['type_code']]
+        if self.name_pattern and mask.any():
+            # Only the names of resources whose type already matched are searched, each once.
+            name_pattern = re.compile(self.name_pattern, re.IGNORECASE)
+            names = table.categories['resource_name']
+            candidates = np.unique(by_resource['name_code'][mask])
+            name_hits = np.zeros(len(names), dtype=bool)
+            name_hits[candidates] = [bool(name_pattern.search(names[code])) for code in candidates]
+            mask &= name_hits[by_resource['name_code']]
+        return mask
+
+
+# SQL and AD VMs by Azure name (az3t-sql-0, azure-3tier-ad) or Terraform address
+# (azurerm_windows_virtual_machine.sql[0], ....ad), as in DEFAULT_TIER_RULES
+SQL_VM_PATTERN = r'(^|[-_.])sql($|[-_.\d\[])'
+AD_VM_PATTERN = r'(^|[-_.])ad($|[-_.\d\[])'
+
+# List-price assumptions (East US): App Gateway Basic runs at roughly a tenth of Standard_v2's fixed
+# hourly rate with capacity units unchanged; reservations save about 40% (1 year) / 60% (3 years)
+# on compute; Hybrid Benefit drops the Windows license, about 40% of a Windows VM's cost.
+DEFAULT_SAVINGS_LEVERS = [
+    SavingsLever('appgw_sku', 'sku', 'applicationGateways', (('Standard_v2', 1.0), ('Basic', 0.3)),
+                 "Consider using Application Gateway Basic SKU instead of Standard v2 "
+                 "if WAF features are not required.", effort='Low'),
+    SavingsLever('bastion_hours', 'schedule', 'bastionHosts', SCHEDULE_OPTIONS[:1] + SCHEDULE_OPTIONS[2:],
+                 "Consider using Azure Bastion only during business hours (deploy it on demand).", effort='Low'),
+    SavingsLever('vm_shutdown', 'schedule', 'virtualMachines|virtualMachineScaleSets', SCHEDULE_OPTIONS,
+                 "Implement auto-shutdown for VMs during non-business hours.", effort='Low',
+                 name_pattern=f'^(?!.*{SQL_VM_PATTERN})(?!.*{AD_VM_PATTERN})'),
+    SavingsLever('sql_shutdown', 'schedule', 'virtualMachines', SCHEDULE_OPTIONS[:1] + SCHEDULE_OPTIONS[2:4],
+                 "Shut the SQL VMs down outside business hours if nothing uses them then.", effort='Medium',
+                 name_pattern=SQL_VM_PATTERN),
+    SavingsLever('sql_reservation', 'reservation', 'virtualMachines',
+                 (('pay-as-you-go', 0.0), ('1-year', 0.4), ('3-year', 0.6)),
+                 "Consider Reserved Instances for SQL VMs if running 24/7.", effort='Medium',
+                 name_pattern=SQL_VM_PATTERN),
+    SavingsLever('sql_hybrid_benefit', 'hybrid_benefit', 'virtualMachines', (('no', 0.0), ('yes', 1.0)),
+                 "Consider Azure Hybrid Benefit for the SQL VMs if you have existing Windows Server licenses.",
+                 effort='Medium', name_pattern=SQL_VM_PATTERN, license_share=0.4),
+    SavingsLever('windows_hybrid_benefit', 'hybrid_benefit', 'virtualMachines', (('no', 0.0), ('yes', 1.0)),
+                 "Consider Azure Hybrid Benefit for Windows VMs if you have existing licenses.",
+                 effort='Medium', name_pattern=AD_VM_PATTERN, license_share=0.4),
+]
+
+
+class SavingsSimulator:
+    """
+    Evaluates every combination of lever options against a cost table at once.
+
+    Resources are collapsed into groups by the set of levers that apply to them, so a
+    scenario is a row of option choices and its cost a dot product over a handful of
+    group costs. The cost of a group under a scenario is
+
+        cost * sku * ((1 - license) * (1 - discount if reserved else hours) + license * hours * (1 - hybrid))
+
+    since reserved compute is paid whether or not the VMs run. Costs are scaled to a
+    month from the days the table covers.
+    """
+
+    def __init__(self, levers: Optional[List[SavingsLever]] = None, chunk_size: int = 65536):
+        self.levers = list(levers if levers is not None else DEFAULT_SAVINGS_LEVERS)
+        if len(self.levers) > 63:
+            raise ValueError(f"At most 63 savings levers are supported, got {len(self.levers)}")
+        self.chunk_size = chunk_size
+        # The report, workbook and recommendations all simulate the same table
+        self._last: Optional[Tuple[str, ColumnSet]] = None
+
+    @classmethod
+    def from_file(cls, path: str) -> 'SavingsSimulator':
+        """
+        Load levers from JSON: {"levers": [{"name", "kind", "resource_type", "options": [[label, value], ...]
+        or "schedule", "recommendation", "effort", "name_pattern", "license_share"}]}. Levers replace
+        the defaults of the same name, keeping the fields they leave out, and are added otherwise.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        levers = {lever.name: lever for lever in DEFAULT_SAVINGS_LEVERS}
+        for lever_config in config.get('levers', []):
+            lever = SavingsLever.from_dict(lever_config, levers.get(lever_config.get('name')))
+            levers[lever.name] = lever
+        return cls(list(levers.values()))
+
+    @property
+    def fingerprint(self) -> str:
+        payload = json.dumps([(lever.name, lever.kind, lever.resource_type, lever.name_pattern, lever.options,
+                               lever.license_share) for lever in self.levers])
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def monthly_scale(table: CostTable) -> float:
+        return HOURS_PER_MONTH / 24 / table.days_covered if table.days_covered else 1.0
+
+    def _groups(self, table: CostTable) -> Tuple[np.ndarray, np.ndarray]:
+        """Lever membership of each resource group and the group's monthly cost."""
+        by_resource = table.by_resource
+        membership = np.zeros((len(by_resource), len(self.levers)), dtype=bool)
+        for index, lever in enumerate(self.levers):
+            membership[:, index] = lever.matches(table)
+        # Pack each membership row into one integer key so grouping is a plain integer unique.
+        bits = np.left_shift(np.int64(1), np.arange(len(self.levers), dtype=np.int64))
+        keys, inverse = np.unique(membership @ bits, return_inverse=True)
+        groups = (keys[:, None] & bits) != 0
+        costs = np.bincount(inverse.reshape(-1), weights=by_resource['cost'], minlength=len(groups))
+        return groups, costs * self.monthly_scale(table)
+
+    def _evaluate(self, choices: np.ndarray, groups: np.ndarray, costs: np.ndarray) -> np.ndarray:
+        """Monthly cost of each scenario (row of option indexes) over the groups."""
+        values = np.stack([np.array([value for _, value in lever.options])[choices[:, index]]
+                           for index, lever in enumerate(self.levers)], axis=1)
+        shape = (len(choices), len(groups))
+        sku, hours = np.ones(shape), np.ones(shape)
+        discount, hybrid = np.zeros(shape), np.zeros(shape)
+        license_share = np.zeros(len(groups))
+        for index, lever in enumerate(self.levers):
+            member = groups[:, index]
+            if not member.any():
+                continue
+            lever_values = values[:, index:index + 1]
+            if lever.kind == 'sku':
+                sku = np.where(member, sku * lever_values, sku)
+            elif lever.kind == 'schedule':
+                hours = np.where(member, hours * lever_values, hours)
+            elif lever.kind == 'reservation':
+                discount = np.where(member, np.maximum(discount, lever_values), discount)
+            else:
+                hybrid = np.where(member, np.maximum(hybrid, lever_values), hybrid)
+                license_share = np.where(member, np.maximum(license_share, lever.license_share), license_share)
+        compute = np.where(discount > 0, 1 - discount, hours)
+        factors = sku * ((1 - license_share) * compute + license_share * hours * (1 - hybrid))
+        return factors @ costs
+
+    def simulate(self, table: CostTable) -> ColumnSet:
+        """
+        Every scenario over the levers that apply to the table, ranked by monthly savings
+        (fewest changes first among equal savings). Levers matching no resources are held
+        at their status quo, so they do not multiply the scenario count.
+        """
+        if self._last is not None and self._last[0] == table.fingerprint:
+            return self._last[1]
+        groups, costs = self._groups(table)
+        active = groups.any(axis=0)
+        counts = [len(lever.options) if active[index] else 1 for index, lever in enumerate(self.levers)]
+        total = int(np.prod(counts))
+        if total > MAX_SCENARIOS:
+            raise ValueError(f"{total:,} scenarios exceed the limit of {MAX_SCENARIOS:,}; use fewer lever options")
+        choices = np.indices(counts).reshape(len(counts), -1).T if counts else np.zeros((1, 0), dtype=np.int64)
+        baseline = float(costs.sum())
+        monthly = np.concatenate([self._evaluate(choices[start:start + self.chunk_size], groups, costs)
+                                  for start in range(0, len(choices), self.chunk_size)])
+        savings = baseline - monthly
+        changes = (choices > 0).sum(axis=1)
+        order = np.lexsort((changes, -np.round(savings, 6)))
+        scenarios = ColumnSet({
+            'choices': choices[order],
+            'changes': changes[order],
+            'monthly_cost': monthly[order],
+            'savings': savings[order],
+            'savings_pct': savings[order] / baseline * 100 if baseline else np.zeros(len(order)),
+        })
+        self._last = (table.fingerprint, scenarios)
+        return scenarios
+
+    def describe(self, choices: np.ndarray) -> str:
+        """Human-readable changes of one scenario."""
+        changes = [f"{lever.name}={lever.options[choice][0]}"
+                   for lever, choice in zip(self.levers, choices.tolist()) if choice]
+        return ", ".join(changes) or "no changes"
+
+    def labeled(self, scenarios: ColumnSet, limit: Optional[int] = None) -> ColumnSet:
+        """The first `limit` scenarios with a 'scenario' description column instead of option indexes."""
+        scenarios = scenarios[:limit] if limit is not None else scenarios
+        columns = {'scenario': np.array([self.describe(choices) for choices in scenarios['choices']], dtype=object)}
+        columns.update((name, values) for name, values in scenarios.columns.items() if name != 'choices')
+        return ColumnSet(columns)
+
+    def best_by_changes(self, scenarios: ColumnSet) -> ColumnSet:
+        """
+        The highest-saving scenario for each number of changes, keeping only those that save
+        more than every scenario with fewer changes (scenarios are already ranked).
+        """
+        _, first = np.unique(scenarios['changes'], return_index=True)
+        best = scenarios[first]
+        best = best[best['changes'] > 0]
+        previous = np.maximum.accumulate(np.concatenate(([0.0], best['savings'][:-1])))
+        return best[best['savings'] > previous]
+
+    def lever_savings(self, scenarios: ColumnSet) -> ColumnSet:
+        """Best option of each applicable lever changed on its own, highest savings first."""
+        single = scenarios[scenarios['changes'] == 1]
+        levers, options, savings = [], [], []
+        for index, lever in enumerate(self.levers):
+            changed = single[single['choices'][:, index] > 0]
+            if len(changed) and changed['savings'][0] > 0:
+                levers.append(index)
+                options.append(lever.options[int(changed['choices'][0, index])][0])
+                savings.append(float(changed['savings'][0]))
+        order = np.argsort(-np.array(savings), kind='stable')
+        return ColumnSet({
+            'lever': np.array(levers, dtype=np.int64)[order],
+            'option': np.array(options, dtype=object)[order],
+            'savings': np.array(savings)[order],
+        })
+
+
+# Ordered tier rules for resource names and Terraform addresses (first match wins). The
+# shared rule comes first so that e.g. the Traffic Manager endpoint "tm_web" is not web.
+DEFAULT_TIER_RULES = [
+    (r'bastion|traffic_?manager|(^|[-_.])tm($|[-_.])|(^|[-_.])ad($|[-_.\d\[])', 'shared'),
+    (r'appgw|app_?gateway|(^|[-_.])web($|[-_.\d\[])', 'web'),
+    (r'(^|[-_.])biz($|[-_.\d\[])', 'business'),
+    (r'(^|[-_.])db($|[-_.\d\[])|sql', 'data'),
+]
+UNALLOCATED_TIER = 'unallocated'
+UNTAGGED = '(untagged)'
+DEFAULT_ALLOCATION_TAGS = ('environment', 'owner')
+
+
+@dataclass(frozen=True)
+class SharedCostRule:
+    """Spreads the cost of resources matching `pattern` over `tiers`, evenly or in proportion to their direct costs."""
+    pattern: str
+    tiers: Tuple[str, ...]
+    basis: str = 'cost'
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> 'SharedCostRule':
+        if config.get('basis', 'cost') not in ('cost', 'even'):
+            raise ValueError(f"Shared cost basis must be 'cost' or 'even', got {config['basis']!r}")
+        return cls(config['pattern'], tuple(config['tiers']), config.get('basis', 'cost'))
+
+
+# Bastion and Traffic Manager serve every tier; AD stays a shared cost of its own
+DEFAULT_SHARED_COST_RULES = [
+    SharedCostRule(r'bastion|traffic_?manager|(^|[-_.])tm($|[-_.])', ('web', 'business', 'data')),
+]
+
+
+class CostAllocation:
+    """
+    Costs of one table allocated to tiers and tags.
+
+    Every resource (row of table.by_resource) has a tier code and a value code per tag
+    key, with an inverted index from each code to its resources. Cells of resources
+    under a shared-cost rule are replaced by weighted cells on the rule's tiers, in
+    integer nano-dollars with the remainder on the last tier, so totals are unchanged.
+    """
+
+    def __init__(self, table: CostTable, tiers: List[str], resource_tiers: np.ndarray,
+                 tags: Dict[str, Tuple[List[str], np.ndarray]], cell_resources: np.ndarray,
+                 cells: np.ndarray, cell_tiers: np.ndarray, cell_nanos: np.ndarray, shared: np.ndarray):
+        self.table = table
+        self.tiers = tiers
+        self.resource_tiers = resource_tiers
+        self.tags = tags
+        self.cell_resources = cell_resources
+        self.cells = cells
+        self.cell_tiers = cell_tiers
+        self.cell_nanos = cell_nanos
+        self.shared = shared
+        self._inverted: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    @property
+    def dimensions(self) -> List[str]:
+        return ['tier', 'resource_type'] + [f'tag:{key}' for key in self.tags]
+
+    def _resource_codes(self, dimension: str) -> Tuple[List[str], np.ndarray]:
+        """Labels of a dimension and the code of each resource."""
+        if dimension == 'tier':
+            return self.tiers, self.resource_tiers
+        if dimension == 'resource_type':
+            return self.table.categories['resource_type'], self.table.by_resource['type_code']
+        if dimension.startswith('tag:') and dimension[4:] in self.tags:
+            return self.tags[dimension[4:]]
+        raise ValueError(f"Unknown allocation dimension {dimension!r}; expected one of {', '.join(self.dimensions)}")
+
+    def resources(self, dimension: str, value: str) -> ColumnSet:
+        """The resources (rows of table.by_resource) with a tier, type or tag value, from the inverted index."""
+        labels, codes = self._resource_codes(dimension)
+        if dimension not in self._inverted:
+            order = np.argsort(codes, kind='stable')
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(labels)))))
+            self._inverted[dimension] = order, offsets
+        order, offsets = self._inverted[dimension]
+        code = labels.index(value) if value in labels else None
+        rows = order[offsets[code]:offsets[code + 1]] if code is not None else order[:0]
+        return self.table.by_resource[rows]
+
+    def pivot(self, dimensions: List[str]) -> ColumnSet:
+        """Allocated cost per combination of the dimensions' values, largest first."""
+        key = np.zeros(len(self.cells), dtype=np.int64)
+        labels = []
+        for dimension in dimensions:
+            values, codes = self._resource_codes(dimension)
+            if dimension == 'tier':
+                cell_codes = self.cell_tiers
+            else:
+                cell_codes = np.asarray(codes, dtype=np.int64)[self.cell_resources[self.cells]]
+            key = key * max(len(values), 1) + cell_codes
+            labels.append(values)
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        starts = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1]))) if len(key) else np.zeros(0, np.int64)
+        nanos = np.add.reduceat(self.cell_nanos[order], starts) if len(starts) else np.zeros(0, np.int64)
+        rank = np.lexsort((key[starts], -nanos))
+        keys = key[starts][rank]
+        
+        columns = {}
+        for dimension, values in reversed(list(zip(dimensions, labels))):
+            columns[dimension] = np.array(values, dtype=object)[keys % max(len(values), 1)]
+            keys = keys // max(len(values), 1)
+        result = {dimension: columns[dimension] for dimension in dimensions}
+        result.update(cost_nanos=nanos[rank], cost=nanos[rank] / NANOS_PER_DOLLAR,
+                      percentage=self.table._percentages(nanos[rank]))
+        return ColumnSet(result)
+
+    @cached_property
+    def by_tier(self) -> ColumnSet:
+        """Direct, shared-in and total cost and resource count per tier, largest first."""
+        count = len(self.tiers)
+        direct_cells = ~self.shared[self.cell_resources[self.cells]]
+        direct = np.zeros(count, dtype=np.int64)
+        total = np.zeros(count, dtype=np.int64)
+        np.add.at(direct, self.cell_tiers[direct_cells], self.cell_nanos[direct_cells])
+        np.add.at(total, self.cell_tiers, self.cell_nanos)
+        resources = np.bincount(self.resource_tiers[~self.shared], minlength=count)
+        order = np.lexsort((np.arange(count), -total))
+        order = order[(total[order] != 0) | (resources[order] > 0)]
+        return ColumnSet({
+            'tier': np.array(self.tiers, dtype=object)[order],
+            'resources': resources[order],
+            'direct': direct[order] / NANOS_PER_DOLLAR,
+            'shared': (total - direct)[order] / NANOS_PER_DOLLAR,
+            'cost': total[order] / NANOS_PER_DOLLAR,
+            'percentage': self.table._percentages(total[order]),
+        })
+
+
+class CostAllocator:
+    """Assigns resources to architecture tiers and tag values and spreads shared costs over tiers."""
+
+    def __init__(self, tier_rules: Optional[List[Tuple[str, str]]] = None,
+                 shared_rules: Optional[List[SharedCostRule]] = None, tag_keys: Optional[Iterable[str]] = None):
+        self.tier_rules = list(tier_rules if tier_rules is not None else DEFAULT_TIER_RULES)
+        self.shared_rules = list(shared_rules if shared_rules is not None else DEFAULT_SHARED_COST_RULES)
+        self.tag_keys = tuple(tag_keys if tag_keys is not None else DEFAULT_ALLOCATION_TAGS)
+        self._compiled = [(re.compile(pattern, re.IGNORECASE), tier) for pattern, tier in self.tier_rules]
+        tiers = [tier for _, tier in self.tier_rules]
+        tiers += [tier for rule in self.shared_rules for tier in rule.tiers]
+        self.tiers = list(dict.fromkeys(tiers + [UNALLOCATED_TIER]))
+        # Reports, workbooks and the service all allocate the same table
+        self._last: Optional[Tuple[str, CostAllocation]] = None
+
+    @classmethod
+    def from_file(cls, path: str, tag_keys: Optional[Iterable[str]] = None) -> 'CostAllocator':
+        """
+        Load allocation rules from JSON: {"tiers": [{"pattern", "tier"}], "shared": [{"pattern",
+        "tiers", "basis"}], "tags": [...]}. Tier rules run before the defaults; "shared" and
+        "tags" replace the defaults when given.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        tier_rules = [(rule['pattern'], rule['tier']) for rule in config.get('tiers', [])] + DEFAULT_TIER_RULES
+        shared = config.get('shared')
+        return cls(tier_rules,
+                   [SharedCostRule.from_dict(rule) for rule in shared] if shared is not None else None,
+                   tag_keys if tag_keys is not None else config.get('tags'))
+
+    @property
+    def fingerprint(self) -> str:
+        payload = json.dumps([self.tier_rules, [(rule.pattern, rule.tiers, rule.basis) for rule in self.shared_rules],
+                              self.tag_keys])
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    def tier_of(self, name: str) -> str:
+        for pattern, tier in self._compiled:
+            if pattern.search(name):
+                return tier
+        return UNALLOCATED_TIER
+
+    def allocate(self, table: CostTable, tags: Optional[Dict[str, Dict[str, str]]] = None) -> CostAllocation:
+        """Allocate a table's costs; tags maps resource names to their tags."""
+        tags = tags or {}
+        key = table.fingerprint + hashlib.sha256(json.dumps(tags, sort_keys=True).encode()).hexdigest()
+        if self._last is not None and self._last[0] == key:
+            return self._last[1]
+        
+        by_resource = table.by_resource
+        names = table.categories['resource_name']
+        name_codes = by_resource['name_code']
+        # Tiers, tags and shared rules are resolved once per distinct resource name
+        tier_codes = np.array([self.tiers.index(self.tier_of(name)) for name in names], dtype=np.int64)
+        resource_tiers = tier_codes[name_codes] if len(names) else np.zeros(0, dtype=np.int64)
+        rule_codes = np.full(len(names), -1, dtype=np.int64)
+        for index, rule in reversed(list(enumerate(self.shared_rules))):
+            pattern = re.compile(rule.pattern, re.IGNORECASE)
+            rule_codes[[bool(pattern.search(name)) for name in names]] = index
+        resource_rules = rule_codes[name_codes] if len(names) else np.zeros(0, dtype=np.int64)
+        resource_tags = {}
+        for tag_key in self.tag_keys:
+            values = CategoryIndex()
+            codes = values.encode([str((tags.get(name) or {}).get(tag_key) or UNTAGGED) for name in names])
+            resource_tags[tag_key] = (values.values, codes.astype(np.int64)[name_codes] if len(names) else codes)
+        
+        # Cell -> by_resource row, by the same (type, name) pair key by_resource groups on
+        width = max(len(names), 1)
+        pair_keys = by_resource['type_code'].astype(np.int64) * width + name_codes
+        order = np.argsort(pair_keys)
+        cell_keys = table.columns['resource_type'].astype(np.int64) * width + table.columns['resource_name']
+        cell_resources = order[np.searchsorted(pair_keys[order], cell_keys)] if len(table) else np.zeros(0, np.int64)
+        
+        cell_rules = resource_rules[cell_resources]
+        direct = np.flatnonzero(cell_rules < 0)
+        cells = [direct]
+        cell_tiers = [resource_tiers[cell_resources[direct]]]
+        cell_nanos = [table.columns['cost_nanos'][direct]]
+        direct_totals = np.bincount(cell_tiers[0], weights=cell_nanos[0], minlength=len(self.tiers))
+        for index, rule in enumerate(self.shared_rules):
+            split = np.flatnonzero(cell_rules == index)
+            if not len(split):
+                continue
+            targets = np.array([self.tiers.index(tier) for tier in rule.tiers], dtype=np.int64)
+            weights = direct_totals[targets] if rule.basis == 'cost' else np.zeros(len(targets))
+            weights = weights / weights.sum() if weights.sum() > 0 else np.full(len(targets), 1 / len(targets))
+            nanos = table.columns['cost_nanos'][split]
+            shares = np.floor(np.outer(nanos, weights)).astype(np.int64)
+            shares[:, -1] = nanos - shares[:, :-1].sum(axis=1)
+            cells.append(np.repeat(split, len(targets)))
+            cell_tiers.append(np.tile(targets, len(split)))
+            cell_nanos.append(shares.reshape(-1))
+        
+        allocation = CostAllocation(table, self.tiers, resource_tiers, resource_tags, cell_resources,
+                                    np.concatenate(cells), np.concatenate(cell_tiers), np.concatenate(cell_nanos),
+                                    resource_rules >= 0)
+        self._last = (key, allocation)
+        return allocation
+
+
+def _infracost_cost(component: Dict) -> float:
+    """Monthly cost of an Infracost cost component, derived from hourlyCost when needed."""
+    monthly = component.get('monthlyCost')
+    if monthly is not None:
+        return float(monthly)
+    hourly = component.get('hourlyCost')
+    return float(hourly) * HOURS_PER_MONTH if hourly is not None else 0.0
+
+
+def iter_infracost_resources(path: str, section: str = 'breakdown'):
+    """
+    Stream (project path, resource) pairs from an Infracost JSON file.
+
+    With ijson installed, each resource is built from parser events as it is read,
+    so large multi-project files are never loaded whole; otherwise the file is
+    parsed with the json module.
+    """
+    resource_prefix = f'projects.item.{section}.resources.item'
+    try:
+        ijson = _lazy_import('ijson')
+    except ImportError:
+        with open(path) as f:
+            for project in json.load(f).get('projects') or []:
+                project_path = (project.get('metadata') or {}).get('path', '.')
+                for item in (project.get(section) or {}).get('resources') or []:
+                    yield project_path, item
+        return
+    
+    project_path = '.'
+    builder = None
+    with open(path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=False):
+            if builder is not None:
+                if prefix == resource_prefix and event == 'end_map':
+                    yield project_path, builder.value
+                    builder = None
+                else:
+                    builder.event(event, value)
+            elif prefix == resource_prefix and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == 'projects.item.metadata.path' and event == 'string':
+                project_path = value
+            elif prefix == 'projects.item' and event == 'start_map':
+                project_path = '.'
+
+
+def _infracost_address(project_path: str, item: Dict) -> str:
+    """Resource address, prefixed with its project path outside the root project."""
+    address = item.get('name', 'Unknown')
+    return f"{project_path}/{address}" if project_path not in ('', '.') else address
+
+
+def _infracost_resource_rows(project_path: str, item: Dict, classifier: ResourceClassifier):
+    """Yield (resource_type, resource_name, meter, monthly cost) for a resource and its sub-resources."""
+    address = _infracost_address(project_path, item)
+    resource_type = classifier.classify(item.get('resourceType') or address)
+    for component in item.get('costComponents') or []:
+        yield resource_type, address, component.get('name', 'Unknown'), _infracost_cost(component)
+    for subresource in item.get('subresources') or []:
+        sub_name = subresource.get('name', 'Unknown')
+        sub_type = INFRACOST_SUBRESOURCE_TYPES.get(sub_name, resource_type)
+        for row in _infracost_resource_rows('.', {**subresource, 'name': f"{address}.{sub_name}"}, classifier):
+            yield (sub_type,) + row[1:]
+
+
+def load_infracost_breakdown(path: str, section: str = 'breakdown', batch_size: int = DEFAULT_BATCH_SIZE,
+                             classifier: Optional[ResourceClassifier] = None) -> Dict:
+    """Load an Infracost breakdown into cost data, one cell per cost component."""
+    aggregator = StreamingCostAggregator(classifier)
+    columns = ([], [], [], [])
+    tags = {}
+    
+    def flush():
+        types, names, meters, costs = columns
+        aggregator.add_batch(aggregator.make_batch_from_columns(types, names, meters, [0] * len(costs), costs))
+        for column in columns:
+            column.clear()
+    
+    for project_path, item in iter_infracost_resources(path, section):
+        for row in _infracost_resource_rows(project_path, item, aggregator.classifier):
+            for column, value in zip(columns, row):
+                column.append(value)
+            # Sub-resources such as OS disks carry their parent's tags
+            if item.get('tags'):
+                tags[row[1]] = item['tags']
+        if len(columns[3]) >= batch_size:
+            flush()
+    flush()
+    label = "Infracost Estimate (Monthly)" if section == 'breakdown' else "Infracost Past Estimate (Monthly)"
+    cost_data = aggregator.to_cost_data(label)
+    cost_data['tags'] = tags
+    return cost_data
+
+
+def _infracost_checksum(item: Dict) -> str:
+    """The resource's block checksum, or a hash of its pricing when the breakdown has none."""
+    checksum = (item.get('metadata') or {}).get('checksum')
+    if checksum:
+        return checksum
+    pricing = {key: item.get(key) for key in ('resourceType', 'costComponents', 'subresources')}
+    return hashlib.sha256(json.dumps(pricing, sort_keys=True).encode()).hexdigest()
+
+
+class InfracostIndex:
+    """
+    SQLite index of a baseline Infracost breakdown, keyed by resource address.
+
+    Each resource keeps its block checksum, its location (filename and line span) and
+    its monthly cost including sub-resources. A change is priced by looking up only the
+    resources it touches: resources whose checksum still matches are skipped without
+    being priced, so a check costs time in proportion to the change. The index is
+    rebuilt whenever the baseline file changes.
+    """
+
+    FILENAME = "infracost_index.sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS resources (
+                    address TEXT PRIMARY KEY,
+                    project TEXT NOT NULL,
+                    resource_type TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    start_line INTEGER NOT NULL,
+                    end_line INTEGER NOT NULL,
+                    cost_nanos INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS resources_by_project ON resources (project);
+                CREATE INDEX IF NOT EXISTS resources_by_location ON resources (filename, start_line);
+                CREATE TABLE IF NOT EXISTS source (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+    @classmethod
+    def in_directory(cls, output_dir: str) -> 'InfracostIndex':
+        return cls(os.path.join(output_dir, cls.FILENAME))
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def resource_record(project_path: str, item: Dict, classifier: ResourceClassifier) -> Tuple:
+        """(address, project, resource_type, checksum, filename, start_line, end_line, cost_nanos) of a resource."""
+        metadata = item.get('metadata') or {}
+        address = _infracost_address(project_path, item)
+        cost_nanos = sum(int(round(row[3] * NANOS_PER_DOLLAR))
+                         for row in _infracost_resource_rows(project_path, item, classifier))
+        return (address, project_path or '.', classifier.classify(item.get('resourceType') or address),
+                _infracost_checksum(item), metadata.get('filename') or '',
+                int(metadata.get('startLine') or 0), int(metadata.get('endLine') or 0), cost_nanos)
+
+    def sync(self, breakdown_path: str, classifier: ResourceClassifier,
+             batch_size: int = DEFAULT_BATCH_SIZE) -> bool:
+        """Index the baseline breakdown unless it is unchanged since the last sync; True if rebuilt."""
+        stat = os.stat(breakdown_path)
+        signature = f"{os.path.abspath(breakdown_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        row = self._conn.execute("SELECT value FROM source WHERE key = 'signature'").fetchone()
+        if row and row[0] == signature:
+            return False
+        
+        insert = "INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        with self._conn:
+            self._conn.execute("DELETE FROM resources")
+            batch = []
+            for project_path, item in iter_infracost_resources(breakdown_path):
+                batch.append(self.resource_record(project_path, item, classifier))
+                if len(batch) >= batch_size:
+                    self._conn.executemany(insert, batch)
+                    batch.clear()
+            self._conn.executemany(insert, batch)
+            total = self._conn.execute("SELECT COALESCE(SUM(cost_nanos), 0) FROM resources").fetchone()[0]
+            self._conn.executemany("INSERT OR REPLACE INTO source VALUES (?, ?)",
+                                   [('signature', signature), ('total_nanos', str(total))])
+        return True
+
+    @property
+    def total_nanos(self) -> int:
+        row = self._conn.execute("SELECT value FROM source WHERE key = 'total_nanos'").fetchone()
+        return int(row[0]) if row else 0
+
+    def delta(self, head_path: str, classifier: ResourceClassifier) -> Tuple[ColumnSet, Dict]:
+        """
+        Per-resource monthly cost changes of a head breakdown against the index, plus totals.
+
+        The head breakdown may cover only the projects a change touched: resources of
+        other projects keep their baseline cost, and a baseline resource counts as
+        removed only if its project is in the head breakdown.
+        """
+        lookup = "SELECT checksum, cost_nanos FROM resources WHERE address = ?"
+        changes = []
+        seen, projects = set(), set()
+        evaluated = 0
+        for project_path, item in iter_infracost_resources(head_path):
+            evaluated += 1
+            address = _infracost_address(project_path, item)
+            seen.add(address)
+            projects.add(project_path or '.')
+            baseline = self._conn.execute(lookup, (address,)).fetchone()
+            if baseline is not None and baseline[0] == _infracost_checksum(item):
+                continue
+            record = self.resource_record(project_path, item, classifier)
+            changes.append((address, 'changed' if baseline else 'added', record[2], record[4], record[5],
+                            baseline[1] if baseline else 0, record[7]))
+        
+        for project in sorted(projects):
+            for address, resource_type, filename, start_line, cost_nanos in self._conn.execute(
+                    "SELECT address, resource_type, filename, start_line, cost_nanos FROM resources "
+                    "WHERE project = ?", (project,)):
+                if address not in seen:
+                    changes.append((address, 'removed', resource_type, filename, start_line, cost_nanos, 0))
+        
+        addresses, kinds, types, filenames, lines, before, after = zip(*changes) if changes else [()] * 7
+        before = np.array(before, dtype=np.int64)
+        after = np.array(after, dtype=np.int64)
+        delta = after - before
+        order = np.lexsort((np.array(addresses, dtype=object), -np.abs(delta)))
+        result = ColumnSet({
+            'address': np.array(addresses, dtype=object)[order],
+            'change': np.array(kinds, dtype=object)[order],
+            'resource_type': np.array(types, dtype=object)[order],
+            'location': np.array([f"{filename}:{line}" if filename else '' for filename, line in zip(filenames, lines)],
+                                 dtype=object)[order],
+            'baseline': before[order] / NANOS_PER_DOLLAR,
+            'head': after[order] / NANOS_PER_DOLLAR,
+            'delta': delta[order] / NANOS_PER_DOLLAR,
+        })
+        baseline_nanos = self.total_nanos
+        delta_nanos = int(delta.sum())
+        totals = {
+            'baseline': baseline_nanos / NANOS_PER_DOLLAR,
+            'head': (baseline_nanos + delta_nanos) / NANOS_PER_DOLLAR,
+            'delta': delta_nanos / NANOS_PER_DOLLAR,
+            'delta_pct': delta_nanos / baseline_nanos * 100 if baseline_nanos else None,
+            'evaluated': evaluated,
+            'repriced': sum(kind != 'removed' for kind in kinds),
+            'projects': sorted(projects),
+        }
+        return result, totals
+
+
+# Retail Prices API units of measure -> billed units per month
+PRICE_UNITS_PER_MONTH = {
+    '1 hour': HOURS_PER_MONTH,
+    '1/hour': HOURS_PER_MONTH,
+    '1/day': HOURS_PER_MONTH / 24,
+    '1/month': 1.0,
+    '1 gb/month': 1.0,
+}
+
+
+class PriceCatalog:
+    """
+    Offline price catalog built from an Azure Retail Prices API export.
+
+    Consumption prices are normalized to monthly unit prices and stored as two NumPy
+    arrays: an open-addressing hash table of 64-bit keys over (service, SKU, region,
+    meter) and the prices in the same slots. With a cache directory the arrays are built
+    once per price sheet and memory-mapped afterwards, so opening the catalog reads
+    nothing and a lookup touches one or two slots; batches of keys are probed together.
+    """
+
+    CACHE_DIR = ".price_catalog"
+    MANIFEST = "catalog.json"
+
+    def __init__(self, source: str, cache_dir: Optional[str] = None):
+        self.source = source
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def key(service: str, sku: str, region: str, meter: str) -> int:
+        """64-bit key of a (service, SKU, region, meter) tuple; case and spacing of region are ignored."""
+        region = region.replace(' ', '')
+        text = '|'.join(part.strip().lower() for part in (service, sku, region, meter))
+        return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little') or 1
+
+    @staticmethod
+    def item_key(item: Dict) -> int:
+        """Key of a price sheet item. The Retail Prices API only tells Windows VM prices apart by product name."""
+        sku = item.get('armSkuName') or item.get('skuName') or ''
+        if (item.get('productName') or '').endswith(' Windows'):
+            sku += ' Windows'
+        return PriceCatalog.key(item.get('serviceName') or '', sku, item.get('armRegionName') or '',
+                                item.get('meterName') or '')
+
+    @staticmethod
+    def iter_items(path: str) -> Iterator[Dict]:
+        """Price items of an export: one API page ({"Items": [...]}), a list of pages, or a list of items."""
+        with open(path) as f:
+            data = json.load(f)
+        for entry in data if isinstance(data, list) else [data]:
+            if 'Items' in entry:
+                yield from entry['Items']
+            else:
+                yield entry
+
+    @classmethod
+    def build(cls, path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Hash table slots and monthly unit prices of the pay-as-you-go, first-tier prices in a sheet."""
+        entries: Dict[int, float] = {}
+        for item in cls.iter_items(path):
+            sku_name = (item.get('skuName') or '').lower()
+            if item.get('type', 'Consumption') != 'Consumption' or float(item.get('tierMinimumUnits') or 0) > 0:
+                continue
+            if 'spot' in sku_name or 'low priority' in sku_name:
+                continue
+            units = PRICE_UNITS_PER_MONTH.get((item.get('unitOfMeasure') or '').lower())
+            if units is None:
+                continue
+            entries[cls.item_key(item)] = float(item.get('retailPrice', item.get('unitPrice', 0.0))) * units
+        
+        # At most half the slots are used, so probe sequences stay short
+        size = 1 << max(4, (2 * len(entries)).bit_length())
+        mask = size - 1
+        slots = np.zeros(size, dtype=np.uint64)
+        prices = np.full(size, np.nan)
+        for key, price in entries.items():
+            position = key & mask
+            while slots[position]:
+                position = (position + 1) & mask
+            slots[position] = key
+            prices[position] = price
+        return slots, prices
+
+    def _signature(self) -> str:
+        """Path, size and modification time of the price sheet, or of a catalog directory's manifest."""
+        path = os.path.join(self.source, self.MANIFEST) if os.path.isdir(self.source) else self.source
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    @property
+    def fingerprint(self) -> str:
+        signature = self._signature() if os.path.exists(self.source) else f"missing:{self.source}"
+        return hashlib.sha256(signature.encode()).hexdigest()[:16]
+
+    def _refresh_cache(self):
+        """Rebuild the cached arrays unless they were built from the current price sheet."""
+        signature = self._signature()
+        manifest_path = os.path.join(self.cache_dir, self.MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                if json.load(f).get('source') == signature:
+                    return
+        with TRACER.span('catalog.build'):
+            slots, prices = self.build(self.source)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name, array in (('slots', slots), ('prices', prices)):
+            temporary = os.path.join(self.cache_dir, f'{name}.tmp.npy')
+            np.save(temporary, array)
+            os.replace(temporary, os.path.join(self.cache_dir, f'{name}.npy'))
+        with open(manifest_path, 'w') as f:
+            json.dump({'source': signature, 'prices': int(np.count_nonzero(slots))}, f)
+
+    @cached_property
+    def _table(self) -> Tuple[np.ndarray, np.ndarray]:
+        if os.path.isdir(self.source):
+            directory = self.source
+        elif self.cache_dir is None:
+            return self.build(self.source)
+        else:
+            directory = self.cache_dir
+            self._refresh_cache()
+        return (np.load(os.path.join(directory, 'slots.npy'), mmap_mode='r'),
+                np.load(os.path.join(directory, 'prices.npy'), mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._table[0]))
+
+    def lookup(self, keys) -> np.ndarray:
+        """Monthly unit price of each key, NaN where the catalog has no price."""
+        slots, prices = self._table
+        keys = np.asarray(keys, dtype=np.uint64)
+        mask = len(slots) - 1
+        result = np.full(len(keys), np.nan)
+        positions = (keys & np.uint64(mask)).astype(np.int64)
+        pending = np.arange(len(keys))
+        while len(pending):
+            found = slots[positions[pending]]
+            hits = found == keys[pending]
+            result[pending[hits]] = prices[positions[pending[hits]]]
+            pending = pending[~hits & (found != 0)]
+            positions[pending] = (positions[pending] + 1) & mask
+        return result
+
+    def price(self, service: str, sku: str, region: str, meter: str) -> Optional[float]:
+        price = self.lookup([self.key(service, sku, region, meter)])[0]
+        return None if np.isnan(price) else float(price)
+
+
+_TF_VARIABLE = re.compile(r'^variable\s+"([^"]+)"\s*\{(.*?)^\}', re.MULTILINE | re.DOTALL)
+_TF_ASSIGNMENT = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_-]*)\s*=\s*("(?:[^"\\]|\\.)*"|[^\s#/]+)', re.MULTILINE)
+
+
+def _tf_scalar(text: str):
+    if text.startswith('"'):
+        return text[1:-1]
+    if text in ('true', 'false'):
+        return text == 'true'
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+
+def load_terraform_variables(directory: str) -> Dict:
+    """
+    Scalar Terraform variables of a stack: defaults from *.tf, then terraform.tfvars and
+    *.auto.tfvars assignments. Only literal strings, numbers and booleans are read.
+    """
+    variables = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.tf'))):
+        with open(path) as f:
+            for name, body in _TF_VARIABLE.findall(f.read()):
+                for key, value in _TF_ASSIGNMENT.findall(body):
+                    if key == 'default':
+                        variables[name] = _tf_scalar(value)
+    tfvars = [os.path.join(directory, 'terraform.tfvars')] + sorted(glob.glob(os.path.join(directory, '*.auto.tfvars')))
+    for path in tfvars:
+        if os.path.exists(path):
+            with open(path) as f:
+                variables.update((key, _tf_scalar(value)) for key, value in _TF_ASSIGNMENT.findall(f.read()))
+    return variables
+
+
+def _vm_meter(size: str) -> str:
+    """Retail Prices API meter name of a VM size, e.g. Standard_D4s_v5 -> 'D4s v5'."""
+    return re.sub(r'^(Standard|Basic)_', '', size).replace('_', ' ')
+
+
+class _StackVariables(dict):
+    """Terraform variables that also answer vm_meter_x with the meter of vm_size_x."""
+
+    def __missing__(self, name: str):
+        size = f"vm_size_{name[len('vm_meter_'):]}"
+        if name.startswith('vm_meter_') and size in self:
+            return _vm_meter(str(self[size]))
+        raise KeyError(name)
+
+
+@dataclass(frozen=True)
+class PricedComponent:
+    """
+    One catalog meter of a deployed resource. Text fields are format strings over the
+    Terraform variables ({index} numbers counted resources, {vm_meter_x} is the meter
+    of var.vm_size_x); count and quantity name a variable or hold a number.
+    """
+    resource: str
+    service: str
+    sku: str
+    meter: str
+    count: str = '1'
+    quantity: str = '1'
+
+    @cached_property
+    def variables(self) -> Tuple[str, ...]:
+        """Names of the Terraform variables the component's lines depend on."""
+        names = {'location'}
+        for text in (self.resource, self.sku, self.meter):
+            names.update(re.findall(r'\{(\w+)', text))
+        names.update(value for value in (self.count, self.quantity) if not re.fullmatch(r'\d+(\.\d*)?', value))
+        names.discard('index')
+        return tuple(sorted({name.replace('vm_meter_', 'vm_size_', 1) for name in names}))
+
+    def expand(self, variables: Dict) -> List[Tuple[str, str, int, float]]:
+        """(resource name, meter, catalog key, monthly quantity) of each instance."""
+        variables = _StackVariables(variables)
+        try:
+            sku, meter = self.sku.format_map(variables), self.meter.format_map(variables)
+            key = PriceCatalog.key(self.service, sku, str(variables['location']), meter)
+            count = float(variables.get(self.count, self.count))
+            quantity = float(variables.get(self.quantity, self.quantity))
+            return [(self.resource.format_map(_StackVariables(variables, index=index)), meter, key, quantity)
+                    for index in range(int(count))]
+        except KeyError as e:
+            raise ValueError(f"Cannot price {self.resource}: Terraform variable {e} is not set") from None
+        except ValueError as e:
+            raise ValueError(f"Cannot price {self.resource}: {e}") from None
+
+
+# Priced meters of the resources in main.tf and loadbalancers.tf. OS disks are priced at
+# Infracost's 30 GB default since the stack sets no disk size; the SQL Server license of the
+# marketplace image and usage-based meters (data processed, DNS queries) are not included.
+DEPLOYMENT_PRICING = [
+    PricedComponent('{name_prefix}-appgw', 'Application Gateway', 'Standard', 'Standard Fixed Cost'),
+    PricedComponent('{name_prefix}-appgw', 'Application Gateway', 'Standard', 'Standard Capacity Units',
+                    quantity='app_gateway_capacity'),
+    PricedComponent('{name_prefix}-appgw-pip', 'Virtual Network', 'Standard', 'Standard IPv4 Static Public IP'),
+    PricedComponent('{name_prefix}-bastion', 'Azure Bastion', 'Basic', 'Basic Gateway'),
+    PricedComponent('{name_prefix}-bastion-pip', 'Virtual Network', 'Standard', 'Standard IPv4 Static Public IP'),
+    PricedComponent('{name_prefix}-ad', 'Virtual Machines', '{vm_size_ad} Windows', '{vm_meter_ad}'),
+    PricedComponent('{name_prefix}-ad_OsDisk', 'Storage', 'S4 LRS', 'S4 LRS Disk'),
+    PricedComponent('az3t-sql-{index}', 'Virtual Machines', '{vm_size_sql} Windows', '{vm_meter_sql}',
+                    count='sql_vm_count'),
+    PricedComponent('az3t-sql-{index}_OsDisk', 'Storage', 'P4 LRS', 'P4 LRS Disk', count='sql_vm_count'),
+    PricedComponent('{name_prefix}-biz-lb', 'Load Balancer', 'Standard',
+                    'Standard Included LB Rules and Outbound Rules'),
+    PricedComponent('{name_prefix}-db-lb', 'Load Balancer', 'Standard',
+                    'Standard Included LB Rules and Outbound Rules'),
+    PricedComponent('{name_prefix}-tm', 'Traffic Manager', 'Azure Endpoint', 'Azure Endpoint'),
+]
+
+
+def expand_variants(spec, base: Dict) -> List[Dict]:
+    """
+    Variable sets to price: spec is a list of overrides of the base variables, or an object
+    whose list values are crossed into a grid (e.g. {"location": [...], "vm_size_sql": [...]}).
+    """
+    if isinstance(spec, dict):
+        names = list(spec)
+        choices = [value if isinstance(value, list) else [value] for value in spec.values()]
+        spec = [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+    return [{**base, **overrides} for overrides in spec]
+
+
+class DeploymentPricer:
+    """Prices the deployment's components from a PriceCatalog for one or many sets of Terraform variables."""
+
+    def __init__(self, catalog: PriceCatalog, components: Optional[List[PricedComponent]] = None):
+        self.catalog = catalog
+        self.components = components if components is not None else DEPLOYMENT_PRICING
+
+    def lines(self, variants: List[Dict]) -> ColumnSet:
+        """Priced lines of every variant; costs are NaN where the catalog has no price."""
+        variant, lines = [], []
+        # Variants mostly differ in a few variables, so each component is expanded once
+        # per distinct combination of the variables it reads
+        expanded = {}
+        for number, variables in enumerate(variants):
+            for index, component in enumerate(self.components):
+                signature = (index,) + tuple(variables.get(name) for name in component.variables)
+                rows = expanded.get(signature)
+                if rows is None:
+                    rows = expanded[signature] = component.expand(variables)
+                lines.extend(rows)
+                variant.extend([number] * len(rows))
+        resources, meters, keys, quantities = zip(*lines) if lines else [()] * 4
+        unit_prices = self.catalog.lookup(np.array(keys, dtype=np.uint64))
+        return ColumnSet({
+            'variant': np.array(variant, dtype=np.int64),
+            'resource_name': np.array(resources, dtype=object),
+            'meter': np.array(meters, dtype=object),
+            'unit_price': unit_prices,
+            'cost': unit_prices * np.array(quantities, dtype=np.float64),
+        })
+
+    def totals(self, variants: List[Dict]) -> ColumnSet:
+        """Monthly total and unpriced line count of each variant."""
+        lines = self.lines(variants)
+        missing = np.isnan(lines['cost'])
+        return ColumnSet({
+            'variant': np.arange(len(variants)),
+            'total': np.bincount(lines['variant'], weights=np.where(missing, 0.0, lines['cost']),
+                                 minlength=len(variants)),
+            'unpriced': np.bincount(lines['variant'], weights=missing, minlength=len(variants)).astype(np.int64),
+        })
+
+
+INVENTORY_KINDS = {
+    'vm': 'Microsoft.Compute/virtualMachines',
+    'vmss': 'Microsoft.Compute/virtualMachineScaleSets',
+    'load_balancer': 'Microsoft.Network/loadBalancers',
+    'application_gateway': 'Microsoft.Network/applicationGateways',
+    'public_ip': 'Microsoft.Network/publicIPAddresses',
+}
+DEFAULT_INVENTORY_MAX_AGE = 60.0
+DEFAULT_INVENTORY_CONCURRENCY = 8
+DEFAULT_CPU_DAYS = 14
+DEFAULT_IDLE_CPU = 2.0
+DEFAULT_LOW_CPU = 20.0
+DEFAULT_PEAK_CPU = 50.0
+# Halving a B2s would leave 1 GB of memory; the B1ms keeps 2 GB
+DOWNSIZE_OVERRIDES = {'Standard_B2s': 'Standard_B1ms'}
+
+
+def _enum_text(value) -> str:
+    """SDK enums and plain strings alike as text."""
+    return str(getattr(value, 'value', value) or '')
+
+
+def _power_state(instance_view) -> str:
+    """'running', 'stopped', 'deallocated', ... from a VM instance view's PowerState/* status."""
+    for status in getattr(instance_view, 'statuses', None) or []:
+        code = status.code or ''
+        if code.startswith('PowerState/'):
+            return code.split('/', 1)[1]
+    return ''
+
+
+def _inventory_record(kind: str, resource, **fields) -> Dict:
+    record = {
+        'name': resource.name,
+        'kind': kind,
+        'id': resource.id or '',
+        'location': resource.location or '',
+        'sku': _enum_text(getattr(getattr(resource, 'sku', None), 'name', None)),
+        'os_type': '',
+        'power_state': '',
+        'attached': True,
+        'capacity': 1,
+        'cpu_avg': None,
+        'cpu_max': None,
+    }
+    record.update(fields)
+    return record
+
+
+def _vm_record(vm) -> Dict:
+    os_disk = getattr(getattr(vm, 'storage_profile', None), 'os_disk', None)
+    return _inventory_record('vm', vm, sku=_enum_text(vm.hardware_profile.vm_size),
+                             os_type=_enum_text(getattr(os_disk, 'os_type', None)),
+                             power_state=_power_state(getattr(vm, 'instance_view', None)))
+
+
+def _scale_set_record(scale_set) -> Dict:
+    profile = getattr(scale_set, 'virtual_machine_profile', None)
+    os_disk = getattr(getattr(profile, 'storage_profile', None), 'os_disk', None)
+    return _inventory_record('vmss', scale_set, os_type=_enum_text(getattr(os_disk, 'os_type', None)),
+                             capacity=int(getattr(scale_set.sku, 'capacity', None) or 0))
+
+
+def _load_balancer_record(load_balancer) -> Dict:
+    pools = load_balancer.backend_address_pools or []
+    return _inventory_record('load_balancer', load_balancer, attached=any(
+        pool.backend_ip_configurations or pool.load_balancer_backend_addresses for pool in pools))
+
+
+def _application_gateway_record(gateway) -> Dict:
+    pools = gateway.backend_address_pools or []
+    autoscale = getattr(gateway, 'autoscale_configuration', None)
+    return _inventory_record('application_gateway', gateway,
+                             attached=any(pool.backend_addresses or pool.backend_ip_configurations for pool in pools),
+                             capacity=int(gateway.sku.capacity or getattr(autoscale, 'min_capacity', None) or 1))
+
+
+def _public_ip_record(address) -> Dict:
+    return _inventory_record('public_ip', address,
+                             attached=address.ip_configuration is not None or address.nat_gateway is not None)
+
+
+class InventorySnapshot:
+    """
+    Point-in-time inventory of a resource group: one record per VM, scale set, load balancer,
+    application gateway and public IP, with its SKU, power state, attachment and CPU use.
+
+    Snapshots are plain JSON, so a fetched snapshot is cached next to the reports for later
+    runs, and a recorded one can stand in for the inventory APIs entirely.
+    """
+
+    FIELDS = ('name', 'kind', 'id', 'location', 'sku', 'os_type', 'power_state', 'attached', 'capacity',
+              'cpu_avg', 'cpu_max')
+
+    def __init__(self, resources: List[Dict], captured_at: Optional[str] = None, subscription_id: str = '',
+                 resource_group: str = '', cpu_days: int = DEFAULT_CPU_DAYS):
+        unknown = {kind for kind in (resource.get('kind') for resource in resources) if kind not in INVENTORY_KINDS}
+        if unknown:
+            raise ValueError(f"Unknown inventory kinds: {', '.join(sorted(map(str, unknown)))}")
+        self.resources = resources
+        self.captured_at = captured_at or datetime.now(timezone.utc).isoformat(timespec='seconds')
         self.subscription_id = subscription_id
         self.resource_group = resource_group
-        self.credential = DefaultAzureCredential()
+        self.cpu_days = cpu_days
+
+    def __len__(self) -> int:
+        return len(self.resources)
+
+    @staticmethod
+    def cache_path(directory: str, subscription_id: str, resource_group: str) -> str:
+        return os.path.join(directory, f"inventory_{subscription_id}_{resource_group}.json")
+
+    @classmethod
+    def load(cls, path: str) -> 'InventorySnapshot':
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['resources'], data.get('captured_at'), data.get('subscription_id', ''),
+                   data.get('resource_group', ''), data.get('cpu_days', DEFAULT_CPU_DAYS))
+
+    def to_dict(self) -> Dict:
+        return {
+            'captured_at': self.captured_at,
+            'subscription_id': self.subscription_id,
+            'resource_group': self.resource_group,
+            'cpu_days': self.cpu_days,
+            'resources': self.resources,
+        }
+
+    def save(self, path: str):
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(temporary, path)
+
+    @property
+    def age_minutes(self) -> float:
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(self.captured_at)).total_seconds() / 60
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()[:16]
+
+    @cached_property
+    def columns(self) -> ColumnSet:
+        """The records as columns; missing CPU figures are NaN."""
+        def column(name: str, default=''):
+            return [resource.get(name, default) for resource in self.resources]
         
-        # Initialize Azure clients
-        self.consumption_client = ConsumptionManagementClient(
-            self.credential, subscription_id
-        )
-        self.resource_client = ResourceManagementClient(
-            self.credential, subscription_id
-        )
-        self.compute_client = ComputeManagementClient(
-            self.credential, subscription_id
-        )
-        self.network_client = NetworkManagementClient(
-            self.credential, subscription_id
-        )
+        def metric(name: str) -> np.ndarray:
+            return np.array([np.nan if value is None else value for value in column(name, None)], dtype=np.float64)
+        
+        columns = {name: np.array(column(name), dtype=object) for name in ('name', 'kind', 'id', 'location', 'sku',
+                                                                           'os_type', 'power_state')}
+        columns['attached'] = np.array(column('attached', True), dtype=bool)
+        columns['capacity'] = np.array(column('capacity', 1), dtype=np.int64)
+        columns['cpu_avg'] = metric('cpu_avg')
+        columns['cpu_max'] = metric('cpu_max')
+        return ColumnSet(columns)
+
+
+class RightsizingAdvisor:
+    """
+    Joins an inventory snapshot to a cost table and flags resources to delete, deallocate
+    or resize: unattached public IPs, stopped VMs that are still allocated (and billed),
+    idle or oversized VMs and scale sets by CPU, and load balancers or application
+    gateways with nothing behind them. Rules are masks over the snapshot's columns.
+
+    Resources match cost rows by name, case-insensitively; resources without billed cost
+    are valued at catalog list price where the catalog has one.
+    """
+
+    RULES = {
+        'unattached_ip': ("Public IP not attached to any resource", "Delete it, or attach it where it is needed"),
+        'stopped_allocated': ("Stopped but still allocated, so compute is still billed",
+                              "Deallocate it (az vm deallocate) or delete it"),
+        'idle': ("Idle: {cpu_avg:.1f}% average / {cpu_max:.1f}% peak CPU over {days} days",
+                 "Deallocate or delete it"),
+        'oversized': ("Oversized: {cpu_avg:.1f}% average / {cpu_max:.1f}% peak CPU over {days} days",
+                      "Resize from {sku} to {target}"),
+        'empty_load_balancer': ("Load balancer with no backend pool members", "Delete it, or add backends"),
+        'empty_app_gateway': ("Application gateway with no backend targets", "Delete it, or add backend targets"),
+    }
+    # Recommendation and effort per rule, for the recommendations list
+    RECOMMENDATIONS = {
+        'unattached_ip': ("Delete unattached public IPs ({names}).", "Low"),
+        'stopped_allocated': ("Deallocate stopped VMs that are still allocated and billed ({names}).", "Low"),
+        'idle': ("Deallocate or remove idle VMs and scale sets ({names}).", "Low"),
+        'oversized': ("Downsize VMs and scale sets with low CPU use ({names}).", "Medium"),
+        'empty_load_balancer': ("Remove load balancers with no backends ({names}).", "Low"),
+        'empty_app_gateway': ("Remove or repurpose application gateways with no backend targets ({names}).",
+                              "Medium"),
+    }
+
+    def __init__(self, idle_cpu: float = DEFAULT_IDLE_CPU, low_cpu: float = DEFAULT_LOW_CPU,
+                 peak_cpu: float = DEFAULT_PEAK_CPU):
+        if not 0 <= idle_cpu <= low_cpu <= peak_cpu <= 100:
+            raise ValueError("CPU thresholds must satisfy 0 <= idle <= low <= peak <= 100")
+        self.idle_cpu = idle_cpu
+        self.low_cpu = low_cpu
+        self.peak_cpu = peak_cpu
+
+    @property
+    def fingerprint(self) -> str:
+        return f"{self.idle_cpu}:{self.low_cpu}:{self.peak_cpu}"
+
+    @staticmethod
+    def downsize(size: str) -> Optional[str]:
+        """The size one step down in the same family (half the vCPUs), or None at the smallest size."""
+        if size in DOWNSIZE_OVERRIDES:
+            return DOWNSIZE_OVERRIDES[size]
+        match = re.fullmatch(r'(Standard_([A-Z]+))(\d+)([a-z]*)(_v\d+)?', size)
+        if match is None:
+            return None
+        smaller = int(match.group(3)) // 2
+        if smaller < (1 if match.group(2) in ('A', 'B') else 2):
+            return None
+        return f"{match.group(1)}{smaller}{match.group(4)}{match.group(5) or ''}"
+
+    @staticmethod
+    def price_key(kind: str, sku: str, location: str, os_type: str) -> int:
+        """Catalog key of a resource's main meter, 0 when it has no single meter to price."""
+        if kind in ('vm', 'vmss') and sku:
+            suffix = ' Windows' if os_type.lower() == 'windows' else ''
+            return PriceCatalog.key('Virtual Machines', sku + suffix, location, _vm_meter(sku))
+        if kind == 'public_ip' and sku:
+            return PriceCatalog.key('Virtual Network', sku, location, f"{sku} IPv4 Static Public IP")
+        if kind == 'load_balancer' and sku == 'Standard':
+            return PriceCatalog.key('Load Balancer', sku, location, 'Standard Included LB Rules and Outbound Rules')
+        return 0
+
+    def joined(self, snapshot: InventorySnapshot, table: CostTable, catalog: PriceCatalog) -> ColumnSet:
+        """The snapshot's columns with each resource's monthly cost: billed when in the table, else list price."""
+        columns = snapshot.columns
+        by_resource = table.by_resource
+        names = table.categories['resource_name']
+        # Cost per case-folded resource name, summed over the resource's cost rows
+        folded = CategoryIndex()
+        folded_codes = folded.encode(name.lower() for name in names)
+        name_nanos = np.bincount(by_resource['name_code'], weights=by_resource['cost_nanos'], minlength=len(names))
+        folded_nanos = np.bincount(folded_codes, weights=name_nanos, minlength=len(folded))
+        positions = {name: code for code, name in enumerate(folded.values)}
+        rows = np.array([positions.get(name.lower(), -1) for name in columns['name'].tolist()], dtype=np.int64)
+        billed = np.full(len(rows), np.nan)
+        billed[rows >= 0] = folded_nanos[rows[rows >= 0]] / NANOS_PER_DOLLAR * SavingsSimulator.monthly_scale(table)
+        
+        keys = np.array([self.price_key(*fields) for fields in zip(columns['kind'].tolist(), columns['sku'].tolist(),
+                                                                   columns['location'].tolist(),
+                                                                   columns['os_type'].tolist())], dtype=np.uint64)
+        listed = catalog.lookup(keys) * columns['capacity']
+        listed[keys == 0] = np.nan
+        result = dict(columns.columns)
+        result['cost'] = np.where(np.isnan(billed), listed, billed)
+        result['cost_source'] = np.where(~np.isnan(billed), 'billed',
+                                         np.where(np.isnan(listed), '', 'list price')).astype(object)
+        return ColumnSet(result)
+
+    def findings(self, snapshot: InventorySnapshot, table: CostTable, catalog: PriceCatalog) -> ColumnSet:
+        """One row per flagged resource with its rule, suggested action and monthly savings, largest first."""
+        joined = self.joined(snapshot, table, catalog)
+        kind, power, cpu_avg, cpu_max = joined['kind'], joined['power_state'], joined['cpu_avg'], joined['cpu_max']
+        compute = ((kind == 'vm') & (power == 'running')) | ((kind == 'vmss') & (joined['capacity'] > 0))
+        measured = compute & ~np.isnan(cpu_avg) & ~np.isnan(cpu_max)
+        idle = measured & (cpu_avg < self.idle_cpu) & (cpu_max < self.low_cpu)
+        low = measured & ~idle & (cpu_avg < self.low_cpu) & (cpu_max < self.peak_cpu)
+        targets = np.array([(self.downsize(sku) or '') if flagged else ''
+                            for sku, flagged in zip(joined['sku'].tolist(), low.tolist())], dtype=object)
+        oversized = low & (targets != '')
+        rules = np.select([
+            (kind == 'public_ip') & ~joined['attached'],
+            (kind == 'vm') & (power == 'stopped'),
+            idle,
+            oversized,
+            (kind == 'load_balancer') & ~joined['attached'],
+            (kind == 'application_gateway') & ~joined['attached'],
+        ], list(self.RULES), default='').astype(object)
+        flagged = np.flatnonzero(rules != '')
+        
+        # Resizing saves the price difference, applied to the billed cost; without catalog
+        # prices for both sizes, one step down is taken to halve the cost
+        cost = joined['cost'][flagged]
+        savings = cost.copy()
+        resize = np.flatnonzero(oversized[flagged])
+        if len(resize):
+            rows = flagged[resize]
+            current = catalog.lookup([self.price_key(*fields) for fields in zip(
+                kind[rows].tolist(), joined['sku'][rows].tolist(), joined['location'][rows].tolist(),
+                joined['os_type'][rows].tolist())])
+            smaller = catalog.lookup([self.price_key(*fields) for fields in zip(
+                kind[rows].tolist(), targets[rows].tolist(), joined['location'][rows].tolist(),
+                joined['os_type'][rows].tolist())])
+            ratio = np.where(np.isnan(current) | np.isnan(smaller) | (current <= 0), 0.5, 1 - smaller / current)
+            savings[resize] = cost[resize] * ratio
+        
+        messages = []
+        for row, rule in zip(flagged.tolist(), rules[flagged].tolist()):
+            values = {'cpu_avg': cpu_avg[row], 'cpu_max': cpu_max[row], 'days': snapshot.cpu_days,
+                      'sku': joined['sku'][row], 'target': targets[row]}
+            finding, action = self.RULES[rule]
+            messages.append((finding.format(**values), action.format(**values)))
+        order = np.argsort(-np.nan_to_num(savings, nan=-np.inf), kind='stable')
+        return ColumnSet({
+            'resource_name': joined['name'][flagged][order],
+            'kind': kind[flagged][order],
+            'sku': joined['sku'][flagged][order],
+            'rule': rules[flagged][order],
+            'finding': np.array([finding for finding, _ in messages], dtype=object)[order],
+            'action': np.array([action for _, action in messages], dtype=object)[order],
+            'suggested_sku': targets[flagged][order],
+            'cpu_avg': cpu_avg[flagged][order],
+            'cpu_max': cpu_max[flagged][order],
+            'cost': cost[order],
+            'cost_source': joined['cost_source'][flagged][order],
+            'savings': savings[order],
+        })
+
+
+def write_csv_chunks(path: str, columns: Dict[str, np.ndarray], chunk_rows: int = EXPORT_CHUNK_ROWS) -> int:
+    """Write equal-length columns as CSV, converting only chunk_rows rows to Python values at a time."""
+    csv = _lazy_import('csv')
+    rows = len(next(iter(columns.values()))) if columns else 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(list(columns))
+        for offset in range(0, rows, chunk_rows):
+            writer.writerows(zip(*(column[offset:offset + chunk_rows].tolist() for column in columns.values())))
+    return rows
+
+
+def write_excel_sheet(workbook, title: str, columns: Dict[str, Iterable], header_style: Optional[str] = None,
+                      max_rows: int = EXCEL_MAX_ROWS, chunk_rows: int = EXPORT_CHUNK_ROWS) -> List[str]:
+    """
+    Stream equal-length columns into a write-only workbook, one chunk of rows at a time.
+
+    Rows beyond the sheet limit continue on 'Title (2)', 'Title (3)', ... sheets, each with
+    the header repeated. Header cells share the workbook's named header_style. Returns the
+    titles of the sheets written.
+    """
+    cell_class = _lazy_import('openpyxl.cell').WriteOnlyCell
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+    rows = len(next(iter(columns.values()))) if columns else 0
+    per_sheet = max_rows - 1
+    titles = []
+    for part, sheet_start in enumerate(range(0, max(rows, 1), per_sheet), 1):
+        suffix = f" ({part})" if part > 1 else ""
+        sheet = workbook.create_sheet(title[:31 - len(suffix)] + suffix)
+        header = []
+        for name in columns:
+            cell = cell_class(sheet, value=name)
+            if header_style is not None:
+                cell.style = header_style
+            header.append(cell)
+        sheet.append(header)
+        sheet_stop = min(sheet_start + per_sheet, rows)
+        for offset in range(sheet_start, sheet_stop, chunk_rows):
+            stop = min(offset + chunk_rows, sheet_stop)
+            for row in zip(*(_python_values(column[offset:stop]) for column in columns.values())):
+                sheet.append(row)
+        titles.append(sheet.title)
+    return titles
+
+
+def _dataset_writer(path: str, schema, file_format: str):
+    if file_format == 'parquet':
+        return _lazy_import('pyarrow.parquet').ParquetWriter(path, schema)
+    return _lazy_import('pyarrow.ipc').new_file(path, schema)
+
+
+def cost_dataset_partitioning():
+    """
+    Partitioning to read a write_cost_dataset dataset with, e.g.
+    pyarrow.dataset.dataset(path, format='parquet', partitioning=cost_dataset_partitioning()).
+
+    Readers need the explicit schema: an estimate-only dataset has nothing but the Hive default
+    partition, from which partitioning='hive' cannot infer the type of the date key.
+    """
+    pa = _lazy_import('pyarrow')
+    return _lazy_import('pyarrow.dataset').partitioning(
+        pa.schema([('resource_group', pa.string()), ('date', pa.date32())]), flavor='hive')
+
+
+def write_cost_dataset(table: 'CostTable', path: str, file_format: str, subscription_id: str,
+                       resource_group: str, chunk_rows: int = EXPORT_CHUNK_ROWS) -> List[str]:
+    """
+    Write the table's line items as a Hive-partitioned Parquet or Arrow IPC dataset.
+
+    Files are laid out as resource_group=<name>/date=<YYYY-MM-DD>/part-0.<format> (undated
+    estimates go to the Hive default partition) and written in row groups of chunk_rows
+    straight from the table columns. Resource type, name and meter stay dictionary-encoded
+    with the table's categories; cost and percentage are numeric. Read it back with
+    cost_dataset_partitioning(). Returns the files written.
+    """
+    pa = _lazy_import('pyarrow')
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([
+        ('subscription_id', dictionary),
+        ('resource_type', dictionary),
+        ('resource_name', dictionary),
+        ('meter', dictionary),
+        ('cost', pa.float64()),
+        ('cost_nanos', pa.int64()),
+        ('percentage', pa.float64()),
+    ])
+    categories = {name: pa.array(table.categories[name], pa.string()) for name in CostTable.CATEGORICAL}
+    subscription = pa.array([subscription_id], pa.string())
+    
+    columns = table.columns
+    order = np.lexsort((columns['resource_name'], columns['resource_type'], columns['day']))
+    days = columns['day'][order]
+    bounds = np.flatnonzero(np.diff(days)) + 1
+    starts = np.concatenate(([0], bounds)) if len(days) else np.zeros(0, dtype=np.int64)
+    stops = np.concatenate((bounds, [len(days)])) if len(days) else np.zeros(0, dtype=np.int64)
+    
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for start, stop in zip(starts, stops):
+        day = int(days[start])
+        partition = os.path.join(path, f"resource_group={resource_group}",
+                                 f"date={date.fromordinal(day).isoformat() if day else HIVE_DEFAULT_PARTITION}")
+        os.makedirs(partition, exist_ok=True)
+        file_path = os.path.join(partition, f"part-0.{file_format}")
+        with _dataset_writer(file_path, schema, file_format) as writer:
+            for offset in range(start, stop, chunk_rows):
+                rows = order[offset:min(offset + chunk_rows, stop)]
+                nanos = columns['cost_nanos'][rows]
+                writer.write_batch(pa.RecordBatch.from_arrays([
+                    pa.DictionaryArray.from_arrays(np.zeros(len(rows), dtype=np.int32), subscription),
+                    *(pa.DictionaryArray.from_arrays(columns[name][rows].astype(np.int32), categories[name])
+                      for name in CostTable.CATEGORICAL),
+                    pa.array(nanos / NANOS_PER_DOLLAR),
+                    pa.array(nanos),
+                    pa.array(table._percentages(nanos)),
+                ], schema=schema))
+        files.append(file_path)
+    return files
+
+
+class AzureCostAnalyzer:
+    def __init__(self, subscription_id: str, resource_group: str = "azure-3tier-rg-ypggv",
+                 batch_size: int = DEFAULT_BATCH_SIZE, concurrency: int = 1,
+                 shard_by: str = 'none', scopes: Optional[List[str]] = None,
+                 usage_store: Optional[UsageStore] = None, resettle_days: int = DEFAULT_RESETTLE_DAYS,
+                 credential=None, clients: Optional[Dict] = None,
+                 infracost_file: Optional[str] = None, classifier: Optional[ResourceClassifier] = None,
+                 history: Optional[CostHistory] = None, anomaly_detector: Optional[AnomalyDetector] = None,
+                 forecaster: Optional[CostForecaster] = None, budget: Optional[float] = None,
+                 scheduler: Optional[RequestScheduler] = None, simulator: Optional['SavingsSimulator'] = None,
+                 price_catalog: Optional[PriceCatalog] = None, terraform_variables: Optional[Dict] = None,
+                 allocator: Optional[CostAllocator] = None, inventory_file: Optional[str] = None,
+                 inventory_cache: Optional[str] = None, inventory_max_age: float = DEFAULT_INVENTORY_MAX_AGE,
+                 inventory_concurrency: int = DEFAULT_INVENTORY_CONCURRENCY,
+                 advisor: Optional[RightsizingAdvisor] = None):
+        self.subscription_id = subscription_id
+        self.resource_group = resource_group
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.shard_by = shard_by
+        self.scopes = scopes or [f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"]
+        self.usage_store = usage_store
+        self.resettle_days = max(0, resettle_days)
+        self.infracost_file = infracost_file
+        self.classifier = classifier or DEFAULT_CLASSIFIER
+        self.history = history
+        self.anomaly_detector = anomaly_detector or AnomalyDetector()
+        self.forecaster = forecaster or CostForecaster()
+        self.budget = budget
+        # Paces and retries API requests; shared by all shards of a run
+        self.scheduler = scheduler or RequestScheduler(self.concurrency)
+        self.simulator = simulator or SavingsSimulator()
+        # Offline estimates price the Terraform stack's resources from a local catalog
+        self.price_catalog = price_catalog or PriceCatalog(DEFAULT_PRICE_SHEET)
+        self.terraform_variables = terraform_variables
+        self.allocator = allocator or CostAllocator()
+        # The inventory stage runs with a recorded snapshot, or with a directory caching fetched ones
+        self.inventory_file = inventory_file
+        self.inventory_cache = inventory_cache
+        self.inventory_max_age = inventory_max_age
+        # Inventory requests go to other providers than usage pages, under their own limit
+        self.inventory_scheduler = RequestScheduler(inventory_concurrency, max_retries=self.scheduler.max_retries)
+        self.advisor = advisor or RightsizingAdvisor()
+        # Azure credential and clients are created on first use (or reuse a client
+        # set already built for this subscription)
+        self._credential = credential
+        self.clients = clients if clients is not None else {}
         
         # Cost data storage
         self.cost_data = {}
         self.resource_costs = {}
+        self.ingest_stats = IngestStats()
+        
+    @property
+    def credential(self):
+        if self._credential is None:
+            with TRACER.span('credential'):
+                self._credential = _default_credential()
+        return self._credential
+    
+    def _client(self, name: str):
+        client = self.clients.get(name)
+        if client is None:
+            credential = self.credential
+            with TRACER.span(f'client.{name}'):
+                module_name, class_name = AZURE_CLIENTS[name]
+                client_class = getattr(_lazy_import(module_name), class_name)
+                client = self.clients[name] = client_class(credential, self.subscription_id)
+        return client
+    
+    @property
+    def consumption_client(self):
+        return self._client('consumption')
+    
+    @property
+    def resource_client(self):
+        return self._client('resource')
+    
+    @property
+    def compute_client(self):
+        return self._client('compute')
+    
+    @property
+    def network_client(self):
+        return self._client('network')
+    
+    @property
+    def monitor_client(self):
+        return self._client('monitor')
+    
+    def __getstate__(self) -> Dict:
+        # Credentials, SDK clients and the SQLite store stay in the parent process;
+        # pickled copies are only used for rendering outputs.
+        state = self.__dict__.copy()
+        state['_credential'] = None
+        state['clients'] = {}
+        state['usage_store'] = None
+        state['history'] = None
+        state['scheduler'] = None
+        state['inventory_scheduler'] = None
+        return state
+        
+    def _ingest_pages(self, pages, aggregator: StreamingCostAggregator) -> IngestStats:
+        """Stream usage pages into the aggregator in bounded batches."""
+        stats = IngestStats()
+        started = time.perf_counter()
+        buffer = []
+        
+        def flush():
+            with TRACER.span('aggregate.batch', rows=len(buffer)):
+                aggregator.add_usages(buffer)
+            TRACER.count('usage.rows', len(buffer))
+            stats.batches += 1
+        
+        for page in pages:
+            stats.pages += 1
+            TRACER.count('api.pages')
+            for usage in page:
+                buffer.append(usage)
+                if len(buffer) >= self.batch_size:
+                    flush()
+                    buffer = []
+        if buffer:
+            flush()
+        stats.rows = aggregator.rows
+        stats.elapsed = time.perf_counter() - started
+        stats.peak_rss_mb = _peak_rss_mb()
+        return stats
+        
+    def _fetch_shard(self, shard: FetchShard,
+                     parent: Optional[Span] = None) -> Tuple[StreamingCostAggregator, IngestStats]:
+        """Fetch and aggregate the usage details of a single shard."""
+        with TRACER.span('fetch.shard', parent, scope=shard.scope, start=str(shard.start), end=str(shard.end)) as span:
+            pages = self.scheduler.pages(lambda raw_response_hook: self.consumption_client.usage_details.list(
+                scope=shard.scope,
+                filter=shard.filter,
+                raw_response_hook=raw_response_hook
+            ))
+            aggregator = StreamingCostAggregator(self.classifier)
+            stats = self._ingest_pages(pages, aggregator)
+            span.attributes.update(rows=stats.rows, pages=stats.pages)
+            return aggregator, stats
+    
+    def _fetch_shards(self, shards: List[FetchShard],
+                      on_shard: Optional[Callable] = None) -> Tuple[StreamingCostAggregator, IngestStats]:
+        """
+        Fetch shards on a bounded thread pool and merge their partial aggregates.
+
+        Partials are merged in shard order, and cell totals are integer sums, so the
+        result is identical to fetching the whole period serially. on_shard(shard,
+        partial) is called in shard order as soon as each shard and all before it are done.
+        """
+        started = time.perf_counter()
+        aggregator = StreamingCostAggregator()
+        stats = IngestStats(shards=len(shards))
+        
+        def merge(shard: FetchShard, result: Tuple[StreamingCostAggregator, IngestStats]):
+            partial, partial_stats = result
+            if on_shard is not None:
+                on_shard(shard, partial)
+            with TRACER.span('aggregate.merge'):
+                aggregator.merge(partial)
+            stats.pages += partial_stats.pages
+            stats.batches += partial_stats.batches
+        
+        if self.concurrency == 1 or len(shards) == 1:
+            for shard in shards:
+                merge(shard, self._fetch_shard(shard))
+        else:
+            parent = TRACER.current()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                results = pool.map(lambda shard: self._fetch_shard(shard, parent), shards)
+                for shard, result in zip(shards, results):
+                    merge(shard, result)
+        stats.rows = aggregator.rows
+        stats.elapsed = time.perf_counter() - started
+        stats.peak_rss_mb = _peak_rss_mb()
+        return aggregator, stats
+    
+    def _fetch_incremental(self, start: date, end: date) -> Tuple[StreamingCostAggregator, IngestStats]:
+        """Fetch only the days after each scope's watermark and serve the rest from the usage store."""
+        started = time.perf_counter()
+        stats = IngestStats(shards=0)
+        for scope in self.scopes:
+            fetch_start = start
+            watermark = self.usage_store.watermark(self.subscription_id, scope)
+            if watermark is not None and watermark >= start:
+                # Always refresh today's partial data, even inside the re-settlement window
+                fetch_start = min(max(start, watermark - timedelta(days=self.resettle_days - 1)), end)
+            print(f"  {scope}: fetching {fetch_start} to {end} (watermark: {watermark or 'none'})")
+            
+            shards = [FetchShard(scope, shard_start, shard_end)
+                      for shard_start, shard_end in _shard_periods(fetch_start, end, self.shard_by)]
+            # Store each shard as soon as it and the shards before it are complete, so a run
+            # that fails part-way resumes from the last completed shard
+            
+            def store(shard: FetchShard, shard_partial: StreamingCostAggregator):
+                with TRACER.span('store.write'):
+                    self.usage_store.replace(self.subscription_id, scope, shard.start, shard.end, shard_partial)
+            
+            partial, partial_stats = self._fetch_shards(shards, store)
+            stats.shards += partial_stats.shards
+            stats.pages += partial_stats.pages
+            stats.batches += partial_stats.batches
+            stats.rows += partial_stats.rows
         
+        with TRACER.span('store.load'):
+            aggregator = self.usage_store.load(self.subscription_id, self.scopes, start, end)
+        stats.elapsed = time.perf_counter() - started
+        stats.peak_rss_mb = _peak_rss_mb()
+        return aggregator, stats
+    
     def get_current_month_costs(self) -> Dict:
         """Get current month's costs for the resource group."""
         try:
@@ -69,146 +3723,200 @@ class AzureCostAnalyzer:
             
             print(f"Fetching costs from {start_date_str} to {end_date_str}...")
             
-            # Get usage details for the resource group
-            usage_details = self.consumption_client.usage_details.list(
-                scope=f"/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group}",
-                filter=f"properties/usageStart ge '{start_date_str}' and properties/usageEnd le '{end_date_str}'"
-            )
-            
-            total_cost = 0.0
-            resource_breakdown = {}
-            
-            for usage in usage_details:
-                cost = float(usage.cost) if usage.cost else 0.0
-                total_cost += cost
-                
-                resource_name = usage.resource_name or "Unknown"
-                resource_type = usage.resource_type or "Unknown"
-                
-                if resource_type not in resource_breakdown:
-                    resource_breakdown[resource_type] = {
-                        'total_cost': 0.0,
-                        'resources': {}
-                    }
-                
-                resource_breakdown[resource_type]['total_cost'] += cost
-                
-                if resource_name not in resource_breakdown[resource_type]['resources']:
-                    resource_breakdown[resource_type]['resources'][resource_name] = 0.0
-                
-                resource_breakdown[resource_type]['resources'][resource_name] += cost
+            retries, throttled = self.scheduler.retries, self.scheduler.throttled
+            with TRACER.span('fetch', incremental=self.usage_store is not None):
+                if self.usage_store is not None:
+                    aggregator, self.ingest_stats = self._fetch_incremental(start_date.date(), end_date.date())
+                else:
+                    shards = [
+                        FetchShard(scope, shard_start, shard_end)
+                        for scope in self.scopes
+                        for shard_start, shard_end in _shard_periods(start_date.date(), end_date.date(), self.shard_by)
+                    ]
+                    aggregator, self.ingest_stats = self._fetch_shards(shards)
+            self.ingest_stats.retries = self.scheduler.retries - retries
+            self.ingest_stats.throttled = self.scheduler.throttled - throttled
+            print(self.ingest_stats.summary())
             
-            return {
-                'total_cost': total_cost,
-                'period': f"{start_date_str} to {end_date_str}",
-                'breakdown': resource_breakdown
-            }
+            with TRACER.span('aggregate.table'):
+                cost_data = aggregator.to_cost_data(f"{start_date_str} to {end_date_str}")
             
+        except ApiThrottledError:
+            # Throttling and dropped connections are not a reason to report made-up numbers
+            raise
         except Exception as e:
+            if RequestScheduler._status(e) is not None:
+                # Neither is an error response (401/403, a bad request): estimates would hide it
+                raise
             print(f"Error fetching current month costs: {e}")
+            print("Falling back to estimated costs")
             return self.get_estimated_costs()
+        
+        # Outside the fallback: a failing history store is a bug to surface, not a reason for estimates
+        with TRACER.span('tags'):
+            cost_data['tags'] = self.get_resource_tags()
+        with TRACER.span('inventory'):
+            cost_data['inventory'] = self.get_inventory()
+        if self.history is not None:
+            with TRACER.span('history.record'):
+                self.history.record(self.subscription_id, self.resource_group,
+                                    start_date.date(), end_date.date(), cost_data['table'])
+            with TRACER.span('history.trends'):
+                cost_data['trends'] = self.history.trends([(self.subscription_id, self.resource_group)],
+                                                          today=end_date.date())
+            with TRACER.span('anomalies'):
+                cost_data['anomalies'] = self.history.detect_anomalies(
+                    self.subscription_id, self.resource_group, self.anomaly_detector,
+                    settled_before=end_date.date() - timedelta(days=self.resettle_days),
+                    since=start_date.date()
+                )
+        else:
+            with TRACER.span('anomalies'):
+                cost_data['anomalies'] = self.anomaly_detector.scan(cost_data['table'])
+        return cost_data
+    
+    def get_resource_tags(self) -> Dict[str, Dict[str, str]]:
+        """Tags of the resource group's resources by name; empty when they cannot be listed."""
+        try:
+            resources = self.scheduler.call(
+                lambda: list(self.resource_client.resources.list_by_resource_group(self.resource_group)))
+        except ApiThrottledError:
+            raise
+        except Exception as e:
+            print(f"Warning: could not list resource tags, allocating without them: {e}")
+            return {}
+        return {resource.name: dict(resource.tags) for resource in resources if getattr(resource, 'tags', None)}
+    
+    def _inventory_call(self, function: Callable, parent: Optional[Span], name: str, **attributes):
+        with TRACER.span(name, parent, **attributes):
+            return self.inventory_scheduler.call(function)
+    
+    def _cpu_utilization(self, resource_id: str, timespan: str) -> Tuple[Optional[float], Optional[float]]:
+        """Average and peak of the hourly 'Percentage CPU' metric of a VM or scale set."""
+        response = self.monitor_client.metrics.list(resource_id, timespan=timespan, interval='PT1H',
+                                                    metricnames='Percentage CPU', aggregation='Average,Maximum')
+        averages, peaks = [], []
+        for metric in response.value or []:
+            for series in metric.timeseries or []:
+                for point in series.data or []:
+                    if point.average is not None:
+                        averages.append(point.average)
+                    if point.maximum is not None:
+                        peaks.append(point.maximum)
+        return (float(np.mean(averages)) if averages else None, float(max(peaks)) if peaks else None)
+    
+    def fetch_inventory(self, cpu_days: int = DEFAULT_CPU_DAYS) -> InventorySnapshot:
+        """
+        List the resource group's VMs, scale sets, load balancers, application gateways and
+        public IPs, then the CPU utilization of running VMs and scale sets over cpu_days.
+
+        The five list calls run concurrently, then one metrics call per running machine;
+        VM power states come with the VM list (instance views are only fetched one by one
+        from API versions that do not return them).
+        """
+        group = self.resource_group
+        compute, network = self.compute_client, self.network_client
+        listings = {
+            'vm': lambda: list(compute.virtual_machines.list(group, expand='instanceView')),
+            'vmss': lambda: list(compute.virtual_machine_scale_sets.list(group)),
+            'load_balancer': lambda: list(network.load_balancers.list(group)),
+            'application_gateway': lambda: list(network.application_gateways.list(group)),
+            'public_ip': lambda: list(network.public_ip_addresses.list(group)),
+        }
+        builders = {
+            'vm': _vm_record,
+            'vmss': _scale_set_record,
+            'load_balancer': _load_balancer_record,
+            'application_gateway': _application_gateway_record,
+            'public_ip': _public_ip_record,
+        }
+        parent = TRACER.current()
+        with ThreadPoolExecutor(max_workers=self.inventory_scheduler.max_concurrency) as pool:
+            listed = dict(zip(listings, pool.map(
+                lambda kind: self._inventory_call(listings[kind], parent, 'inventory.list', kind=kind), listings)))
+            
+            missing = [vm for vm in listed['vm'] if getattr(vm, 'instance_view', None) is None]
+            views = pool.map(lambda vm: self._inventory_call(
+                lambda: compute.virtual_machines.instance_view(group, vm.name), parent, 'inventory.instance_view'),
+                missing)
+            for vm, view in zip(missing, views):
+                vm.instance_view = view
+            resources = [builders[kind](item) for kind, items in listed.items() for item in items]
+            
+            measured = [resource for resource in resources
+                        if (resource['kind'] == 'vm' and resource['power_state'] == 'running')
+                        or (resource['kind'] == 'vmss' and resource['capacity'] > 0)]
+            end = datetime.now(timezone.utc).replace(microsecond=0)
+            timespan = f"{(end - timedelta(days=cpu_days)).isoformat()}/{end.isoformat()}"
+            try:
+                self.monitor_client
+            except ImportError as e:
+                print(f"Warning: CPU metrics need azure-mgmt-monitor ({e}); idle and oversized checks are skipped")
+                measured = []
+            utilization = pool.map(lambda resource: self._inventory_call(
+                lambda: self._cpu_utilization(resource['id'], timespan), parent, 'inventory.metrics'), measured)
+            for resource, (average, peak) in zip(measured, utilization):
+                resource['cpu_avg'], resource['cpu_max'] = average, peak
+        return InventorySnapshot(resources, end.isoformat(), self.subscription_id, self.resource_group, cpu_days)
+    
+    def get_inventory(self, fetch: bool = True) -> Optional[InventorySnapshot]:
+        """
+        The inventory snapshot: the recorded file if one was given, else the cached snapshot
+        when younger than inventory_max_age minutes (any age without fetch), else a fetched
+        one, which is cached. None when the inventory stage is off or nothing is available.
+        """
+        if self.inventory_file:
+            return InventorySnapshot.load(self.inventory_file)
+        if self.inventory_cache is None:
+            return None
+        path = InventorySnapshot.cache_path(self.inventory_cache, self.subscription_id, self.resource_group)
+        cached = InventorySnapshot.load(path) if os.path.exists(path) else None
+        if cached is not None and (not fetch or cached.age_minutes <= self.inventory_max_age):
+            return cached
+        if not fetch:
+            print("Warning: no cached inventory snapshot; rightsizing needs a live run or --inventory-file")
+            return None
+        try:
+            with TRACER.span('inventory.fetch'):
+                snapshot = self.fetch_inventory()
+        except ApiThrottledError:
+            raise
+        except Exception as e:
+            stale = f", using the snapshot from {cached.captured_at}" if cached is not None else ""
+            print(f"Warning: could not fetch the resource inventory{stale}: {e}")
+            return cached
+        snapshot.save(path)
+        return snapshot
     
     def get_estimated_costs(self) -> Dict:
         """Get estimated costs based on resource types and sizes."""
-        print("Using estimated costs (actual usage data not available)...")
-        
-        # Estimated monthly costs based on current resource configuration
-        estimated_costs = {
-            'total_cost': 0.0,
-            'period': 'Estimated Monthly',
-            'breakdown': {
-                'Microsoft.Compute/virtualMachines': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Compute/virtualMachineScaleSets': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Network/loadBalancers': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Network/applicationGateways': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Network/bastionHosts': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Network/trafficmanagerprofiles': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Network/publicIPAddresses': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                },
-                'Microsoft.Storage/storageAccounts': {
-                    'total_cost': 0.0,
-                    'resources': {}
-                }
-            }
-        }
+        if self.infracost_file and os.path.exists(self.infracost_file):
+            print(f"Using Infracost estimates from {self.infracost_file}...")
+            cost_data = load_infracost_breakdown(self.infracost_file, batch_size=self.batch_size,
+                                                 classifier=self.classifier)
+            cost_data['inventory'] = self.get_inventory(fetch=False)
+            return cost_data
         
-        # Cost estimates based on typical Azure pricing (East US region)
-        cost_estimates = {
-            # Virtual Machines (Standard_B2s - 2 vCPUs, 4 GB RAM)
-            'azure-3tier-ad': 30.40,  # Windows Server 2022
-            'az3t-sql-0': 30.40,      # Windows Server 2022 + SQL Server
-            'az3t-sql-1': 30.40,      # Windows Server 2022 + SQL Server
-            
-            # Load Balancers (Standard SKU)
-            'azure-3tier-biz-lb': 18.26,  # Internal LB
-            'azure-3tier-db-lb': 18.26,   # Internal LB
-            
-            # Application Gateway (Standard v2)
-            'azure-3tier-appgw': 195.00,  # Standard v2 with WAF
-            
-            # Azure Bastion
-            'azure-3tier-bastion': 144.00,  # Standard Bastion
-            
-            # Traffic Manager
-            'azure-3tier-tm-ypggv': 1.50,  # Standard profile
-            
-            # Public IPs (Static)
-            'azure-3tier-appgw-pip': 3.65,   # Static IP
-            'azure-3tier-bastion-pip': 3.65, # Static IP
-            
-            # Storage (OS Disks - Standard SSD)
-            'azure-3tier-ad_OsDisk': 4.00,   # 30 GB Standard SSD
-            'az3t-sql-0_OsDisk': 4.00,       # 30 GB Standard SSD
-            'az3t-sql-1_OsDisk': 4.00,       # 30 GB Standard SSD
-        }
+        print("Using estimated costs (actual usage data not available)...")
         
-        # Calculate total estimated cost
-        total_estimated = sum(cost_estimates.values())
-        estimated_costs['total_cost'] = total_estimated
-        
-        # Categorize costs by resource type
-        for resource_name, cost in cost_estimates.items():
-            if 'vm' in resource_name.lower() or 'sql' in resource_name.lower() or 'ad' in resource_name.lower():
-                resource_type = 'Microsoft.Compute/virtualMachines'
-            elif 'lb' in resource_name.lower():
-                resource_type = 'Microsoft.Network/loadBalancers'
-            elif 'appgw' in resource_name.lower():
-                resource_type = 'Microsoft.Network/applicationGateways'
-            elif 'bastion' in resource_name.lower():
-                resource_type = 'Microsoft.Network/bastionHosts'
-            elif 'tm' in resource_name.lower():
-                resource_type = 'Microsoft.Network/trafficmanagerprofiles'
-            elif 'pip' in resource_name.lower():
-                resource_type = 'Microsoft.Network/publicIPAddresses'
-            elif 'disk' in resource_name.lower():
-                resource_type = 'Microsoft.Storage/storageAccounts'
-            else:
-                resource_type = 'Microsoft.Compute/virtualMachines'
-            
-            estimated_costs['breakdown'][resource_type]['total_cost'] += cost
-            estimated_costs['breakdown'][resource_type]['resources'][resource_name] = cost
+        variables = self.terraform_variables
+        if variables is None:
+            variables = load_terraform_variables(SCRIPT_DIR)
+        with TRACER.span('catalog.price'):
+            lines = DeploymentPricer(self.price_catalog).lines([variables])
+        unpriced = np.isnan(lines['cost'])
+        for resource_name, meter in zip(lines['resource_name'][unpriced], lines['meter'][unpriced]):
+            print(f"Warning: no catalog price for {resource_name} ({meter}) in {variables.get('location')}")
+        lines = lines[~unpriced]
         
-        return estimated_costs
+        aggregator = StreamingCostAggregator(self.classifier)
+        aggregator.add_batch(aggregator.make_batch_from_columns(
+            self.classifier.classify_many(lines['resource_name']), lines['resource_name'], lines['meter'],
+            [0] * len(lines), lines['cost']
+        ))
+        cost_data = aggregator.to_cost_data('Estimated Monthly')
+        cost_data['inventory'] = self.get_inventory(fetch=False)
+        return cost_data
     
     def generate_cost_report(self, cost_data: Dict) -> str:
         """Generate a detailed cost report."""
@@ -222,35 +3930,73 @@ class AzureCostAnalyzer:
         report.append(f"Period: {cost_data['period']}")
         report.append("")
         
+        table = CostTable.from_cost_data(cost_data)
+        
         # Total cost summary
         report.append("COST SUMMARY")
         report.append("-" * 40)
-        report.append(f"Total Monthly Cost: ${cost_data['total_cost']:.2f}")
-        report.append(f"Daily Average: ${cost_data['total_cost'] / 30:.2f}")
-        report.append(f"Hourly Average: ${cost_data['total_cost'] / (30 * 24):.2f}")
+        # Averages over the days with usage data; monthly estimates are spread over an average month
+        days = table.average_days
+        report.append(f"Total Monthly Cost: ${table.total_cost:.2f}")
+        if table.days_covered:
+            report.append(f"Days Covered: {table.days_covered}")
+        report.append(f"Daily Average: ${table.total_cost / days:.2f}")
+        report.append(f"Hourly Average: ${table.total_cost / (days * 24):.2f}")
         report.append("")
         
+        # Month-over-month and week-over-week trends from the cost history
+        trends = cost_data.get('trends')
+        if trends is not None:
+            report.append("COST TRENDS")
+            report.append("-" * 40)
+            report.extend(trends.summary_lines())
+            report.append("")
+        
+        # Month-end projection of month-to-date usage
+        if table.days_covered:
+            report.append("MONTH-END FORECAST")
+            report.append("-" * 40)
+            report.extend(self.forecast_lines(table))
+            report.append("")
+        
+        anomalies = cost_data.get('anomalies')
+        if anomalies is not None:
+            report.append("COST ANOMALIES")
+            report.append("-" * 40)
+            report.extend(anomaly_lines(anomalies, with_group=False) or ["No cost anomalies detected"])
+            report.append("")
+        
         # Cost breakdown by resource type
         report.append("COST BREAKDOWN BY RESOURCE TYPE")
         report.append("-" * 50)
         
-        sorted_breakdown = sorted(
-            cost_data['breakdown'].items(),
-            key=lambda x: x[1]['total_cost'],
-            reverse=True
-        )
-        
-        for resource_type, data in sorted_breakdown:
-            if data['total_cost'] > 0:
-                percentage = (data['total_cost'] / cost_data['total_cost']) * 100
-                report.append(f"{resource_type}")
-                report.append(f"  Total Cost: ${data['total_cost']:.2f} ({percentage:.1f}%)")
+        for row in table.by_type.rows():
+            if row.cost > 0:
+                report.append(f"{row.resource_type}")
+                report.append(f"  Total Cost: ${row.cost:.2f} ({row.percentage:.1f}%)")
                 
                 # Individual resources
-                for resource_name, cost in data['resources'].items():
+                resources = table.resources_by_type[row.resource_type]
+                for resource_name, cost in zip(resources['resource_name'], resources['cost']):
                     report.append(f"    - {resource_name}: ${cost:.2f}")
                 report.append("")
         
+        # Costs by architecture tier (shared costs spread) and by tag
+        report.extend(self.allocation_lines(cost_data))
+        
+        # Idle and oversized resources found in the inventory snapshot
+        if cost_data.get('inventory') is not None:
+            report.append("INVENTORY & RIGHTSIZING")
+            report.append("-" * 50)
+            report.extend(self.rightsizing_lines(cost_data))
+            report.append("")
+        
+        # What-if savings of the simulated scenarios
+        report.append("WHAT-IF SAVINGS")
+        report.append("-" * 50)
+        report.extend(self.savings_lines(table))
+        report.append("")
+        
         # Cost optimization recommendations
         report.append("COST OPTIMIZATION RECOMMENDATIONS")
         report.append("-" * 50)
@@ -264,59 +4010,172 @@ class AzureCostAnalyzer:
         
         return "\n".join(report)
     
-    def get_cost_optimization_recommendations(self, cost_data: Dict) -> List[str]:
-        """Generate cost optimization recommendations."""
-        recommendations = []
+    def forecast_lines(self, table: CostTable) -> List[str]:
+        """Report lines projecting the month-end cost, in total, per resource type and against the budget."""
+        total, by_type, month = self.forecaster.forecast_table(table, self.budget)
+        confidence = f"{self.forecaster.confidence:.0%}"
+        row = next(total.rows())
+        lines = [
+            f"Month-to-date: ${row.cost_to_date:.2f} over {month['days_elapsed']} of {month['days_in_month']} days",
+            f"Projected Month-End: ${row.projected:.2f} ({confidence} band ${row.lower:.2f} - ${row.upper:.2f})",
+            f"Burn Rate: ${row.burn_rate:.2f}/day (last 7 days), daily cost changing {row.trend:+.2f} per day",
+        ]
+        if self.budget is not None:
+            elapsed_pct = month['days_elapsed'] / month['days_in_month'] * 100
+            lines.append(f"Budget: ${row.budget:.2f} ({row.budget_used_pct:.1f}% used with {elapsed_pct:.1f}% "
+                         f"of the month elapsed)")
+            if row.overrun > 0:
+                exhausted = month['start'] + timedelta(days=int(row.exhausted_day) - 1)
+                lines.append(f"Projected Overrun: ${row.overrun:.2f} ({row.overrun / row.budget * 100:+.1f}%), "
+                             f"budget exhausted around {exhausted}")
+            else:
+                lines.append(f"Projected to finish ${-row.overrun:.2f} under budget")
+        for type_row in by_type.rows():
+            lines.append(f"  {type_row.resource_type}: ${type_row.cost_to_date:.2f} -> ${type_row.projected:.2f} "
+                         f"(${type_row.lower:.2f} - ${type_row.upper:.2f})")
+        return lines
+    
+    def allocation(self, cost_data: Dict) -> CostAllocation:
+        return self.allocator.allocate(CostTable.from_cost_data(cost_data), cost_data.get('tags'))
+    
+    def allocation_lines(self, cost_data: Dict) -> List[str]:
+        """Report sections with the cost per tier and per value of each allocation tag."""
+        allocation = self.allocation(cost_data)
+        lines = ["COST ALLOCATION BY TIER", "-" * 50]
+        for row in allocation.by_tier.rows():
+            shared = f", shared ${row.shared:.2f}" if row.shared else ""
+            lines.append(f"{row.tier}: ${row.cost:.2f} ({row.percentage:.1f}%) - direct ${row.direct:.2f}{shared}, "
+                         f"{row.resources} resources")
+        lines.append("")
+        for tag_key in allocation.tags:
+            lines.append(f"COST ALLOCATION BY TAG: {tag_key.upper()}")
+            lines.append("-" * 50)
+            pivot = allocation.pivot([f'tag:{tag_key}', 'tier'])
+            for value in dict.fromkeys(pivot[f'tag:{tag_key}'].tolist()):
+                rows = pivot[pivot[f'tag:{tag_key}'] == value]
+                tiers = ", ".join(f"{tier} ${cost:.2f}" for tier, cost in zip(rows['tier'], rows['cost']))
+                lines.append(f"{value}: ${rows['cost'].sum():.2f} ({rows['percentage'].sum():.1f}%) - {tiers}")
+            lines.append("")
+        return lines
+    
+    def rightsizing(self, cost_data: Dict) -> ColumnSet:
+        return self.advisor.findings(cost_data['inventory'], CostTable.from_cost_data(cost_data), self.price_catalog)
+    
+    def rightsizing_lines(self, cost_data: Dict, limit: int = 25) -> List[str]:
+        """Report lines with the inventory counts and the `limit` flagged resources with the largest savings."""
+        inventory = cost_data['inventory']
+        kinds = inventory.columns['kind']
+        labels = {'vm': "VM", 'vmss': "scale set", 'load_balancer': "load balancer",
+                  'application_gateway': "application gateway", 'public_ip': "public IP"}
+        counts = [(np.count_nonzero(kinds == kind), label) for kind, label in labels.items()]
+        counts = ", ".join(f"{count} {label}{'s' if count > 1 else ''}" for count, label in counts if count)
+        lines = [f"Inventory: {len(inventory)} resources ({counts or 'none'}), captured {inventory.captured_at}"]
+        findings = self.rightsizing(cost_data)
+        if not len(findings):
+            return lines + ["No idle or oversized resources found"]
+        priced = findings['savings'][~np.isnan(findings['savings'])]
+        savings = f"~${priced.sum():,.2f}/month" if len(priced) else "unknown"
+        lines.append(f"{len(findings)} resources flagged, potential savings {savings}")
+        for row in findings[:limit].rows():
+            amount = f"~${row.savings:,.2f}/month" if row.savings == row.savings else "savings unknown"
+            source = " at list price" if row.cost_source == 'list price' else ""
+            lines.append(f"- {row.resource_name} ({row.sku or row.kind}): {row.finding}")
+            lines.append(f"    {row.action}; {amount}{source}")
+        if len(findings) > limit:
+            lines.append(f"... and {len(findings) - limit} more (see the Rightsizing sheet of the Excel output)")
+        return lines
+    
+    def savings_lines(self, table: CostTable) -> List[str]:
+        """Report lines with the best simulated scenario for each number of changes."""
+        scenarios = self.simulator.simulate(table)
+        best = self.simulator.labeled(self.simulator.best_by_changes(scenarios))
+        if not len(best):
+            return ["No savings scenarios apply to these resources"]
+        lines = [f"Evaluated {len(scenarios):,} scenarios (monthly figures)"]
+        for row in best.rows():
+            changes = "1 change" if row.changes == 1 else f"{row.changes} changes"
+            lines.append(f"Best with {changes}: ${row.savings:.2f}/month ({row.savings_pct:.1f}%) - {row.scenario}")
+        return lines
+    
+    def optimization_recommendations(self, cost_data: Dict) -> ColumnSet:
+        """Recommendations with priority, simulated monthly savings (NaN when not simulated) and effort."""
+        table = CostTable.from_cost_data(cost_data)
+        scenarios = self.simulator.simulate(table)
+        baseline = table.total_cost * self.simulator.monthly_scale(table)
+        rows = []
         
-        total_cost = cost_data['total_cost']
+        # Levers that would save money here, highest savings first
+        simulated = set()
+        for row in self.simulator.lever_savings(scenarios).rows():
+            lever = self.simulator.levers[row.lever]
+            simulated.add(lever.kind)
+            option = f" ({row.option})" if len(lever.options) > 2 else ""
+            share = row.savings / baseline if baseline else 0.0
+            priority = "High" if share >= 0.1 else "Medium" if share >= 0.03 else "Low"
+            rows.append((priority, f"{lever.recommendation} Potential savings: ~${row.savings:,.0f}/month{option}",
+                         row.savings, lever.effort))
         
-        # Check for high-cost resources
-        for resource_type, data in cost_data['breakdown'].items():
-            if data['total_cost'] > total_cost * 0.3:  # More than 30% of total cost
-                if 'applicationGateways' in resource_type:
-                    recommendations.append(
-                        "Consider using Application Gateway Basic SKU instead of Standard v2 "
-                        "if WAF features are not required. Potential savings: ~$100/month"
-                    )
-                elif 'bastionHosts' in resource_type:
-                    recommendations.append(
-                        "Consider using Azure Bastion only during business hours or "
-                        "implement auto-shutdown. Potential savings: ~$50/month"
-                    )
-                elif 'virtualMachines' in resource_type:
-                    recommendations.append(
-                        "Implement auto-shutdown for VMs during non-business hours. "
-                        "Potential savings: ~$15-20/month per VM"
-                    )
+        # Resources flagged in the inventory, one recommendation per rule
+        if cost_data.get('inventory') is not None:
+            findings = self.rightsizing(cost_data)
+            for rule in dict.fromkeys(findings['rule'].tolist()):
+                flagged = findings[findings['rule'] == rule]
+                names = ", ".join(flagged['resource_name'][:3].tolist())
+                if len(flagged) > 3:
+                    names += f" and {len(flagged) - 3} more"
+                text, effort = self.advisor.RECOMMENDATIONS[rule]
+                text = text.format(names=names)
+                priced = flagged['savings'][~np.isnan(flagged['savings'])]
+                # Unpriced findings only (e.g. an empty application gateway): savings stay unknown, not $0
+                savings = float(priced.sum()) if len(priced) else np.nan
+                if len(priced):
+                    text += f" Potential savings: ~${savings:,.0f}/month"
+                share = savings / baseline if baseline else 0.0
+                priority = "High" if share >= 0.1 else "Medium" if share >= 0.03 else "Low"
+                rows.append((priority, text, savings, effort))
         
-        # General recommendations
-        recommendations.extend([
+        # General recommendations; commitment discounts are still worth checking when no
+        # resource here matched a reservation or Hybrid Benefit lever
+        general = []
+        if 'reservation' not in simulated:
+            general.append("Consider Reserved Instances for VMs that run 24/7 (1-year or 3-year commitment)")
+        if 'hybrid_benefit' not in simulated:
+            general.append("Consider Azure Hybrid Benefit for Windows VMs if you have existing licenses")
+        for recommendation in general + [
             "Enable Azure Cost Management and Billing alerts to monitor spending",
-            "Consider Reserved Instances for SQL VMs if running 24/7 (1-year commitment)",
             "Review and optimize storage types - consider Standard HDD for non-critical data",
             "Implement Azure Advisor recommendations for cost optimization",
-            "Use Azure Policy to enforce cost controls and resource tagging",
-            "Consider Azure Hybrid Benefit for Windows VMs if you have existing licenses"
-        ])
+            "Use Azure Policy to enforce cost controls and resource tagging"
+        ]:
+            rows.append((self._get_priority(recommendation), recommendation, np.nan,
+                         self._get_effort_level(recommendation)))
         
-        return recommendations
+        priority, recommendation, savings, effort = zip(*rows)
+        return ColumnSet({
+            'priority': np.array(priority, dtype=object),
+            'recommendation': np.array(recommendation, dtype=object),
+            'savings': np.array(savings, dtype=np.float64),
+            'effort': np.array(effort, dtype=object),
+        })
+    
+    def get_cost_optimization_recommendations(self, cost_data: Dict) -> List[str]:
+        """Generate cost optimization recommendations."""
+        return self.optimization_recommendations(cost_data)['recommendation'].tolist()
     
     def create_cost_chart(self, cost_data: Dict, output_file: str = "cost_breakdown.png"):
         """Create a visual cost breakdown chart."""
         try:
             # Prepare data for chart
-            labels = []
-            sizes = []
+            table = CostTable.from_cost_data(cost_data)
+            by_type = table.by_type[table.by_type['cost'] > 0]
             colors = ['#ff9999', '#66b3ff', '#99ff99', '#ffcc99', '#ff99cc', '#c2c2f0', '#ffb3e6']
             
-            for resource_type, data in cost_data['breakdown'].items():
-                if data['total_cost'] > 0:
-                    # Shorten resource type names for better display
-                    short_name = resource_type.split('/')[-1].replace('Microsoft.', '')
-                    labels.append(f"{short_name}\n${data['total_cost']:.2f}")
-                    sizes.append(data['total_cost'])
+            # Shortened resource type names for better display
+            labels = [f"{short_name}\n${cost:.2f}" for short_name, cost in zip(by_type['short_type'], by_type['cost'])]
+            sizes = by_type['cost'].tolist()
             
             # Create pie chart
+            plt = _pyplot()
             plt.figure(figsize=(12, 8))
             wedges, texts, autotexts = plt.pie(
                 sizes, 
@@ -326,7 +4185,7 @@ class AzureCostAnalyzer:
                 startangle=90
             )
             
-            plt.title(f'Azure 3-Tier Infrastructure Cost Breakdown\nTotal: ${cost_data["total_cost"]:.2f}/month', 
+            plt.title(f'Azure 3-Tier Infrastructure Cost Breakdown\nTotal: ${table.total_cost:.2f}/month', 
                      fontsize=16, fontweight='bold')
             
             # Improve text readability
@@ -342,31 +4201,22 @@ class AzureCostAnalyzer:
             print(f"Cost breakdown chart saved as: {output_file}")
             
         except Exception as e:
-            print(f"Error creating cost chart: {e}")
+            raise RuntimeError(f"Error creating cost chart: {e}") from e
     
     def create_bar_chart(self, cost_data: Dict, output_file: str = "cost_bar_chart.png"):
         """Create a bar chart for cost breakdown."""
         try:
-            # Prepare data for bar chart
-            resource_types = []
-            costs = []
+            # Prepare data for bar chart (already sorted by cost descending)
+            table = CostTable.from_cost_data(cost_data)
+            by_type = table.by_type[table.by_type['cost'] > 0]
             colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2']
             
-            # Sort by cost descending
-            sorted_breakdown = sorted(
-                cost_data['breakdown'].items(),
-                key=lambda x: x[1]['total_cost'],
-                reverse=True
-            )
-            
-            for resource_type, data in sorted_breakdown:
-                if data['total_cost'] > 0:
-                    # Shorten resource type names for better display
-                    short_name = resource_type.split('/')[-1].replace('Microsoft.', '')
-                    resource_types.append(short_name)
-                    costs.append(data['total_cost'])
+            # Shortened resource type names for better display
+            resource_types = by_type['short_type'].tolist()
+            costs = by_type['cost'].tolist()
             
             # Create bar chart
+            plt = _pyplot()
             plt.figure(figsize=(14, 8))
             bars = plt.bar(resource_types, costs, color=colors[:len(resource_types)])
             
@@ -384,7 +4234,7 @@ class AzureCostAnalyzer:
             plt.grid(axis='y', alpha=0.3)
             
             # Add total cost annotation
-            total_cost = cost_data['total_cost']
+            total_cost = table.total_cost
             plt.text(0.02, 0.98, f'Total Monthly Cost: ${total_cost:.2f}', 
                     transform=plt.gca().transAxes, fontsize=14, fontweight='bold',
                     bbox=dict(boxstyle="round,pad=0.3", facecolor="lightblue", alpha=0.7),
@@ -397,104 +4247,161 @@ class AzureCostAnalyzer:
             print(f"Cost bar chart saved as: {output_file}")
             
         except Exception as e:
-            print(f"Error creating bar chart: {e}")
+            raise RuntimeError(f"Error creating bar chart: {e}") from e
     
     def create_detailed_spreadsheet(self, cost_data: Dict, output_file: str = "detailed_cost_analysis.xlsx"):
-        """Create a detailed Excel spreadsheet with multiple sheets."""
+        """Create a detailed Excel spreadsheet with multiple sheets, streamed row by row."""
         try:
-            with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-                # Sheet 1: Summary
-                summary_data = {
-                    'Metric': [
-                        'Total Monthly Cost',
-                        'Daily Average Cost',
-                        'Hourly Average Cost',
-                        'Total Resources',
-                        'Analysis Date',
-                        'Subscription ID',
-                        'Resource Group'
-                    ],
-                    'Value': [
-                        f"${cost_data['total_cost']:.2f}",
-                        f"${cost_data['total_cost'] / 30:.2f}",
-                        f"${cost_data['total_cost'] / (30 * 24):.2f}",
-                        sum(len(data['resources']) for data in cost_data['breakdown'].values()),
-                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        self.subscription_id,
-                        self.resource_group
-                    ]
-                }
-                summary_df = pd.DataFrame(summary_data)
-                summary_df.to_excel(writer, sheet_name='Summary', index=False)
-                
-                # Sheet 2: Cost by Resource Type
-                resource_type_data = []
-                for resource_type, data in cost_data['breakdown'].items():
-                    if data['total_cost'] > 0:
-                        percentage = (data['total_cost'] / cost_data['total_cost']) * 100
-                        resource_type_data.append({
-                            'Resource Type': resource_type.split('/')[-1].replace('Microsoft.', ''),
-                            'Full Resource Type': resource_type,
-                            'Monthly Cost': data['total_cost'],
-                            'Percentage': percentage,
-                            'Resource Count': len(data['resources'])
-                        })
-                
-                resource_type_df = pd.DataFrame(resource_type_data)
-                resource_type_df = resource_type_df.sort_values('Monthly Cost', ascending=False)
-                resource_type_df.to_excel(writer, sheet_name='By Resource Type', index=False)
-                
-                # Sheet 3: Individual Resources
-                individual_data = []
-                for resource_type, data in cost_data['breakdown'].items():
-                    for resource_name, cost in data['resources'].items():
-                        percentage = (cost / cost_data['total_cost']) * 100
-                        individual_data.append({
-                            'Resource Name': resource_name,
-                            'Resource Type': resource_type.split('/')[-1].replace('Microsoft.', ''),
-                            'Full Resource Type': resource_type,
-                            'Monthly Cost': cost,
-                            'Percentage': percentage,
-                            'Cost Category': self._get_cost_category(resource_type, cost)
-                        })
-                
-                individual_df = pd.DataFrame(individual_data)
-                individual_df = individual_df.sort_values('Monthly Cost', ascending=False)
-                individual_df.to_excel(writer, sheet_name='Individual Resources', index=False)
-                
-                # Sheet 4: Cost Optimization Recommendations
-                recommendations = self.get_cost_optimization_recommendations(cost_data)
-                rec_data = []
-                for i, rec in enumerate(recommendations, 1):
-                    priority = self._get_priority(rec)
-                    rec_data.append({
-                        'Priority': priority,
-                        'Recommendation': rec,
-                        'Estimated Savings': self._get_estimated_savings(rec),
-                        'Implementation Effort': self._get_effort_level(rec)
-                    })
-                
-                rec_df = pd.DataFrame(rec_data)
-                rec_df.to_excel(writer, sheet_name='Optimization Recommendations', index=False)
-                
-                # Sheet 5: Monthly Trends (placeholder for future data)
-                trend_data = {
-                    'Month': ['Current Month', 'Previous Month', '2 Months Ago', '3 Months Ago'],
-                    'Total Cost': [cost_data['total_cost'], 0, 0, 0],
-                    'Compute Cost': [sum(data['total_cost'] for rt, data in cost_data['breakdown'].items() 
-                                       if 'Compute' in rt), 0, 0, 0],
-                    'Network Cost': [sum(data['total_cost'] for rt, data in cost_data['breakdown'].items() 
-                                        if 'Network' in rt), 0, 0, 0],
-                    'Storage Cost': [sum(data['total_cost'] for rt, data in cost_data['breakdown'].items() 
-                                        if 'Storage' in rt), 0, 0, 0]
-                }
-                trend_df = pd.DataFrame(trend_data)
-                trend_df.to_excel(writer, sheet_name='Monthly Trends', index=False)
+            table = CostTable.from_cost_data(cost_data)
+            openpyxl = _lazy_import('openpyxl')
+            styles = _lazy_import('openpyxl.styles')
+            
+            # Write-only workbooks stream rows to disk instead of keeping every cell in memory
+            workbook = openpyxl.Workbook(write_only=True)
+            thin = styles.Side(style='thin')
+            header = styles.NamedStyle(
+                name='Header',
+                font=styles.Font(bold=True),
+                border=styles.Border(left=thin, right=thin, top=thin, bottom=thin),
+                alignment=styles.Alignment(horizontal='center', vertical='top')
+            )
+            workbook.add_named_style(header)
+            
+            # Sheet 1: Summary
+            write_excel_sheet(workbook, 'Summary', {
+                'Metric': [
+                    'Total Monthly Cost',
+                    'Days Covered',
+                    'Daily Average Cost',
+                    'Hourly Average Cost',
+                    'Total Resources',
+                    # The data's period rather than the render time, which a cached workbook would freeze
+                    'Period',
+                    'Subscription ID',
+                    'Resource Group'
+                ],
+                'Value': np.array([
+                    f"${table.total_cost:.2f}",
+                    table.days_covered or "Monthly estimate",
+                    f"${table.total_cost / table.average_days:.2f}",
+                    f"${table.total_cost / (table.average_days * 24):.2f}",
+                    len(table.by_resource),
+                    table.period,
+                    self.subscription_id,
+                    self.resource_group
+                ], dtype=object)
+            }, header.name)
+            
+            # Sheet 2: Cost by Resource Type
+            by_type = table.by_type[table.by_type['cost'] > 0]
+            write_excel_sheet(workbook, 'By Resource Type', {
+                'Resource Type': by_type['short_type'],
+                'Full Resource Type': by_type['resource_type'],
+                'Monthly Cost': by_type['cost'],
+                'Percentage': by_type['percentage'],
+                'Resource Count': by_type['resource_count']
+            }, header.name)
+            
+            # Sheet 3: Individual Resources (continued on further sheets past Excel's row limit)
+            by_resource = table.by_resource
+            write_excel_sheet(workbook, 'Individual Resources', {
+                'Resource Name': by_resource['resource_name'],
+                'Resource Type': by_resource['short_type'],
+                'Full Resource Type': by_resource['resource_type'],
+                'Monthly Cost': by_resource['cost'],
+                'Percentage': by_resource['percentage'],
+                'Cost Category': self._get_cost_categories(by_resource['cost'])
+            }, header.name)
+            
+            # Sheet 4: Cost Optimization Recommendations
+            recommendations = self.optimization_recommendations(cost_data)
+            write_excel_sheet(workbook, 'Optimization Recommendations', {
+                'Priority': recommendations['priority'],
+                'Recommendation': recommendations['recommendation'],
+                'Estimated Savings': np.array([f"${savings:,.2f}/month" if savings == savings else "Variable"
+                                               for savings in recommendations['savings'].tolist()], dtype=object),
+                'Implementation Effort': recommendations['effort']
+            }, header.name)
+            
+            # Sheet 5: Monthly Trends (from the cost history when available)
+            trends = cost_data.get('trends') or CostTrends.from_table(table)
+            month_over_month = trends.month_over_month
+            categories = trends.category_costs(['Compute', 'Network', 'Storage'])
+            write_excel_sheet(workbook, 'Monthly Trends', {
+                'Month': month_over_month['month'],
+                'Total Cost': month_over_month['cost'],
+                'Compute Cost': categories['Compute'],
+                'Network Cost': categories['Network'],
+                'Storage Cost': categories['Storage'],
+                'MoM Change': month_over_month['change'],
+                'MoM Change %': month_over_month['change_pct']
+            }, header.name)
+            
+            # Sheet 6: What-If Scenarios, ranked by simulated monthly savings
+            scenarios = self.simulator.labeled(self.simulator.simulate(table))
+            write_excel_sheet(workbook, 'What-If Scenarios', {
+                'Scenario': scenarios['scenario'],
+                'Changes': scenarios['changes'],
+                'Monthly Cost': scenarios['monthly_cost'],
+                'Monthly Savings': scenarios['savings'],
+                'Savings %': scenarios['savings_pct']
+            }, header.name)
+            
+            # Sheets 7-8: Allocation by tier, and the tier x tag x resource type pivot
+            allocation = self.allocation(cost_data)
+            by_tier = allocation.by_tier
+            write_excel_sheet(workbook, 'Allocation by Tier', {
+                'Tier': by_tier['tier'],
+                'Resources': by_tier['resources'],
+                'Direct Cost': by_tier['direct'],
+                'Shared Cost Allocated': by_tier['shared'],
+                'Total Cost': by_tier['cost'],
+                'Percentage': by_tier['percentage']
+            }, header.name)
+            dimensions = ['tier'] + [f'tag:{tag_key}' for tag_key in allocation.tags] + ['resource_type']
+            pivot = allocation.pivot(dimensions)
+            columns = {'Tier': pivot['tier']}
+            columns.update((f"Tag: {tag_key}", pivot[f'tag:{tag_key}']) for tag_key in allocation.tags)
+            columns.update({
+                'Resource Type': np.array([_short_type_name(value) for value in pivot['resource_type'].tolist()],
+                                          dtype=object),
+                'Monthly Cost': pivot['cost'],
+                'Percentage': pivot['percentage']
+            })
+            write_excel_sheet(workbook, 'Allocation Pivot', columns, header.name)
+            
+            # Sheets 9-10: Inventory joined to costs, and the resources flagged for rightsizing
+            if cost_data.get('inventory') is not None:
+                inventory = self.advisor.joined(cost_data['inventory'], table, self.price_catalog)
+                write_excel_sheet(workbook, 'Inventory', {
+                    'Resource Name': inventory['name'],
+                    'Kind': inventory['kind'],
+                    'SKU': inventory['sku'],
+                    'Location': inventory['location'],
+                    'Power State': inventory['power_state'],
+                    'Attached': inventory['attached'],
+                    'Capacity': inventory['capacity'],
+                    'Avg CPU %': inventory['cpu_avg'],
+                    'Peak CPU %': inventory['cpu_max'],
+                    'Monthly Cost': inventory['cost'],
+                    'Cost Source': inventory['cost_source']
+                }, header.name)
+                findings = self.rightsizing(cost_data)
+                write_excel_sheet(workbook, 'Rightsizing', {
+                    'Resource Name': findings['resource_name'],
+                    'SKU': findings['sku'],
+                    'Finding': findings['finding'],
+                    'Action': findings['action'],
+                    'Suggested SKU': findings['suggested_sku'],
+                    'Monthly Cost': findings['cost'],
+                    'Monthly Savings': findings['savings']
+                }, header.name)
             
+            workbook.save(output_file)
             print(f"Detailed Excel spreadsheet saved as: {output_file}")
             
         except Exception as e:
-            print(f"Error creating Excel spreadsheet: {e}")
+            raise RuntimeError(f"Error creating Excel spreadsheet: {e}") from e
     
     def _get_cost_category(self, resource_type: str, cost: float) -> str:
         """Categorize resources by cost level."""
@@ -507,6 +4414,14 @@ class AzureCostAnalyzer:
         else:
             return "Minimal Cost"
     
+    def _get_cost_categories(self, costs: np.ndarray) -> np.ndarray:
+        """Vectorized _get_cost_category over a series of costs."""
+        return np.select(
+            [costs > 100, costs > 50, costs > 10],
+            ["High Cost", "Medium Cost", "Low Cost"],
+            default="Minimal Cost"
+        )
+    
     def _get_priority(self, recommendation: str) -> str:
         """Determine priority level for recommendations."""
         if "Application Gateway" in recommendation or "Bastion" in recommendation:
@@ -516,19 +4431,6 @@ class AzureCostAnalyzer:
         else:
             return "Low"
     
-    def _get_estimated_savings(self, recommendation: str) -> str:
-        """Extract estimated savings from recommendation text."""
-        if "~$100" in recommendation:
-            return "$100/month"
-        elif "~$50" in recommendation:
-            return "$50/month"
-        elif "~$45" in recommendation:
-            return "$45/month"
-        elif "~$20-30" in recommendation:
-            return "$20-30/month"
-        else:
-            return "Variable"
-    
     def _get_effort_level(self, recommendation: str) -> str:
         """Determine implementation effort level."""
         if "Basic SKU" in recommendation or "auto-shutdown" in recommendation:
@@ -541,78 +4443,1237 @@ class AzureCostAnalyzer:
     def export_to_csv(self, cost_data: Dict, output_file: str = "cost_analysis.csv"):
         """Export cost data to CSV format."""
         try:
-            rows = []
-            
-            for resource_type, data in cost_data['breakdown'].items():
-                for resource_name, cost in data['resources'].items():
-                    rows.append({
-                        'Resource Type': resource_type,
-                        'Resource Name': resource_name,
-                        'Monthly Cost': cost,
-                        'Percentage': (cost / cost_data['total_cost']) * 100
-                    })
-            
-            df = pd.DataFrame(rows)
-            df = df.sort_values('Monthly Cost', ascending=False)
-            df.to_csv(output_file, index=False)
+            by_resource = CostTable.from_cost_data(cost_data).by_resource
+            write_csv_chunks(output_file, {
+                'Resource Type': by_resource['resource_type'],
+                'Resource Name': by_resource['resource_name'],
+                'Monthly Cost': by_resource['cost'],
+                'Percentage': by_resource['percentage']
+            })
             
             print(f"Cost data exported to: {output_file}")
             
         except Exception as e:
-            print(f"Error exporting to CSV: {e}")
+            raise RuntimeError(f"Error exporting to CSV: {e}") from e
+    
+    def export_to_parquet(self, cost_data: Dict, output_dir: str = "cost_lines.parquet"):
+        """Export cost line items as a Parquet dataset partitioned by resource group and date."""
+        try:
+            files = write_cost_dataset(CostTable.from_cost_data(cost_data), output_dir, 'parquet',
+                                       self.subscription_id, self.resource_group)
+            print(f"Cost line items exported to: {output_dir} ({len(files)} partitions)")
+        except Exception as e:
+            raise RuntimeError(f"Error exporting to Parquet: {e}") from e
+    
+    def export_to_arrow(self, cost_data: Dict, output_dir: str = "cost_lines.arrow"):
+        """Export cost line items as an Arrow IPC dataset partitioned by resource group and date."""
+        try:
+            files = write_cost_dataset(CostTable.from_cost_data(cost_data), output_dir, 'arrow',
+                                       self.subscription_id, self.resource_group)
+            print(f"Cost line items exported to: {output_dir} ({len(files)} partitions)")
+        except Exception as e:
+            raise RuntimeError(f"Error exporting to Arrow: {e}") from e
+
+def save_report(analyzer: AzureCostAnalyzer, cost_data: Dict, output_dir: str) -> Tuple[str, str]:
+    """Generate the text report and save it to the output directory."""
+    with TRACER.span('report'):
+        report = analyzer.generate_cost_report(cost_data)
+    report_file = os.path.join(output_dir, f"cost_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+    with open(report_file, 'w') as f:
+        f.write(report)
+    return report, report_file
+
+
+@dataclass
+class RenderResult:
+    """Outcome of rendering one output artifact."""
+    artifact: str
+    path: str
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    cached: bool = False
+    import_times: Optional[Dict[str, float]] = None
+    trace: Optional[Dict] = None
+
+
+class ArtifactCache:
+    """
+    Content-addressed store of rendered artifacts under the output directory.
+
+    Artifacts are keyed by a hash of the cost table and the render options. A manifest
+    records which key each output file currently holds, so unchanged outputs are left
+    alone and previously rendered ones are hard-linked back instead of re-rendered.
+    Stored objects are evicted least-recently-used first beyond a size cap.
+    """
+
+    MANIFEST = "artifact_manifest.json"
+    STORE_DIR = ".artifact_cache"
+
+    def __init__(self, output_dir: str, max_bytes: int = DEFAULT_ARTIFACT_CACHE_MB * 1024 * 1024):
+        self.output_dir = output_dir
+        self.store_dir = os.path.join(output_dir, self.STORE_DIR)
+        self.manifest_path = os.path.join(output_dir, self.MANIFEST)
+        self.max_bytes = max_bytes
+        self.manifest: Dict[str, Dict] = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f).get('artifacts', {})
+            except (OSError, ValueError):
+                self.manifest = {}
+
+    @staticmethod
+    def key(artifact: str, table: 'CostTable', options: Dict) -> str:
+        payload = json.dumps({'artifact': artifact, 'render_version': RENDER_VERSION,
+                              'data': table.fingerprint, 'options': options}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _object_path(self, key: str, path: str) -> str:
+        return os.path.join(self.store_dir, key + os.path.splitext(path)[1])
+
+    def restore(self, key: str, path: str) -> bool:
+        """Put the artifact for key at path without rendering; False if it is not cached."""
+        entry = self.manifest.get(os.path.basename(path))
+        stored = self._object_path(key, path)
+        if entry and entry.get('key') == key and os.path.exists(path):
+            if os.path.exists(stored):
+                os.utime(stored)
+            return True
+        if not os.path.exists(stored):
+            return False
+        os.utime(stored)
+        self._place(stored, path)
+        self._record(key, path)
+        return True
+
+    def store(self, key: str, path: str):
+        """Add a freshly rendered artifact to the store."""
+        os.makedirs(self.store_dir, exist_ok=True)
+        stored = self._object_path(key, path)
+        if not os.path.exists(stored):
+            self._place(path, stored)
+        self._record(key, path)
+
+    @staticmethod
+    def _place(source: str, destination: str):
+        temporary = destination + ".tmp"
+        if os.path.exists(temporary):
+            _remove_path(temporary)
+        if os.path.isdir(source):
+            # Dataset directories are placed file by file; a directory can only replace a missing one
+            shutil.copytree(source, temporary, copy_function=_link_or_copy)
+            if os.path.exists(destination):
+                _remove_path(destination)
+        else:
+            _link_or_copy(source, temporary)
+        os.replace(temporary, destination)
+
+    def _record(self, key: str, path: str):
+        self.manifest[os.path.basename(path)] = {
+            'key': key,
+            'size': _path_size(path),
+            'updated': datetime.now().isoformat(timespec='seconds')
+        }
+
+    def save(self):
+        with open(self.manifest_path, 'w') as f:
+            json.dump({'artifacts': self.manifest}, f, indent=2, sort_keys=True)
+        self.prune()
+
+    def prune(self):
+        """Evict least-recently-used store objects beyond the size cap."""
+        _prune_files(glob.glob(os.path.join(self.store_dir, '*')), max_bytes=self.max_bytes)
+
+
+def _link_or_copy(source: str, destination: str):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _path_size(path: str) -> int:
+    """Size of a file, or of all files under a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _prune_files(paths: List[str], keep: Optional[int] = None, max_bytes: Optional[int] = None) -> List[str]:
+    """Delete the least recently modified files (or directories) beyond a count and/or total size cap."""
+    files = sorted((path for path in paths if os.path.exists(path)), key=os.path.getmtime, reverse=True)
+    removed = []
+    total = 0
+    for index, path in enumerate(files):
+        total += _path_size(path)
+        if (keep is not None and index >= keep) or (max_bytes is not None and total > max_bytes):
+            _remove_path(path)
+            removed.append(path)
+    return removed
+
+
+def prune_reports(output_dir: str, keep: int = DEFAULT_KEEP_REPORTS) -> List[str]:
+    """Keep only the newest text reports in the output directory."""
+    return _prune_files(glob.glob(os.path.join(output_dir, 'cost_report_*.txt')), keep=keep)
+
+
+def _render_artifact(analyzer: AzureCostAnalyzer, artifact: str, cost_data: Dict, path: str) -> RenderResult:
+    """Render a single artifact, capturing its timing and any failure."""
+    started = time.perf_counter()
+    imported_before = set(_IMPORT_TIMES)
+    try:
+        with TRACER.span(f'render.{artifact}'):
+            getattr(analyzer, RENDERERS[artifact][0])(cost_data, path)
+        result = RenderResult(artifact, path, time.perf_counter() - started)
+    except Exception as e:
+        result = RenderResult(artifact, path, time.perf_counter() - started, str(e))
+    result.import_times = {name: elapsed for name, elapsed in _IMPORT_TIMES.items()
+                           if name not in imported_before}
+    return result
+
+
+def _render_in_worker(analyzer: AzureCostAnalyzer, artifact: str, cost_data: Dict, path: str) -> RenderResult:
+    """_render_artifact in a renderer process, handing its spans back to the parent."""
+    result = _render_artifact(analyzer, artifact, cost_data, path)
+    result.trace = TRACER.drain()
+    return result
+
+
+def selected_artifacts(args) -> List[str]:
+    """Output artifacts selected on the command line, in RENDERERS order."""
+    return [artifact for artifact in RENDERERS
+            if getattr(args, artifact) or (args.all and _module_available(RENDERER_REQUIRES.get(artifact)))]
+
+
+def write_outputs(analyzer: AzureCostAnalyzer, cost_data: Dict, args, output_dir: str,
+                  workers: Optional[int] = None, cache: Optional[ArtifactCache] = None) -> List[RenderResult]:
+    """
+    Render the selected output artifacts, concurrently when more than one is requested.
+
+    Renderers are independent, so each runs in its own worker process against the same
+    pre-aggregated cost table snapshot. Artifacts found in the cache are not re-rendered.
+    """
+    artifacts = selected_artifacts(args)
+    if not artifacts:
+        return []
+    
+    table = CostTable.from_cost_data(cost_data).precompute()
+    paths = {artifact: os.path.join(output_dir, RENDERERS[artifact][1]) for artifact in artifacts}
+    options = {'subscription_id': analyzer.subscription_id, 'resource_group': analyzer.resource_group}
+    if cost_data.get('trends') is not None:
+        options['trends'] = cost_data['trends'].fingerprint
+    # Tags, allocation rules and savings levers change sheets without changing the table
+    options['allocation'] = analyzer.allocator.fingerprint
+    options['levers'] = analyzer.simulator.fingerprint
+    if cost_data.get('tags'):
+        options['tags'] = hashlib.sha256(json.dumps(cost_data['tags'], sort_keys=True).encode()).hexdigest()
+    if cost_data.get('inventory') is not None:
+        # Unbilled inventory resources are valued at catalog prices
+        options['inventory'] = (f"{cost_data['inventory'].fingerprint}:{analyzer.advisor.fingerprint}:"
+                                f"{analyzer.price_catalog.fingerprint}")
+    keys = {artifact: ArtifactCache.key(artifact, table, options) for artifact in artifacts}
+    
+    with TRACER.span('render', artifacts=len(artifacts)):
+        started = time.perf_counter()
+        results = {}
+        for artifact in artifacts:
+            if cache is not None and cache.restore(keys[artifact], paths[artifact]):
+                results[artifact] = RenderResult(artifact, paths[artifact], cached=True)
+            elif os.path.exists(paths[artifact]):
+                # Never render into a file that may be hard-linked into the cache
+                _remove_path(paths[artifact])
+        pending = [artifact for artifact in artifacts if artifact not in results]
+        
+        workers = min(workers or len(pending), len(pending)) if pending else 0
+        if workers == 1:
+            rendered = [_render_artifact(analyzer, artifact, cost_data, paths[artifact]) for artifact in pending]
+        elif workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_reset_trace) as pool:
+                futures = [pool.submit(_render_in_worker, analyzer, artifact, cost_data, paths[artifact])
+                           for artifact in pending]
+                rendered = [future.result() for future in futures]
+        else:
+            rendered = []
+        for result in rendered:
+            results[result.artifact] = result
+            TRACER.merge(result.trace)
+            # Keep heavy imports done by renderer processes visible in the startup profile
+            for name, elapsed in (result.import_times or {}).items():
+                _IMPORT_TIMES.setdefault(name, elapsed)
+            if cache is not None and result.error is None:
+                cache.store(keys[result.artifact], result.path)
+        if cache is not None:
+            cache.save()
+    
+    results = [results[artifact] for artifact in artifacts]
+    print(f"\nRendered {len(rendered)} of {len(results)} artifacts in {time.perf_counter() - started:.2f}s:")
+    for result in results:
+        if result.cached:
+            status = "unchanged, reused from cache"
+        elif result.error is None:
+            status = f"{result.elapsed:.2f}s"
+        else:
+            status = f"FAILED after {result.elapsed:.2f}s: {result.error}"
+        print(f"  {os.path.basename(result.path)}: {status}")
+    return results
+
+
+def allocator_from_args(args) -> CostAllocator:
+    tag_keys = [key.strip() for key in args.allocation_tags.split(',') if key.strip()] if args.allocation_tags else None
+    if args.allocation_rules:
+        return CostAllocator.from_file(args.allocation_rules, tag_keys)
+    return CostAllocator(tag_keys=tag_keys)
+
+
+def analyzer_options(args) -> Dict:
+    """Analyzer keyword arguments shared by single-target and batch runs."""
+    return {
+        'batch_size': args.batch_size,
+        'concurrency': args.concurrency,
+        'shard_by': args.shard_by,
+        'resettle_days': args.resettle_days,
+        'classifier': ResourceClassifier.from_file(args.classifier_rules) if args.classifier_rules else None,
+        'anomaly_detector': AnomalyDetector(threshold=args.anomaly_threshold),
+        'forecaster': CostForecaster(confidence=args.forecast_confidence),
+        'budget': args.budget,
+        'scheduler': RequestScheduler(args.concurrency, args.request_rate, max_retries=args.max_retries),
+        'simulator': SavingsSimulator.from_file(args.scenarios) if args.scenarios else None,
+        'price_catalog': PriceCatalog(args.price_sheet, os.path.join(args.output_dir, PriceCatalog.CACHE_DIR)),
+        'terraform_variables': load_terraform_variables(args.terraform_dir),
+        'allocator': allocator_from_args(args),
+        'inventory_file': args.inventory_file,
+        'inventory_cache': args.output_dir if args.inventory else None,
+        'inventory_max_age': args.inventory_max_age,
+        'inventory_concurrency': args.inventory_concurrency,
+        'advisor': RightsizingAdvisor(low_cpu=args.low_cpu),
+    }
+
+
+@dataclass(frozen=True)
+class AnalysisTarget:
+    """A subscription / resource group pair analyzed in batch mode."""
+    subscription_id: str
+    resource_group: str
+
+    @classmethod
+    def parse(cls, text: str) -> 'AnalysisTarget':
+        """Parse 'SUBSCRIPTION_ID/RESOURCE_GROUP' or 'SUBSCRIPTION_ID,RESOURCE_GROUP'."""
+        for separator in (',', '/'):
+            if separator in text:
+                subscription_id, resource_group = (part.strip() for part in text.split(separator, 1))
+                if subscription_id and resource_group:
+                    return cls(subscription_id, resource_group)
+        raise ValueError(f"Invalid target '{text}', expected SUBSCRIPTION_ID/RESOURCE_GROUP")
+
+    @property
+    def slug(self) -> str:
+        return f"{self.subscription_id}_{self.resource_group}"
+
+
+def load_targets(path: str) -> List[AnalysisTarget]:
+    """Read one target per line; blank lines, '#' comments, a CSV header and repeated targets are skipped."""
+    targets = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.lower().startswith('subscription'):
+                continue
+            targets.append(AnalysisTarget.parse(line))
+    return list(dict.fromkeys(targets))
+
+
+# Per-process state of batch workers: one credential, and one client set and request
+# scheduler per subscription
+_WORKER_STATE: Dict = {}
+
+
+def _init_batch_worker():
+    _reset_trace()
+    with TRACER.span('credential'):
+        _WORKER_STATE['credential'] = _default_credential()
+    _WORKER_STATE['clients'] = {}
+    _WORKER_STATE['schedulers'] = {}
+
+
+def _analyze_target(target: AnalysisTarget, args) -> Dict:
+    """Analyze one batch target inside a worker process."""
+    started = time.perf_counter()
+    output_dir = os.path.join(args.output_dir, target.slug)
+    try:
+        with TRACER.span('target', subscription_id=target.subscription_id, resource_group=target.resource_group):
+            os.makedirs(output_dir, exist_ok=True)
+            clients = _WORKER_STATE['clients'].get(target.subscription_id)
+            options = analyzer_options(args)
+            # Rate limits apply per subscription, so targets of one subscription share a scheduler
+            options['scheduler'] = _WORKER_STATE['schedulers'].setdefault(target.subscription_id,
+                                                                          options['scheduler'])
+            analyzer = AzureCostAnalyzer(
+                target.subscription_id, target.resource_group,
+                credential=_WORKER_STATE['credential'], clients=clients,
+                usage_store=UsageStore.in_directory(output_dir) if args.incremental else None,
+                # All targets share one history so trends can be queried across resource groups
+                history=CostHistory.in_directory(args.output_dir) if args.history else None,
+                **options
+            )
+            _WORKER_STATE['clients'][target.subscription_id] = analyzer.clients
+            
+            cost_data = analyzer.get_current_month_costs()
+            _, report_file = save_report(analyzer, cost_data, output_dir)
+            # Worker processes render their own outputs serially
+            cache = None if args.no_artifact_cache else ArtifactCache(output_dir, args.artifact_cache_mb * 1024 * 1024)
+            results = write_outputs(analyzer, cost_data, args, output_dir, workers=1, cache=cache)
+            prune_reports(output_dir, args.keep_reports)
+        failed = [result for result in results if result.error is not None]
+        result = {
+            'target': target,
+            'cost_data': cost_data,
+            'report_file': report_file,
+            'elapsed': time.perf_counter() - started,
+            'error': "; ".join(result.error for result in failed) or None
+        }
+    except Exception as e:
+        result = {
+            'target': target,
+            'cost_data': None,
+            'report_file': None,
+            'elapsed': time.perf_counter() - started,
+            'error': str(e)
+        }
+    # Spans and counters of this target go back to the parent for the run summary
+    result['trace'] = TRACER.drain()
+    return result
+
+
+def rollup_forecast_lines(results: List[Dict], forecaster: CostForecaster, budget: Optional[float]) -> List[str]:
+    """Roll-up report lines projecting each target's month-end cost, fitted as one batch."""
+    dated = [result for result in results if CostTable.from_cost_data(result['cost_data']).days_covered]
+    if not dated:
+        return []
+    forecast, month = forecaster.forecast_tables([CostTable.from_cost_data(result['cost_data'])
+                                                  for result in dated], budget)
+    lines = []
+    for result, row in zip(dated + [None], forecast.rows()):
+        label = (f"{result['target'].subscription_id} / {result['target'].resource_group}"
+                 if result else "All targets")
+        line = f"{label}: ${row.cost_to_date:.2f} -> ${row.projected:.2f} (${row.lower:.2f} - ${row.upper:.2f})"
+        if budget is not None and row.overrun > 0:
+            line += f", over budget by ${row.overrun:.2f}"
+        lines.append(line)
+    lines.insert(0, f"Day {month['days_elapsed']} of {month['days_in_month']}, "
+                    f"{forecaster.confidence:.0%} bands")
+    return lines
+
+
+def generate_rollup_report(results: List[Dict], forecaster: Optional[CostForecaster] = None,
+                           budget: Optional[float] = None) -> str:
+    """Generate a consolidated report across all batch targets."""
+    succeeded = [result for result in results if result['error'] is None]
+    grand_total = sum(CostTable.from_cost_data(result['cost_data']).total_cost for result in succeeded)
+    
+    report = []
+    report.append("=" * 80)
+    report.append("AZURE 3-TIER INFRASTRUCTURE - CONSOLIDATED COST ROLL-UP")
+    report.append("=" * 80)
+    report.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    report.append(f"Targets: {len(results)} ({len(results) - len(succeeded)} failed)")
+    report.append(f"Total Cost: ${grand_total:.2f}")
+    report.append("")
+    
+    report.append("COST BY TARGET")
+    report.append("-" * 50)
+    for result in sorted(succeeded, key=lambda r: r['cost_data']['total_cost'], reverse=True):
+        target = result['target']
+        cost = result['cost_data']['total_cost']
+        percentage = (cost / grand_total) * 100 if grand_total else 0.0
+        report.append(f"{target.subscription_id} / {target.resource_group}")
+        report.append(f"  Total Cost: ${cost:.2f} ({percentage:.1f}%) - {result['cost_data']['period']}")
+    report.append("")
+    
+    report.append("COST BY RESOURCE TYPE (ALL TARGETS)")
+    report.append("-" * 50)
+    if succeeded:
+        combined = CostTable.concat([CostTable.from_cost_data(result['cost_data'])
+                                     for result in succeeded], "All targets")
+        for row in combined.by_type.rows():
+            report.append(f"{row.resource_type}: ${row.cost:.2f} ({row.percentage:.1f}%)")
+    
+    forecast_lines = rollup_forecast_lines(succeeded, forecaster or CostForecaster(), budget)
+    if forecast_lines:
+        report.append("")
+        report.append("MONTH-END FORECAST BY TARGET")
+        report.append("-" * 50)
+        report.extend(forecast_lines)
+    
+    failed = [result for result in results if result['error'] is not None]
+    if failed:
+        report.append("")
+        report.append("FAILED TARGETS")
+        report.append("-" * 50)
+        for result in failed:
+            report.append(f"{result['target'].subscription_id} / {result['target'].resource_group}: {result['error']}")
+    
+    report.append("")
+    report.append("=" * 80)
+    return "\n".join(report)
+
+
+def anomaly_lines(anomalies: ColumnSet, limit: int = 10, with_group: bool = True) -> List[str]:
+    """Text report lines for the first `limit` anomalies."""
+    lines = []
+    for row in anomalies[:limit].rows():
+        where = f"{row.resource_group}/" if with_group and row.resource_group else ""
+        lines.append(f"{date.fromordinal(row.day)} {where}{row.resource_name} ({_short_type_name(row.resource_type)}): "
+                     f"${row.cost:.2f} vs ${row.expected:.2f} expected (z={row.zscore:.1f})")
+    if len(anomalies) > limit:
+        lines.append(f"... and {len(anomalies) - limit} more")
+    return lines
+
+
+def generate_trend_report(args, targets: List[AnalysisTarget]) -> str:
+    """Trend report of the selected targets (or the whole history) from the history store alone."""
+    path = os.path.join(args.output_dir, CostHistory.FILENAME)
+    if not os.path.exists(path):
+        raise RuntimeError(f"No cost history at {path}; run with --history first")
+    if not targets and args.subscription_id:
+        targets = [AnalysisTarget(args.subscription_id, args.resource_group)]
+    
+    started = time.perf_counter()
+    history = CostHistory(path)
+    try:
+        pairs = [(target.subscription_id, target.resource_group) for target in targets] if targets else None
+        trends = history.trends(pairs, months=args.trend_months)
+        anomalies = history.anomalies(pairs, since=date.today() - timedelta(days=30))
+    finally:
+        history.close()
+    
+    report = []
+    report.append("=" * 80)
+    report.append("AZURE 3-TIER INFRASTRUCTURE - COST TRENDS")
+    report.append("=" * 80)
+    report.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    report.append(f"Targets: {', '.join(f'{t.subscription_id} / {t.resource_group}' for t in targets) or 'all'}")
+    report.append(f"Query time: {(time.perf_counter() - started) * 1000:.1f}ms")
+    report.append("")
+    report.extend(trends.summary_lines(months=args.trend_months))
+    report.append("")
+    report.append("COST ANOMALIES (LAST 30 DAYS)")
+    report.append("-" * 40)
+    report.extend(anomaly_lines(anomalies, limit=25) or ["No cost anomalies detected"])
+    report.append("")
+    report.append("=" * 80)
+    return "\n".join(report)
+
+
+def generate_delta_report(args) -> str:
+    """Monthly cost delta of a head Infracost breakdown against the indexed baseline breakdown."""
+    baseline_path = args.infracost_file or os.path.join(args.output_dir, 'infracost_breakdown.json')
+    if not os.path.exists(baseline_path):
+        raise RuntimeError(f"No baseline Infracost breakdown at {baseline_path}; set --infracost-file")
+    classifier = ResourceClassifier.from_file(args.classifier_rules) if args.classifier_rules else ResourceClassifier()
+    
+    started = time.perf_counter()
+    index = InfracostIndex.in_directory(args.output_dir)
+    try:
+        with TRACER.span('delta.index'):
+            rebuilt = index.sync(baseline_path, classifier, batch_size=args.batch_size)
+        indexed = time.perf_counter()
+        with TRACER.span('delta.evaluate'):
+            changes, totals = index.delta(args.delta, classifier)
+    finally:
+        index.close()
+    finished = time.perf_counter()
+    
+    delta_file = os.path.join(args.output_dir, 'cost_delta.json')
+    with open(delta_file, 'w') as f:
+        json.dump({'baseline_file': baseline_path, 'head_file': args.delta, 'totals': totals,
+                   'resources': changes.records()}, f, indent=2)
+    
+    report = []
+    report.append("=" * 80)
+    report.append("AZURE 3-TIER INFRASTRUCTURE - COST DELTA")
+    report.append("=" * 80)
+    report.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    report.append(f"Baseline: {baseline_path} ({'re-indexed' if rebuilt else 'index reused'} "
+                  f"in {(indexed - started) * 1000:.1f}ms)")
+    report.append(f"Change: {args.delta} ({totals['evaluated']} resources in {', '.join(totals['projects']) or 'no projects'}, "
+                  f"{totals['repriced']} re-priced in {(finished - indexed) * 1000:.1f}ms)")
+    report.append("")
+    report.append("RESOURCE CHANGES")
+    report.append("-" * 40)
+    for row in changes.rows():
+        location = f", {row.location}" if row.location else ""
+        report.append(f"{row.delta:+12,.2f}  {row.address} ({row.change}{location}): "
+                      f"${row.baseline:,.2f} -> ${row.head:,.2f}")
+    if not len(changes):
+        report.append("No resource changes")
+    report.append("")
+    pct = f" ({totals['delta_pct']:+.1f}%)" if totals['delta_pct'] is not None else ""
+    report.append(f"Monthly cost: ${totals['baseline']:,.2f} -> ${totals['head']:,.2f}")
+    report.append(f"Monthly delta: {totals['delta']:+,.2f}{pct}")
+    report.append(f"Delta saved to: {delta_file}")
+    report.append("")
+    report.append("=" * 80)
+    return "\n".join(report)
+
+
+def generate_variant_report(args, limit: int = 25) -> str:
+    """Monthly totals of the deployment under each variable set in --price-variants, cheapest first."""
+    with open(args.price_variants) as f:
+        spec = json.load(f)
+    variants = expand_variants(spec, load_terraform_variables(args.terraform_dir))
+    catalog = PriceCatalog(args.price_sheet, os.path.join(args.output_dir, PriceCatalog.CACHE_DIR))
+    
+    started = time.perf_counter()
+    with TRACER.span('catalog.open'):
+        entries = len(catalog)
+    opened = time.perf_counter()
+    with TRACER.span('catalog.variants', variants=len(variants)):
+        totals = DeploymentPricer(catalog).totals(variants)
+    finished = time.perf_counter()
+    
+    overrides = sorted({name for variables in (spec if isinstance(spec, list) else [spec]) for name in variables})
+    # lexsort's last key is the primary one: fully priced variants first, then cheapest, then input order
+    ranked = totals[np.lexsort((totals['variant'], totals['total'], totals['unpriced'] > 0))]
+    variants_file = os.path.join(args.output_dir, 'price_variants.json')
+    with open(variants_file, 'w') as f:
+        json.dump([{**{name: variants[row.variant].get(name) for name in overrides},
+                    'total': row.total, 'unpriced': row.unpriced} for row in ranked.rows()], f, indent=2)
+    
+    report = []
+    report.append("=" * 80)
+    report.append("AZURE 3-TIER INFRASTRUCTURE - PRICE VARIANTS")
+    report.append("=" * 80)
+    report.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    report.append(f"Price catalog: {args.price_sheet} ({entries} prices, opened in {(opened - started) * 1000:.1f}ms)")
+    report.append(f"Priced {len(variants)} variants in {(finished - opened) * 1000:.1f}ms")
+    report.append("")
+    report.append(f"CHEAPEST VARIANTS (MONTHLY, TOP {min(limit, len(ranked))})")
+    report.append("-" * 40)
+    for row in ranked[:limit].rows():
+        variables = ', '.join(f"{name}={variants[row.variant].get(name)}" for name in overrides)
+        unpriced = f" ({row.unpriced} meters without a price)" if row.unpriced else ""
+        report.append(f"${row.total:>12,.2f}  {variables or 'terraform.tfvars'}{unpriced}")
+    report.append("")
+    report.append(f"All variants saved to: {variants_file}")
+    report.append("")
+    report.append("=" * 80)
+    return "\n".join(report)
+
+
+def run_batch(targets: List[AnalysisTarget], args) -> bool:
+    """Analyze all targets in parallel worker processes and write the roll-up; True if all succeeded."""
+    # Two workers writing the same target's output directory would clobber each other
+    targets = list(dict.fromkeys(targets))
+    # Targets spend most of their time waiting on the API, so default to one process per target
+    workers = args.workers or min(len(targets), MAX_BATCH_WORKERS)
+    print(f"Analyzing {len(targets)} targets with {workers} worker processes...")
+    started = time.perf_counter()
+    
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker) as pool:
+        futures = [pool.submit(_analyze_target, target, args) for target in targets]
+        for future in as_completed(futures):
+            result = future.result()
+            TRACER.merge(result.pop('trace', None))
+            target = result['target']
+            if result['error'] is None:
+                print(f"  {target.subscription_id} / {target.resource_group}: "
+                      f"${result['cost_data']['total_cost']:.2f} in {result['elapsed']:.1f}s -> {result['report_file']}")
+            else:
+                print(f"  {target.subscription_id} / {target.resource_group}: failed: {result['error']}")
+            results.append(result)
+    
+    results.sort(key=lambda result: targets.index(result['target']))
+    with TRACER.span('rollup'):
+        rollup = generate_rollup_report(results, CostForecaster(confidence=args.forecast_confidence), args.budget)
+    rollup_file = os.path.join(args.output_dir, f"cost_rollup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+    with open(rollup_file, 'w') as f:
+        f.write(rollup)
+    
+    slowest = max(result['elapsed'] for result in results)
+    print(f"\nBatch completed in {time.perf_counter() - started:.1f}s (slowest target: {slowest:.1f}s)")
+    print(f"Consolidated roll-up saved to: {rollup_file}")
+    print("\n" + rollup)
+    return all(result['error'] is None for result in results)
+
+
+class CostService:
+    """
+    Long-running analysis service: warm clients, scheduled refreshes and a local HTTP/JSON API.
+
+    Each target keeps one analyzer, so its credential, SDK clients and request scheduler stay
+    warm for the life of the process, and refreshes only fetch the days after its usage-store
+    watermark. All refreshes (and so all SQLite access) run on one background thread; requests
+    are answered from the last refresh's snapshot, with response bodies built once per snapshot.
+    """
+
+    SNAPSHOT_DIR = ".service_snapshots"
+
+    def __init__(self, args, targets: List[AnalysisTarget]):
+        self.args = args
+        self.targets = targets
+        self.interval = args.refresh_interval * 60
+        self.started = time.time()
+        self.snapshots: Dict[AnalysisTarget, Dict] = {}
+        self.errors: Dict[AnalysisTarget, str] = {}
+        self.last_refresh: Optional[Dict] = None
+        self._analyzers: Dict[AnalysisTarget, AzureCostAnalyzer] = {}
+        self._credential = None
+        self._clients: Dict[str, Dict] = {}
+        self._schedulers: Dict[str, RequestScheduler] = {}
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self.routes = {
+            '/health': self.health,
+            '/targets': self.target_list,
+            '/costs': self.costs,
+            '/resources': self.resources,
+            '/trends': self.trends,
+            '/anomalies': self.anomalies,
+            '/forecast': self.forecast,
+            '/scenarios': self.scenarios,
+            '/allocation': self.allocation,
+            '/inventory': self.inventory,
+            '/report': self.report,
+            '/artifacts': self.artifacts,
+        }
+
+    def output_dir(self, target: AnalysisTarget) -> str:
+        if len(self.targets) == 1:
+            return self.args.output_dir
+        return os.path.join(self.args.output_dir, target.slug)
+
+    def _analyzer(self, target: AnalysisTarget) -> AzureCostAnalyzer:
+        analyzer = self._analyzers.get(target)
+        if analyzer is None:
+            args = self.args
+            output_dir = self.output_dir(target)
+            os.makedirs(output_dir, exist_ok=True)
+            if self._credential is None and not args.offline:
+                with TRACER.span('credential'):
+                    self._credential = _default_credential()
+            options = analyzer_options(args)
+            # Targets of one subscription share SDK clients and a request scheduler
+            options['scheduler'] = self._schedulers.setdefault(target.subscription_id, options['scheduler'])
+            analyzer = self._analyzers[target] = AzureCostAnalyzer(
+                target.subscription_id, target.resource_group,
+                credential=self._credential, clients=self._clients.setdefault(target.subscription_id, {}),
+                scopes=args.scopes if len(self.targets) == 1 else None,
+                infracost_file=args.infracost_file or (
+                    os.path.join(args.output_dir, 'infracost_breakdown.json') if args.offline else None),
+                usage_store=None if args.offline else UsageStore.in_directory(output_dir),
+                history=CostHistory.in_directory(args.output_dir) if args.history else None,
+                **options
+            )
+        return analyzer
+
+    def refresh(self):
+        """Re-analyze every target and swap in the new snapshots; failed targets keep their last one."""
+        TRACER.drain()
+        started = time.perf_counter()
+        for target in self.targets:
+            target_started = time.perf_counter()
+            try:
+                with TRACER.span('service.refresh', subscription_id=target.subscription_id,
+                                 resource_group=target.resource_group):
+                    analyzer = self._analyzer(target)
+                    output_dir = self.output_dir(target)
+                    cost_data = analyzer.get_estimated_costs() if self.args.offline else analyzer.get_current_month_costs()
+                    report, report_file = save_report(analyzer, cost_data, output_dir)
+                    cache = None if self.args.no_artifact_cache else ArtifactCache(
+                        output_dir, self.args.artifact_cache_mb * 1024 * 1024)
+                    results = write_outputs(analyzer, cost_data, self.args, output_dir, workers=1, cache=cache)
+                    prune_reports(output_dir, self.args.keep_reports)
+                    snapshot_dir, artifacts = self._publish(output_dir, results)
+                previous = self.snapshots.get(target)
+                self.snapshots[target] = {
+                    'analyzer': analyzer,
+                    'cost_data': cost_data,
+                    'table': CostTable.from_cost_data(cost_data),
+                    'report': report,
+                    'report_file': report_file,
+                    'artifacts': artifacts,
+                    'snapshot_dir': snapshot_dir,
+                    'refreshed_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'elapsed': time.perf_counter() - target_started,
+                    'responses': {},
+                }
+                self.errors.pop(target, None)
+                self._prune_snapshot_dirs(output_dir, keep=[snapshot_dir, previous and previous['snapshot_dir']])
+            except Exception as e:
+                self.errors[target] = str(e)
+                print(f"Refresh of {target.subscription_id} / {target.resource_group} failed: {e}")
+        summary = TRACER.summary()
+        self.last_refresh = {
+            'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'elapsed_s': round(time.perf_counter() - started, 3),
+            'counters': summary['counters'],
+            'phases': summary['phases'],
+        }
+        print(f"Refreshed {len(self.targets) - len(self.errors)} of {len(self.targets)} targets "
+              f"in {self.last_refresh['elapsed_s']:.1f}s")
+
+    @classmethod
+    def _publish(cls, output_dir: str, results: List[RenderResult]) -> Tuple[str, Dict[str, str]]:
+        """Link this refresh's artifacts into a directory of their own for its snapshot to serve.
+
+        The next refresh re-renders the artifacts in place, so the live snapshot must not read them there.
+        """
+        root = os.path.join(output_dir, cls.SNAPSHOT_DIR)
+        os.makedirs(root, exist_ok=True)
+        snapshot_dir = _lazy_import('tempfile').mkdtemp(prefix='snapshot-', dir=root)
+        artifacts = {}
+        for result in results:
+            if result.error is not None or not os.path.exists(result.path):
+                continue
+            name = os.path.basename(result.path)
+            destination = os.path.join(snapshot_dir, name)
+            if os.path.isdir(result.path):
+                shutil.copytree(result.path, destination, copy_function=_link_or_copy)
+            else:
+                _link_or_copy(result.path, destination)
+            artifacts[name] = destination
+        return snapshot_dir, artifacts
+
+    @classmethod
+    def _prune_snapshot_dirs(cls, output_dir: str, keep: List[Optional[str]]):
+        # The previous snapshot's files are kept one more refresh for requests still reading them
+        root = os.path.join(output_dir, cls.SNAPSHOT_DIR)
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def run_refresher(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def _snapshot(self, query: Dict[str, str]) -> Dict:
+        target = AnalysisTarget.parse(query['target']) if 'target' in query else self.targets[0]
+        snapshot = self.snapshots.get(target)
+        if snapshot is None:
+            if target not in self.targets:
+                raise LookupError(f"Unknown target {target.subscription_id}/{target.resource_group}")
+            raise LookupError(f"No data yet for {target.subscription_id}/{target.resource_group}")
+        return snapshot
+
+    def health(self, query: Dict[str, str]) -> Dict:
+        if not self.snapshots:
+            status = 'starting'
+        else:
+            status = 'degraded' if self.errors else 'ok'
+        return {
+            'status': status,
+            'uptime_s': round(time.time() - self.started, 1),
+            'refresh_interval_s': self.interval,
+            'last_refresh': self.last_refresh,
+            'targets': self.target_list(query),
+        }
+
+    def target_list(self, query: Dict[str, str]) -> List[Dict]:
+        targets = []
+        for target in self.targets:
+            snapshot = self.snapshots.get(target)
+            targets.append({
+                'subscription_id': target.subscription_id,
+                'resource_group': target.resource_group,
+                'total_cost': snapshot['table'].total_cost if snapshot else None,
+                'refreshed_at': snapshot['refreshed_at'] if snapshot else None,
+                'error': self.errors.get(target),
+            })
+        return targets
+
+    def costs(self, query: Dict[str, str]) -> Dict:
+        snapshot = self._snapshot(query)
+        table = snapshot['table']
+        days = table.average_days
+        analyzer = snapshot['analyzer']
+        return {
+            'subscription_id': analyzer.subscription_id,
+            'resource_group': analyzer.resource_group,
+            'period': table.period,
+            'refreshed_at': snapshot['refreshed_at'],
+            'total_cost': table.total_cost,
+            'days_covered': table.days_covered,
+            'daily_average': table.total_cost / days,
+            'by_type': ColumnSet({name: table.by_type[name] for name in
+                                  ('resource_type', 'short_type', 'cost', 'percentage', 'resource_count')}).records(),
+        }
+
+    def resources(self, query: Dict[str, str]) -> Dict:
+        table = self._snapshot(query)['table']
+        by_resource = table.by_resource
+        if 'type' in query:
+            by_resource = by_resource[(by_resource['resource_type'] == query['type']) |
+                                      (by_resource['short_type'] == query['type'])]
+        limit = int(query.get('limit', 100))
+        fields = ('resource_type', 'resource_name', 'cost', 'percentage', 'rank')
+        return {
+            'count': len(by_resource),
+            'resources': ColumnSet({name: by_resource[name] for name in fields}).records(limit),
+        }
+
+    def trends(self, query: Dict[str, str]) -> Dict:
+        snapshot = self._snapshot(query)
+        trends = snapshot['cost_data'].get('trends') or CostTrends.from_table(snapshot['table'])
+        return {
+            'month_over_month': trends.month_over_month.records(),
+            'week_over_week': trends.week_over_week.records(),
+        }
+
+    def anomalies(self, query: Dict[str, str]) -> Dict:
+        anomalies = self._snapshot(query)['cost_data'].get('anomalies')
+        return {'anomalies': anomalies.records() if anomalies is not None else []}
+
+    def forecast(self, query: Dict[str, str]) -> Dict:
+        snapshot = self._snapshot(query)
+        if not snapshot['table'].days_covered:
+            raise LookupError("No dated usage to forecast from (estimated costs)")
+        analyzer = snapshot['analyzer']
+        total, by_type, month = analyzer.forecaster.forecast_table(snapshot['table'], analyzer.budget)
+        return {
+            'month_start': month['start'].isoformat(),
+            'days_in_month': month['days_in_month'],
+            'days_elapsed': month['days_elapsed'],
+            'confidence': analyzer.forecaster.confidence,
+            'total': total.records()[0],
+            'by_type': by_type.records(),
+        }
+
+    def scenarios(self, query: Dict[str, str]) -> Dict:
+        snapshot = self._snapshot(query)
+        simulator = snapshot['analyzer'].simulator
+        scenarios = simulator.simulate(snapshot['table'])
+        return {
+            'count': len(scenarios),
+            'best_by_changes': simulator.labeled(simulator.best_by_changes(scenarios)).records(),
+            'scenarios': simulator.labeled(scenarios, int(query.get('limit', 100))).records(),
+        }
+
+    def allocation(self, query: Dict[str, str]) -> Dict:
+        """Tier allocation plus a pivot over ?dimensions=tier,tag:environment,resource_type (comma-separated)."""
+        snapshot = self._snapshot(query)
+        allocation = snapshot['analyzer'].allocation(snapshot['cost_data'])
+        dimensions = [dimension for dimension in query.get('dimensions', 'tier').split(',') if dimension]
+        pivot = allocation.pivot(dimensions)
+        return {
+            'by_tier': allocation.by_tier.records(),
+            'dimensions': dimensions,
+            'pivot': pivot.records(int(query['limit']) if 'limit' in query else None),
+        }
+
+    def inventory(self, query: Dict[str, str]) -> Dict:
+        """Inventory joined to costs (?kind= filters, ?limit= caps) and the rightsizing findings."""
+        snapshot = self._snapshot(query)
+        cost_data, analyzer = snapshot['cost_data'], snapshot['analyzer']
+        if cost_data.get('inventory') is None:
+            raise LookupError("No inventory for this target (serve with --inventory or --inventory-file)")
+        resources = analyzer.advisor.joined(cost_data['inventory'], snapshot['table'], analyzer.price_catalog)
+        if 'kind' in query:
+            resources = resources[resources['kind'] == query['kind']]
+        findings = analyzer.rightsizing(cost_data)
+        return {
+            'captured_at': cost_data['inventory'].captured_at,
+            'count': len(resources),
+            'resources': resources.records(int(query['limit']) if 'limit' in query else None),
+            'findings': findings.records(),
+            'potential_savings': float(np.nansum(findings['savings'])),
+        }
+
+    def report(self, query: Dict[str, str]) -> str:
+        return self._snapshot(query)['report']
+
+    def artifacts(self, query: Dict[str, str]) -> List[Dict]:
+        snapshot = self._snapshot(query)
+        return [{'name': name, 'size': _path_size(path), 'directory': os.path.isdir(path)}
+                for name, path in snapshot['artifacts'].items() if os.path.exists(path)]
+
+    def handle(self, method: str, raw_path: str) -> Tuple[int, str, bytes]:
+        """Answer one request: (status, content type, body)."""
+        parse = _lazy_import('urllib.parse')
+        url = parse.urlsplit(raw_path)
+        query = {name: values[-1] for name, values in parse.parse_qs(url.query).items()}
+        path = url.path.rstrip('/') or '/health'
+        try:
+            if method == 'POST' and path == '/refresh':
+                self._wake.set()
+                return 202, 'application/json', json.dumps({'status': 'refresh scheduled'}).encode()
+            if method != 'GET':
+                return 405, 'application/json', json.dumps({'error': f"{method} not allowed"}).encode()
+            if path.startswith('/artifacts/'):
+                snapshot = self._snapshot(query)
+                artifact = snapshot['artifacts'].get(path[len('/artifacts/'):])
+                if artifact is None or not os.path.isfile(artifact):
+                    raise LookupError(f"No file artifact {path[len('/artifacts/'):]}")
+                with open(artifact, 'rb') as f:
+                    return 200, _lazy_import('mimetypes').guess_type(artifact)[0] or 'application/octet-stream', f.read()
+            route = self.routes.get(path)
+            if route is None:
+                raise LookupError(f"No such endpoint {path}")
+            if path in ('/health', '/targets'):
+                return 200, 'application/json', json.dumps(route(query)).encode()
+            # Snapshots never change, so each distinct query is only answered once per refresh
+            responses = self._snapshot(query)['responses']
+            key = (path, tuple(sorted(query.items())))
+            if key not in responses:
+                body = route(query)
+                if isinstance(body, str):
+                    responses[key] = ('text/plain; charset=utf-8', body.encode())
+                else:
+                    responses[key] = ('application/json', json.dumps(body).encode())
+            return (200, *responses[key])
+        except LookupError as e:
+            if isinstance(e, KeyError):
+                # A missing key is a bug in a route, not a missing resource
+                return 500, 'application/json', json.dumps({'error': f"KeyError: {e}"}).encode()
+            status = 503 if str(e).startswith('No data yet') else 404
+            return status, 'application/json', json.dumps({'error': str(e)}).encode()
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        except Exception as e:
+            # Anything else is a bug or a broken snapshot; answer it rather than dropping the connection
+            return 500, 'application/json', json.dumps({'error': f"{type(e).__name__}: {e}"}).encode()
+
+    def handler_class(self):
+        """BaseHTTPRequestHandler subclass answering requests through this service."""
+        server = _lazy_import('http.server')
+        service = self
+        
+        class Handler(server.BaseHTTPRequestHandler):
+            server_version = 'AzureCostAnalysis/1.0'
+            
+            def _send(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def do_GET(self):
+                self._send(*service.handle('GET', self.path))
+            
+            def do_POST(self):
+                self._send(*service.handle('POST', self.path))
+        
+        return Handler
+
+
+def serve(args, targets: List[AnalysisTarget]):
+    """Run the cost service until interrupted (Ctrl-C or SIGTERM)."""
+    # Charts are rendered on the refresh thread, which needs a non-interactive backend
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    service = CostService(args, targets)
+    server = _lazy_import('http.server').ThreadingHTTPServer((args.host, args.port), service.handler_class())
+    refresher = threading.Thread(target=service.run_refresher, name='cost-refresher', daemon=True)
+    refresher.start()
+    signal = _lazy_import('signal')
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"Serving cost data for {len(targets)} targets on http://{args.host}:{server.server_address[1]} "
+          f"(refresh every {args.refresh_interval} minutes)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
 
 def main():
     parser = argparse.ArgumentParser(description='Azure 3-Tier Infrastructure Cost Analysis')
-    parser.add_argument('--subscription-id', required=True, help='Azure subscription ID')
+    parser.add_argument('--subscription-id', help='Azure subscription ID')
     parser.add_argument('--resource-group', default='azure-3tier-rg-ypggv', help='Resource group name')
     parser.add_argument('--output-dir', default='.', help='Output directory for reports and charts')
     parser.add_argument('--chart', action='store_true', help='Generate cost breakdown pie chart')
     parser.add_argument('--bar-chart', action='store_true', help='Generate cost breakdown bar chart')
     parser.add_argument('--excel', action='store_true', help='Generate detailed Excel spreadsheet')
     parser.add_argument('--csv', action='store_true', help='Export cost data to CSV')
-    parser.add_argument('--all', action='store_true', help='Generate all output formats')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Export cost line items as a Parquet dataset partitioned by resource group and date')
+    parser.add_argument('--arrow', action='store_true',
+                        help='Export cost line items as an Arrow IPC dataset partitioned by resource group and date')
+    parser.add_argument('--all', action='store_true',
+                        help='Generate all output formats (Parquet and Arrow only if pyarrow is installed)')
+    parser.add_argument('--render-workers', type=int,
+                        help='Processes rendering output artifacts (default: one per artifact, 1 = serial)')
+    parser.add_argument('--offline', action='store_true',
+                        help='Skip the Azure APIs and report estimated costs')
+    parser.add_argument('--infracost-file',
+                        help='Infracost breakdown JSON used for estimates '
+                             '(default with --offline: infracost_breakdown.json in --output-dir, if present)')
+    parser.add_argument('--delta', metavar='HEAD_BREAKDOWN',
+                        help='Print the monthly cost delta of an Infracost breakdown of the changed stack(s) '
+                             'against the baseline --infracost-file (default: infracost_breakdown.json in '
+                             '--output-dir), re-pricing only resources whose blocks changed')
+    parser.add_argument('--price-sheet', default=DEFAULT_PRICE_SHEET,
+                        help='Retail Prices API export (JSON), or a catalog directory built from one, used to '
+                             'price the Terraform stack offline (default: the East US sample price_sheet.json)')
+    parser.add_argument('--terraform-dir', default=SCRIPT_DIR,
+                        help='Terraform stack whose variables (*.tf defaults, terraform.tfvars) are priced offline')
+    parser.add_argument('--price-variants',
+                        help='JSON list of variable overrides, or an object of value lists to cross, priced '
+                             'from the catalog without calling any API')
+    parser.add_argument('--allocation-rules',
+                        help='JSON file with tier rules, shared-cost splitting rules and tag keys for cost allocation')
+    parser.add_argument('--allocation-tags',
+                        help=f"Comma-separated tag keys to allocate costs by (default: {','.join(DEFAULT_ALLOCATION_TAGS)})")
+    parser.add_argument('--inventory', action='store_true',
+                        help='List VMs, scale sets, load balancers, application gateways and public IPs, join them '
+                             'to the costs and flag idle or oversized resources (snapshots are cached in --output-dir)')
+    parser.add_argument('--inventory-file',
+                        help='Recorded inventory snapshot (JSON) to use instead of the inventory APIs')
+    parser.add_argument('--inventory-max-age', type=float, default=DEFAULT_INVENTORY_MAX_AGE,
+                        help='Minutes a cached inventory snapshot is reused before it is fetched again')
+    parser.add_argument('--inventory-concurrency', type=int, default=DEFAULT_INVENTORY_CONCURRENCY,
+                        help='Inventory and CPU metric requests in flight at once')
+    parser.add_argument('--low-cpu', type=float, default=DEFAULT_LOW_CPU,
+                        help='Average CPU %% below which running VMs and scale sets are flagged as oversized')
+    parser.add_argument('--classifier-rules',
+                        help='JSON file with extra resource-type rules and Terraform type mappings')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print an import-time breakdown when the run finishes')
+    parser.add_argument('--run-summary', action='store_true',
+                        help='Write run_summary.json with phase timings and row/page/byte/retry counters to --output-dir')
+    parser.add_argument('--otlp-file',
+                        help='Write spans and counters as OpenTelemetry OTLP/JSON lines to this file')
+    parser.add_argument('--profile', action='store_true',
+                        help='Run under cProfile and tracemalloc and write the top hotspots to --output-dir')
+    parser.add_argument('--no-artifact-cache', action='store_true',
+                        help='Always re-render artifacts instead of reusing unchanged ones')
+    parser.add_argument('--artifact-cache-mb', type=int, default=DEFAULT_ARTIFACT_CACHE_MB,
+                        help='Size cap of the rendered-artifact cache in the output directory')
+    parser.add_argument('--keep-reports', type=int, default=DEFAULT_KEEP_REPORTS,
+                        help='Number of most recent cost_report_*.txt files to keep')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Usage rows aggregated per columnar batch')
+    parser.add_argument('--shard-by', choices=['none', 'day', 'week'], default='none',
+                        help='Split the usage query into day or week shards')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of shards fetched concurrently')
+    parser.add_argument('--scope', action='append', dest='scopes',
+                        help='ARM scope to query (repeatable); defaults to the resource group')
+    parser.add_argument('--request-rate', type=float,
+                        help='Maximum API page requests per second (default: unpaced until throttled)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Retries of a throttled or failed API request before giving up')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Cache usage under --output-dir and only fetch days after the stored watermark')
+    parser.add_argument('--resettle-days', type=int, default=DEFAULT_RESETTLE_DAYS,
+                        help='Days before the watermark to refetch for late-arriving charges')
+    parser.add_argument('--history', action='store_true',
+                        help='Record daily and monthly costs in a history store under --output-dir for trends')
+    parser.add_argument('--trends', action='store_true',
+                        help='Print cost trends from the history store without calling the Azure APIs')
+    parser.add_argument('--trend-months', type=int, default=12,
+                        help='Months of history covered by trend queries')
+    parser.add_argument('--anomaly-threshold', type=float, default=DEFAULT_ANOMALY_THRESHOLD,
+                        help='EWMA z-score above which a daily cost increase is reported as an anomaly')
+    parser.add_argument('--scenarios',
+                        help='JSON file with what-if savings levers replacing or extending the defaults')
+    parser.add_argument('--budget', type=float,
+                        help='Monthly budget (USD) per resource group to project overruns against')
+    parser.add_argument('--forecast-confidence', type=float, default=DEFAULT_FORECAST_CONFIDENCE,
+                        help='Confidence level of the month-end forecast band')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a service: refresh on a schedule and answer queries over a local HTTP/JSON API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address the --serve API listens on')
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVICE_PORT, help='Port the --serve API listens on')
+    parser.add_argument('--refresh-interval', type=float, default=DEFAULT_REFRESH_MINUTES,
+                        help='Minutes between --serve refreshes (POST /refresh refreshes immediately)')
+    parser.add_argument('--target', action='append', dest='targets', default=[],
+                        help='Batch target SUBSCRIPTION_ID/RESOURCE_GROUP (repeatable)')
+    parser.add_argument('--targets-file', help='File with one SUBSCRIPTION_ID,RESOURCE_GROUP per line')
+    parser.add_argument('--workers', type=int, help=f'Worker processes for batch mode (default: one per target, up to {MAX_BATCH_WORKERS})')
     
     args = parser.parse_args()
-    
+    if args.profile_startup:
+        atexit.register(lambda: print("\n" + startup_profile()))
+    if args.profile:
+        run_profiled(lambda: run(parser, args), args.output_dir)
+    else:
+        run(parser, args)
+
+
+def run(parser: argparse.ArgumentParser, args):
+    """Run the analysis selected on the command line, traced as one 'run' span."""
     try:
-        # Initialize cost analyzer
-        analyzer = AzureCostAnalyzer(args.subscription_id, args.resource_group)
-        
-        # Get cost data
-        print("Analyzing Azure infrastructure costs...")
-        cost_data = analyzer.get_current_month_costs()
-        
-        # Generate report
-        report = analyzer.generate_cost_report(cost_data)
-        
-        # Save report to file
-        report_file = os.path.join(args.output_dir, f"cost_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
-        with open(report_file, 'w') as f:
-            f.write(report)
-        
-        print(f"\nCost analysis report saved to: {report_file}")
-        print("\n" + report)
-        
-        # Generate additional outputs if requested
-        if args.all or args.chart:
-            chart_file = os.path.join(args.output_dir, "cost_breakdown.png")
-            analyzer.create_cost_chart(cost_data, chart_file)
-        
-        if args.all or args.bar_chart:
-            bar_chart_file = os.path.join(args.output_dir, "cost_bar_chart.png")
-            analyzer.create_bar_chart(cost_data, bar_chart_file)
-        
-        if args.all or args.excel:
-            excel_file = os.path.join(args.output_dir, "detailed_cost_analysis.xlsx")
-            analyzer.create_detailed_spreadsheet(cost_data, excel_file)
-        
-        if args.all or args.csv:
-            csv_file = os.path.join(args.output_dir, "cost_analysis.csv")
-            analyzer.export_to_csv(cost_data, csv_file)
-        
+        with TRACER.span('run'):
+            targets = [AnalysisTarget.parse(target) for target in args.targets]
+            if args.targets_file:
+                targets.extend(load_targets(args.targets_file))
+            # A target listed twice (on the command line and in the file) is analyzed once
+            targets = list(dict.fromkeys(targets))
+            if args.trends:
+                print(generate_trend_report(args, targets))
+                return
+            if args.delta:
+                print(generate_delta_report(args))
+                return
+            if args.price_variants:
+                print(generate_variant_report(args))
+                return
+            if args.serve:
+                if not targets and not args.subscription_id:
+                    parser.error("--serve needs --subscription-id, --target or --targets-file")
+                serve(args, targets or [AnalysisTarget(args.subscription_id, args.resource_group)])
+                return
+            if targets:
+                if not run_batch(targets, args):
+                    sys.exit(1)
+                return
+            if not args.subscription_id:
+                parser.error("--subscription-id is required unless --target or --targets-file is given")
+            
+            infracost_file = args.infracost_file
+            if infracost_file is None and args.offline:
+                infracost_file = os.path.join(args.output_dir, 'infracost_breakdown.json')
+            
+            # Initialize cost analyzer
+            analyzer = AzureCostAnalyzer(args.subscription_id, args.resource_group,
+                                         scopes=args.scopes,
+                                         infracost_file=infracost_file,
+                                         usage_store=UsageStore.in_directory(args.output_dir) if args.incremental else None,
+                                         history=CostHistory.in_directory(args.output_dir) if args.history else None,
+                                         **analyzer_options(args))
+            
+            # Get cost data
+            print("Analyzing Azure infrastructure costs...")
+            with TRACER.span('costs', source='estimate' if args.offline else 'api'):
+                cost_data = analyzer.get_estimated_costs() if args.offline else analyzer.get_current_month_costs()
+            
+            # Generate report and save it to file
+            report, report_file = save_report(analyzer, cost_data, args.output_dir)
+            
+            print(f"\nCost analysis report saved to: {report_file}")
+            print("\n" + report)
+            
+            # Generate additional outputs if requested
+            cache = None if args.no_artifact_cache else ArtifactCache(args.output_dir, args.artifact_cache_mb * 1024 * 1024)
+            results = write_outputs(analyzer, cost_data, args, args.output_dir,
+                                    workers=args.render_workers, cache=cache)
+            prune_reports(args.output_dir, args.keep_reports)
+            if any(result.error is not None for result in results):
+                sys.exit(1)
+            
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
+    finally:
+        for path in write_trace_outputs(args):
+            print(f"Trace output saved to: {path}")
 
 if __name__ == "__main__":
     main()
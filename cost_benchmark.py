@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Azure Cost Analysis Benchmarks
+==============================
+
+Benchmarks the cost analyzer against a synthetic stand-in for the Azure Consumption API,
+so its performance can be measured without a live subscription.
+
+Every case (fetch, report and each output renderer) runs in a fresh process at each
+row count and records wall time, throughput and peak memory. Results are appended to
+a JSON-lines history and compared with earlier runs to catch regressions.
+
+Usage:
+    python cost_benchmark.py [--sizes 10k,1m,10m] [--cases fetch,report,csv,excel,chart,bar_chart]
+                             [--output-dir benchmarks] [--fail-on-regression]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+import cost_analysis as ca
+
+# Resource mix of the 3-tier deployment: (ARM type, name prefix)
+FAKE_RESOURCE_TYPES = [
+    ('Microsoft.Compute/virtualMachines', 'vm'),
+    ('Microsoft.Compute/disks', 'osdisk'),
+    ('Microsoft.Network/applicationGateways', 'appgw'),
+    ('Microsoft.Network/bastionHosts', 'bastion'),
+    ('Microsoft.Network/loadBalancers', 'lb'),
+    ('Microsoft.Network/publicIPAddresses', 'pip'),
+    ('Microsoft.Network/trafficManagerProfiles', 'tm'),
+]
+DEFAULT_SIZES = '10k,1m,10m'
+DEFAULT_CASES = ['fetch', 'report', 'csv', 'excel', 'chart', 'bar_chart']
+HISTORY_FILE = 'benchmark_history.jsonl'
+
+
+class FakeUsageDetail:
+    """A legacy usage-details record with the fields the analyzer reads."""
+    __slots__ = ('resource_id', 'meter_id', 'date', 'cost')
+
+    def __init__(self, resource_id: str, meter_id: str, usage_date: datetime, cost: float):
+        self.resource_id = resource_id
+        self.meter_id = meter_id
+        self.date = usage_date
+        self.cost = cost
+
+
+class FakeHttpResponse:
+    def __init__(self, status_code: int, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakePipelineResponse:
+    """What azure-core passes to a raw_response_hook."""
+    def __init__(self, http_response: FakeHttpResponse):
+        self.http_response = http_response
+
+
+class FakeThrottledError(Exception):
+    """A 429 response, shaped like azure.core.exceptions.HttpResponseError."""
+
+    def __init__(self, retry_after: float, headers: Dict[str, str]):
+        seconds = max(math.ceil(retry_after), 1)
+        super().__init__(f"(429) Too many requests, retry after {seconds} seconds")
+        self.status_code = 429
+        self.response = FakeHttpResponse(429, {**headers, 'Retry-After': str(seconds)})
+
+
+class FakePageIterator:
+    """Pages of one usage-details query; continuation_token names the next page."""
+
+    def __init__(self, client: 'FakeConsumptionClient', scope: str, start: date, end: date,
+                 first_page: int, raw_response_hook):
+        self.client = client
+        self.scope = scope
+        self.start = start
+        self.end = end
+        self.raw_response_hook = raw_response_hook
+        self.page = first_page
+        self.pages = -(-client.rows_per_day * ((end - start).days + 1) // client.page_size)
+
+    @property
+    def continuation_token(self) -> Optional[str]:
+        return str(self.page) if self.page < self.pages else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.page >= self.pages:
+            raise StopIteration
+        headers = self.client.request()
+        if self.raw_response_hook is not None:
+            self.raw_response_hook(FakePipelineResponse(FakeHttpResponse(200, headers)))
+        rows = self.client.page_rows(self.scope, self.start, self.end, self.page)
+        self.page += 1
+        return iter(rows)
+
+
+class FakeUsagePager:
+    """Stand-in for the SDK's ItemPaged result of usage_details.list."""
+
+    def __init__(self, client: 'FakeConsumptionClient', scope: str, start: date, end: date, raw_response_hook):
+        self.client = client
+        self.scope = scope
+        self.start = start
+        self.end = end
+        self.raw_response_hook = raw_response_hook
+
+    def by_page(self, continuation_token: Optional[str] = None) -> FakePageIterator:
+        return FakePageIterator(self.client, self.scope, self.start, self.end,
+                                int(continuation_token or 0), self.raw_response_hook)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+
+class FakeUsageDetailsOperations:
+    def __init__(self, client: 'FakeConsumptionClient'):
+        self.client = client
+
+    def list(self, scope: str, filter: Optional[str] = None, raw_response_hook=None, **kwargs) -> FakeUsagePager:
+        dates = re.findall(r"'(\d{4}-\d{2}-\d{2})'", filter or "")
+        start, end = ((date.fromisoformat(dates[0]), date.fromisoformat(dates[1])) if len(dates) == 2
+                      else (date.today().replace(day=1), date.today()))
+        return FakeUsagePager(self.client, scope, start, end, raw_response_hook)
+
+
+class FakeConsumptionClient:
+    """
+    Local stand-in for ConsumptionManagementClient serving synthetic usage details.
+
+    Every day in a queried range has rows_per_day rows. Each row is derived only from
+    its day and its position in that day, so sharded and unsharded queries see the same
+    data. Pages take `latency` seconds. With a quota, at most `quota` page requests are
+    served per `quota_window` seconds; further requests fail with a 429 carrying
+    Retry-After, and successful ones report x-ms-ratelimit-remaining-subscription-reads.
+    """
+
+    def __init__(self, rows_per_day: int = 1000, page_size: int = 1000, latency: float = 0.0,
+                 resources: int = 200, meters: int = 4, quota: Optional[int] = None,
+                 quota_window: float = 1.0):
+        self.rows_per_day = rows_per_day
+        self.page_size = page_size
+        self.latency = latency
+        self.resources = resources
+        self.meters = meters
+        self.quota = quota
+        self.quota_window = quota_window
+        self.usage_details = FakeUsageDetailsOperations(self)
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._resource_ids: Dict[str, List[str]] = {}
+
+    def request(self) -> Dict[str, str]:
+        """Account for one page request, raising FakeThrottledError when over quota."""
+        with self._lock:
+            self.requests += 1
+            headers = {}
+            if self.quota is not None:
+                now = time.monotonic()
+                if now - self._window_start >= self.quota_window:
+                    self._window_start, self._window_requests = now, 0
+                if self._window_requests >= self.quota:
+                    self.throttled += 1
+                    retry_after = max(self._window_start + self.quota_window - now, 0.0)
+                    raise FakeThrottledError(retry_after, {'x-ms-ratelimit-remaining-subscription-reads': '0'})
+                self._window_requests += 1
+                headers['x-ms-ratelimit-remaining-subscription-reads'] = str(self.quota - self._window_requests)
+        if self.latency:
+            time.sleep(self.latency)
+        return headers
+
+    def _resources_for(self, scope: str) -> List[str]:
+        ids = self._resource_ids.get(scope)
+        if ids is None:
+            ids = self._resource_ids[scope] = [
+                f"{scope}/providers/{resource_type}/{prefix}-{index}"
+                for index in range(self.resources)
+                for resource_type, prefix in [FAKE_RESOURCE_TYPES[index % len(FAKE_RESOURCE_TYPES)]]
+            ]
+        return ids
+
+    def page_rows(self, scope: str, start: date, end: date, page: int) -> List[FakeUsageDetail]:
+        """Rows of one page of the [start, end] query."""
+        resource_ids = self._resources_for(scope)
+        total = self.rows_per_day * ((end - start).days + 1)
+        rows = []
+        first = page * self.page_size
+        for position in range(first, min(first + self.page_size, total)):
+            day, index = divmod(position, self.rows_per_day)
+            usage_date = datetime.combine(start + timedelta(days=day), datetime.min.time())
+            ordinal = usage_date.toordinal()
+            rows.append(FakeUsageDetail(
+                resource_ids[(index * 7919 + ordinal) % len(resource_ids)],
+                f"meter-{index % self.meters}",
+                usage_date,
+                ((index * 2654435761 + ordinal) % 1000) / 100.0
+            ))
+        return rows
+
+
+def parse_size(text: str) -> int:
+    """Parse a row count such as 10k, 1m or 2500."""
+    text = text.strip().lower()
+    scale = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def _size_label(rows: int) -> str:
+    for scale, suffix in ((1_000_000, 'm'), (1_000, 'k')):
+        if rows >= scale and rows % scale == 0:
+            return f"{rows // scale}{suffix}"
+    return str(rows)
+
+
+@dataclass
+class BenchmarkResult:
+    """Timings and memory of one case at one row count."""
+    case: str
+    rows: int
+    repeats: int = 0
+    median: float = 0.0
+    best: float = 0.0
+    throughput: float = 0.0
+    peak_rss_mb: Optional[float] = None
+    rss_growth_mb: Optional[float] = None
+    error: Optional[str] = None
+
+
+def _month_days() -> int:
+    today = date.today()
+    return (today - today.replace(day=1)).days + 1
+
+
+def _make_analyzer(client: FakeConsumptionClient) -> ca.AzureCostAnalyzer:
+    return ca.AzureCostAnalyzer('00000000-0000-0000-0000-000000000000', 'azure-3tier-rg-bench',
+                                credential=object(), clients={'consumption': client})
+
+
+def _run_case(case: str, rows: int, options: Dict, data_path: str, output_dir: str,
+              repeat: int, max_time: float) -> BenchmarkResult:
+    """Run one case in the current (fresh) process."""
+    result = BenchmarkResult(case, rows)
+    client = FakeConsumptionClient(rows_per_day=-(-rows // _month_days()), **options)
+    analyzer = _make_analyzer(client)
+    cost_data = None
+    if case != 'fetch':
+        with open(data_path, 'rb') as f:
+            cost_data = pickle.load(f)
+        if case == 'report':
+            run = lambda: analyzer.generate_cost_report(cost_data)
+        else:
+            method, filename = ca.RENDERERS[case]
+            path = os.path.join(output_dir, filename)
+            run = lambda: getattr(analyzer, method)(cost_data, path)
+    else:
+        run = analyzer.get_current_month_costs
+
+    rss_before = ca._peak_rss_mb()
+    timings = []
+    started = time.perf_counter()
+    try:
+        while not timings or (len(timings) < repeat and time.perf_counter() - started < max_time):
+            with contextlib.redirect_stdout(io.StringIO()):
+                case_started = time.perf_counter()
+                output = run()
+                timings.append(time.perf_counter() - case_started)
+            if case == 'fetch':
+                if analyzer.ingest_stats.rows == 0 or output['period'].startswith('Estimated'):
+                    raise RuntimeError("fetch fell back to estimated costs")
+                cost_data = output
+    except Exception as e:
+        result.error = str(e)
+        return result
+
+    if case == 'fetch' and not os.path.exists(data_path):
+        with open(data_path, 'wb') as f:
+            pickle.dump(cost_data, f)
+    result.repeats = len(timings)
+    result.median = statistics.median(timings)
+    result.best = min(timings)
+    result.throughput = rows / result.median if result.median > 0 else 0.0
+    result.peak_rss_mb = ca._peak_rss_mb()
+    if rss_before is not None and result.peak_rss_mb is not None:
+        result.rss_growth_mb = max(result.peak_rss_mb - rss_before, 0.0)
+    return result
+
+
+def _isolated(function, *args):
+    """Run function in a freshly spawned process, so memory peaks are per case."""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(function, *args).result()
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: str) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(results: List[BenchmarkResult], history: List[Dict], options: Dict,
+                     baseline_runs: int = 5, tolerance: float = 0.2) -> List[str]:
+    """Compare results with the median of the last baseline_runs successful runs of each case with the same options."""
+    regressions = []
+    for result in results:
+        if result.error is not None:
+            continue
+        earlier = [entry for entry in history
+                   if entry['case'] == result.case and entry['rows'] == result.rows
+                   and entry.get('options') == options and entry.get('error') is None]
+        earlier = earlier[-baseline_runs:]
+        if not earlier:
+            continue
+        label = f"{result.case} @ {_size_label(result.rows)}"
+        baseline = statistics.median(entry['median'] for entry in earlier)
+        if result.median > baseline * (1 + tolerance):
+            regressions.append(f"{label}: {result.median:.3f}s vs {baseline:.3f}s baseline "
+                               f"({(result.median / baseline - 1) * 100:+.0f}%)")
+        peaks = [entry['peak_rss_mb'] for entry in earlier if entry.get('peak_rss_mb') is not None]
+        if peaks and result.peak_rss_mb is not None:
+            baseline_peak = statistics.median(peaks)
+            if result.peak_rss_mb > baseline_peak * (1 + tolerance):
+                regressions.append(f"{label}: peak RSS {result.peak_rss_mb:.0f} MB vs "
+                                   f"{baseline_peak:.0f} MB baseline")
+    return regressions
+
+
+def run_benchmarks(sizes: List[int], cases: List[str], options: Dict, output_dir: str,
+                   repeat: int = 3, max_time: float = 30.0) -> List[BenchmarkResult]:
+    """Run every case at every size, each in its own process."""
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for rows in sizes:
+            data_path = os.path.join(scratch, f"cost_data_{rows}.pickle")
+            if 'fetch' not in cases:
+                # Later cases render the cost data of a fetch at this size
+                setup = _isolated(_run_case, 'fetch', rows, options, data_path, scratch, 1, 0.0)
+                if setup.error is not None:
+                    results.extend(BenchmarkResult(case, rows, error=f"setup failed: {setup.error}")
+                                   for case in cases)
+                    continue
+            for case in cases:
+                result = _isolated(_run_case, case, rows, options, data_path, output_dir, repeat, max_time)
+                results.append(result)
+                if result.error is None:
+                    rss = f"{result.peak_rss_mb:.0f} MB" if result.peak_rss_mb is not None else "n/a"
+                    print(f"  {case:>10} @ {_size_label(rows):>4}: median {result.median:.3f}s "
+                          f"(best {result.best:.3f}s, {result.repeats}x), {result.throughput:,.0f} rows/sec, "
+                          f"peak RSS {rss}")
+                else:
+                    print(f"  {case:>10} @ {_size_label(rows):>4}: FAILED: {result.error}")
+                if case == 'fetch' and result.error is not None:
+                    break
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Azure Cost Analysis Benchmarks')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma-separated row counts (e.g. 10k,1m,10m)')
+    parser.add_argument('--cases', default=",".join(DEFAULT_CASES),
+                        help=f"Comma-separated cases out of {', '.join(DEFAULT_CASES)}")
+    parser.add_argument('--output-dir', default='benchmarks', help='Directory for rendered outputs and history')
+    parser.add_argument('--repeat', type=int, default=3, help='Maximum runs per case')
+    parser.add_argument('--max-time', type=float, default=30.0,
+                        help='Stop repeating a case once it has run this many seconds')
+    parser.add_argument('--page-size', type=int, default=1000, help='Usage rows per API page')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of simulated latency per page')
+    parser.add_argument('--resources', type=int, default=200, help='Distinct resources in the usage data')
+    parser.add_argument('--meters', type=int, default=4, help='Distinct meters per resource')
+    parser.add_argument('--quota', type=int, help='Page requests allowed per quota window before 429s')
+    parser.add_argument('--quota-window', type=float, default=1.0, help='Quota window in seconds')
+    parser.add_argument('--baseline-runs', type=int, default=5,
+                        help='Earlier runs whose median is the regression baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown or memory growth before a regression is reported')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit 1 when a regression is found')
+
+    args = parser.parse_args()
+    sizes = [parse_size(size) for size in args.sizes.split(',') if size.strip()]
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    unknown = [case for case in cases if case not in DEFAULT_CASES]
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(unknown)}")
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {'page_size': args.page_size, 'latency': args.latency, 'resources': args.resources,
+               'meters': args.meters, 'quota': args.quota, 'quota_window': args.quota_window}
+
+    print(f"Benchmarking {', '.join(cases)} at {', '.join(_size_label(rows) for rows in sizes)} rows...")
+    results = run_benchmarks(sizes, cases, options, args.output_dir, args.repeat, args.max_time)
+
+    history_path = os.path.join(args.output_dir, HISTORY_FILE)
+    regressions = find_regressions(results, load_history(history_path), options,
+                                   args.baseline_runs, args.tolerance)
+    run = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'options': options,
+    }
+    with open(history_path, 'a') as f:
+        for result in results:
+            f.write(json.dumps({**run, **asdict(result)}) + "\n")
+    print(f"\nResults appended to: {history_path}")
+
+    if regressions:
+        print("\nREGRESSIONS")
+        for regression in regressions:
+            print(f"  {regression}")
+    failed = any(result.error is not None for result in results)
+    if failed or (regressions and args.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cost_analysis as ca  # noqa: E402
+
+ds = pytest.importorskip('pyarrow.dataset')
+
+
+@pytest.mark.parametrize('file_format, dataset_format', [('parquet', 'parquet'), ('arrow', 'ipc')])
+def test_estimate_only_dataset_reads_with_partition_schema(tmp_path, file_format, dataset_format):
+    cost_data = ca.load_infracost_breakdown(os.path.join(ROOT, 'cost_reports', 'infracost_breakdown.json'))
+    table = ca.CostTable.from_cost_data(cost_data)
+    path = str(tmp_path / f"cost_lines.{file_format}")
+    ca.write_cost_dataset(table, path, file_format, 'subscription', 'rg')
+    lines = ds.dataset(path, format=dataset_format, partitioning=ca.cost_dataset_partitioning()).to_table()
+    assert lines.num_rows == len(table.columns['day'])
+    assert str(lines.schema.field('date').type) == 'date32[day]'
+    assert lines.column('date').null_count == lines.num_rows
+    assert sum(lines.column('cost').to_pylist()) == pytest.approx(table.total_cost)
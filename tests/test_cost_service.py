@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cost_analysis as ca  # noqa: E402
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """Offline service over the Infracost sample, built from the command line like `--serve` does."""
+    captured = {}
+    monkeypatch.setattr(ca, 'serve', lambda args, targets: captured.update(args=args, targets=targets))
+    monkeypatch.setattr(sys, 'argv', [
+        'cost_analysis.py', '--offline', '--subscription-id', 'subscription', '--csv', '--serve',
+        '--infracost-file', os.path.join(ROOT, 'cost_reports', 'infracost_breakdown.json'),
+        '--output-dir', str(tmp_path)])
+    ca.main()
+    return ca.CostService(captured['args'], captured['targets'])
+
+
+def test_snapshot_artifacts_survive_the_next_refresh(service, tmp_path):
+    service.refresh()
+    first = service.snapshots[service.targets[0]]['artifacts']['cost_analysis.csv']
+    with open(first, 'rb') as f:
+        content = f.read()
+    os.remove(tmp_path / 'cost_analysis.csv')
+    service.refresh()
+    assert open(first, 'rb').read() == content
+    status, _, body = service.handle('GET', '/artifacts/cost_analysis.csv')
+    assert status == 200 and body == content
+    service.refresh()
+    assert not os.path.exists(first)
+    assert len(os.listdir(tmp_path / ca.CostService.SNAPSHOT_DIR)) == 2
+
+
+@pytest.mark.parametrize('error', [KeyError('by_type'), TypeError('unsupported operand'), OSError('disk full')])
+def test_unexpected_errors_answer_500(service, monkeypatch, error):
+    service.refresh()
+
+    def broken(query):
+        raise error
+    monkeypatch.setitem(service.routes, '/costs', broken)
+    status, content_type, body = service.handle('GET', '/costs')
+    assert status == 500 and content_type == 'application/json'
+    assert type(error).__name__.encode() in body
@@ -0,0 +1,75 @@
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cost_analysis as ca  # noqa: E402
+
+
+class _Pager:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def by_page(self, continuation_token=None):
+        yield iter(self.rows)
+
+
+class _UsageDetails:
+    def list(self, **kwargs):
+        day = datetime.now().replace(day=1)
+        return _Pager([SimpleNamespace(
+            resource_id='/subscriptions/s/resourceGroups/rg/providers/Microsoft.Compute/virtualMachines/web-vm0',
+            cost=12.5, date=day, meter_id='m0')])
+
+
+class _ConsumptionClient:
+    usage_details = _UsageDetails()
+
+
+class _BrokenHistory:
+    def record(self, *args, **kwargs):
+        raise RuntimeError("database is locked")
+
+
+def analyzer(**kwargs):
+    return ca.AzureCostAnalyzer('subscription', 'rg', credential=object(),
+                                clients={'consumption': _ConsumptionClient(), 'resource': None},
+                                scheduler=ca.RequestScheduler(max_retries=1, backoff=0), **kwargs)
+
+
+def test_fetched_costs_are_reported():
+    cost_data = analyzer().get_current_month_costs()
+    assert cost_data['table'].total_cost == pytest.approx(12.5)
+
+
+def test_history_errors_do_not_fall_back_to_estimates():
+    with pytest.raises(RuntimeError, match="database is locked"):
+        analyzer(history=_BrokenHistory()).get_current_month_costs()
+
+
+class _ForbiddenError(Exception):
+    status_code = 403
+
+
+class _ForbiddenUsageDetails:
+    def list(self, **kwargs):
+        raise _ForbiddenError("AuthorizationFailed: no Cost Management Reader role")
+
+
+def test_error_responses_do_not_fall_back_to_estimates():
+    client = SimpleNamespace(usage_details=_ForbiddenUsageDetails())
+    analyzer = ca.AzureCostAnalyzer('subscription', 'rg', credential=object(), clients={'consumption': client},
+                                    scheduler=ca.RequestScheduler(max_retries=1, backoff=0))
+    with pytest.raises(_ForbiddenError):
+        analyzer.get_current_month_costs()
+
+
+def test_failures_without_a_response_fall_back_to_estimates():
+    analyzer = ca.AzureCostAnalyzer('subscription', 'rg', credential=object(),
+                                    clients={'consumption': SimpleNamespace()})
+    cost_data = analyzer.get_current_month_costs()
+    assert cost_data['table'].total_cost > 0
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cost_analysis as ca  # noqa: E402
+
+
+def findings(savings):
+    rules = ['empty_app_gateway'] + ['unattached_ip'] * (len(savings) - 1)
+    return ca.ColumnSet({
+        'rule': np.array(rules, dtype=object),
+        'resource_name': np.array([f"resource-{index}" for index in range(len(savings))], dtype=object),
+        'savings': np.array(savings, dtype=np.float64),
+    })
+
+
+def recommendations(monkeypatch, savings):
+    analyzer = ca.AzureCostAnalyzer('subscription')
+    monkeypatch.setattr(analyzer, 'rightsizing', lambda cost_data: findings(savings))
+    cost_data = analyzer.get_estimated_costs()
+    cost_data['inventory'] = object()
+    rows = analyzer.optimization_recommendations(cost_data)
+    return {text: savings for text, savings in zip(rows['recommendation'], rows['savings'])
+            if text.startswith(("Remove or repurpose", "Delete unattached"))}
+
+
+def test_unpriced_rules_keep_unknown_savings(monkeypatch):
+    rows = recommendations(monkeypatch, [np.nan, 3.65, np.nan])
+    gateway = next(text for text in rows if text.startswith("Remove or repurpose"))
+    assert np.isnan(rows[gateway])
+    assert "Potential savings" not in gateway
+    addresses = next(text for text in rows if text.startswith("Delete unattached"))
+    assert rows[addresses] == 3.65
+    assert addresses.endswith("Potential savings: ~$4/month")
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import pytest
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cost_analysis as ca  # noqa: E402
+
+
+def flaky(error, failures, result='ok'):
+    calls = []
+
+    def function():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise error
+        return result
+    return function, calls
+
+
+@pytest.mark.parametrize('error', [ServiceRequestError("connection reset"), ServiceResponseError("read timeout")])
+def test_transport_errors_are_retried(error):
+    scheduler = ca.RequestScheduler(max_retries=3, backoff=0)
+    function, calls = flaky(error, failures=2)
+    assert scheduler.call(function) == 'ok'
+    assert len(calls) == 3
+    assert scheduler.retries == 2
+
+
+def test_exhausted_transport_retries_raise():
+    scheduler = ca.RequestScheduler(max_retries=2, backoff=0)
+    function, calls = flaky(ServiceRequestError("connection reset"), failures=10)
+    with pytest.raises(ca.ApiThrottledError):
+        scheduler.call(function)
+    assert len(calls) == 3
+
+
+class _DroppingUsageDetails:
+    def list(self, **kwargs):
+        raise ServiceResponseError("read timeout")
+
+
+class _ConsumptionClient:
+    usage_details = _DroppingUsageDetails()
+
+
+def test_dropped_connections_do_not_fall_back_to_estimates():
+    analyzer = ca.AzureCostAnalyzer('subscription', credential=object(),
+                                    clients={'consumption': _ConsumptionClient()},
+                                    scheduler=ca.RequestScheduler(max_retries=1, backoff=0))
+    with pytest.raises(ca.ApiThrottledError):
+        analyzer.get_current_month_costs()
+
+
+class _TokenlessPager:
+    """Pages of a list operation without continuation tokens; one request fails once."""
+
+    def __init__(self, pages, fail_at, failed):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.failed = failed
+
+    def by_page(self, continuation_token=None):
+        for number, page in enumerate(self.pages):
+            if number == self.fail_at and not self.failed:
+                self.failed.append(number)
+                raise ServiceResponseError("read timeout")
+            yield iter(page)
+
+
+def test_replayed_pages_are_each_scheduled():
+    pages = [[1, 2], [3, 4], [5]]
+    failed = []
+    scheduler = ca.RequestScheduler(max_retries=3, backoff=0)
+    acquired = []
+    acquire = scheduler._acquire
+
+    def counting_acquire():
+        acquired.append(None)
+        acquire()
+    scheduler._acquire = counting_acquire
+
+    result = list(scheduler.pages(lambda hook: _TokenlessPager(pages, 2, failed)))
+    assert result == pages
+    # Pages 1-2, the failed page 3, pages 1-2 replayed one request each, page 3, end of list
+    assert len(acquired) == 7
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cost_analysis as ca  # noqa: E402
+
+SQL_VMS = ['azurerm_windows_virtual_machine.sql[0]', 'azurerm_windows_virtual_machine.sql[1]']
+DOMAIN_CONTROLLER = 'azurerm_windows_virtual_machine.ad'
+
+
+@pytest.fixture(scope='module')
+def infracost_table():
+    """Cost table of the Infracost sample, whose rows are named by Terraform address."""
+    cost_data = ca.load_infracost_breakdown(os.path.join(ROOT, 'cost_reports', 'infracost_breakdown.json'))
+    return ca.CostTable.from_cost_data(cost_data)
+
+
+def matched(table, lever_name):
+    lever = next(lever for lever in ca.DEFAULT_SAVINGS_LEVERS if lever.name == lever_name)
+    return sorted(table.by_resource['resource_name'][lever.matches(table)].tolist())
+
+
+@pytest.mark.parametrize('lever_name', ['sql_shutdown', 'sql_reservation', 'sql_hybrid_benefit'])
+def test_sql_levers_match_terraform_addresses(infracost_table, lever_name):
+    assert matched(infracost_table, lever_name) == SQL_VMS
+
+
+def test_windows_hybrid_benefit_matches_domain_controller(infracost_table):
+    assert matched(infracost_table, 'windows_hybrid_benefit') == [DOMAIN_CONTROLLER]
+
+
+def test_vm_shutdown_skips_sql_and_domain_controller(infracost_table):
+    names = matched(infracost_table, 'vm_shutdown')
+    assert DOMAIN_CONTROLLER not in names
+    assert not set(SQL_VMS) & set(names)
+
+
+@pytest.mark.parametrize('name, shutdown', [
+    ('az3t-sql-0', False),
+    ('azure-3tier-ad', False),
+    ('azure-3tier-web-vm0', True),
+    ('azurerm_linux_virtual_machine.web[0]', True),
+])
+def test_vm_shutdown_on_azure_names(name, shutdown):
+    aggregator = ca.StreamingCostAggregator()
+    aggregator.add_batch(aggregator.make_batch_from_columns(
+        ['Microsoft.Compute/virtualMachines'], [name], ['Compute'], [0], [10.0]))
+    table = ca.CostTable.from_cost_data(aggregator.to_cost_data('test'))
+    assert (matched(table, 'vm_shutdown') == [name]) is shutdown
+
+
+def test_recommendations_quote_reservation_and_hybrid_benefit(infracost_table):
+    analyzer = ca.AzureCostAnalyzer('subscription')
+    recommendations = analyzer.get_cost_optimization_recommendations({'table': infracost_table})
+    assert any(text.startswith("Consider Reserved Instances for SQL VMs") for text in recommendations)
+    assert any(text.startswith("Consider Azure Hybrid Benefit for the SQL VMs") for text in recommendations)
+    assert not any("auto-shutdown" in text for text in recommendations)
+
+
+def write_levers(tmp_path, *levers):
+    path = tmp_path / 'levers.json'
+    path.write_text(json.dumps({'levers': list(levers)}))
+    return str(path)
+
+
+def test_overrides_keep_the_default_fields_they_leave_out(tmp_path):
+    simulator = ca.SavingsSimulator.from_file(write_levers(tmp_path, {
+        'name': 'appgw_sku', 'options': [['Standard_v2', 1.0], ['Basic', 0.2]]}))
+    lever = next(lever for lever in simulator.levers if lever.name == 'appgw_sku')
+    default = next(lever for lever in ca.DEFAULT_SAVINGS_LEVERS if lever.name == 'appgw_sku')
+    assert lever.options == (('Standard_v2', 1.0), ('Basic', 0.2))
+    assert (lever.kind, lever.recommendation, lever.effort) == (default.kind, default.recommendation, 'Low')
+
+
+def test_new_levers_name_their_missing_fields(tmp_path):
+    path = write_levers(tmp_path, {'name': 'redis_sku', 'kind': 'sku', 'resource_type': 'redis',
+                                   'options': [['Premium', 1.0], ['Standard', 0.5]]})
+    with pytest.raises(ValueError, match="'redis_sku' is missing recommendation"):
+        ca.SavingsSimulator.from_file(path)
@@ -0,0 +1,12 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cost_analysis as ca  # noqa: E402
+
+
+def test_repeated_targets_are_loaded_once(tmp_path):
+    path = tmp_path / 'targets.csv'
+    path.write_text("subscription_id,resource_group\nsub-a,rg-web\n# staging\nsub-b/rg-data\nsub-a, rg-web\n")
+    assert ca.load_targets(str(path)) == [ca.AnalysisTarget('sub-a', 'rg-web'), ca.AnalysisTarget('sub-b', 'rg-data')]